@@ -0,0 +1,294 @@
+import gc
+import sys
+import time
+
+import cpphelper
+import namedstruct
+import packer
+import reader
+import values
+
+
+# Benchmarks of the namedstruct library, runBenchmarks() runs all of them.
+# They print the cost per element for growing numbers of elements, which should stay flat.
+
+
+# calls the function with the given arguments, returns the elapsed seconds and the result
+def timeCall(function, *args):
+    start = time.time()
+    result = function(*args)
+    return time.time() - start, result
+
+
+# prints the microseconds per entry of extending, getting the field lengths and packing bit field arrays
+def benchmarkBitFieldArray(sizes=(10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7)):
+    print "bitFieldArray, microseconds per entry"
+    print "%10s %10s %14s %10s" % ("entries", "extend", "fieldLengths", "pack")
+    for size in sizes:
+        array = values.BitFieldArray("benchmarkArray", "a", "b", "c")
+        extendTime, _ = timeCall(array.extend, ((i % 7, i % 1000, i) for i in xrange(size)))
+        fieldLengthsTime, _ = timeCall(array.getFieldLengths)
+        packTime, _ = timeCall(array.pack)
+        print "%10d %10.3f %14.6f %10.3f" % (size,
+                                             extendTime * 1e6 / size,
+                                             fieldLengthsTime * 1e6 / size,
+                                             packTime * 1e6 / size)
+
+
+# prints the microseconds per entry of decoding a packed bit field array to numpy columns, all at once and by the
+# entry with the python reader
+def benchmarkDecodeBitFieldArray(sizes=(10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7)):
+    import numpy  # numpy is optional, it's only required for columns
+    print "decode bitFieldArray, microseconds per entry"
+    print "%10s %10s %10s" % ("entries", "decode", "get")
+    for size in sizes:
+        indices = numpy.arange(size)
+        array = values.BitFieldArray.fromColumns("benchmarkArray", [indices % 7, indices % 1000, indices],
+                                                 ["a", "b", "c"])
+        data = array.pack()[0]
+        decodeTime, _ = timeCall(reader.decodeBitFieldArray, data, array)
+        arrayReader = reader.Reader(data, array).getRoot()
+        numEntries = min(size, 10 ** 5)
+        getTime, _ = timeCall(lambda: [arrayReader.get("c", i) for i in xrange(numEntries)])
+        print "%10d %10.3f %10.3f" % (size, decodeTime * 1e6 / size, getTime * 1e6 / numEntries)
+
+
+# prints the microseconds per root of collecting the types of many roots with the same, but distinct types
+def benchmarkGetAllTypes(sizes=(10 ** 2, 10 ** 3, 10 ** 4, 10 ** 5)):
+    print "getAllTypes, microseconds per root"
+    print "%10s %10s" % ("roots", "time")
+    for size in sizes:
+        roots = [values.Struct("benchmarkRoot")
+                 .addInt32("a", i)
+                 .add("b", values.Struct("benchmarkChild").addUInt8("c", i % 256).finalize())
+                 .addReference("d", values.SimpleArray(values.types.UINT16, [i % 65536]))
+                 .finalize().getType()
+                 for i in xrange(size)]
+        getAllTypesTime, _ = timeCall(namedstruct.getAllTypes, roots)
+        print "%10d %10.3f" % (size, getAllTypesTime * 1e6 / size)
+
+
+# returns the number of bytes used by the given objects and all the objects they refer to, counting shared
+# objects once. Classes, modules and functions are not counted. (tracemalloc is not available in python 2)
+def getMemorySize(*objects):
+    skippedTypes = (type, type(sys), type(getMemorySize), type(len))
+    seen = set()
+    numBytes = 0
+    stack = list(objects)
+    while stack:
+        anObject = stack.pop()
+        if id(anObject) in seen or isinstance(anObject, skippedTypes):
+            continue
+        seen.add(id(anObject))
+        numBytes += sys.getsizeof(anObject)
+        stack.extend(gc.get_referents(anObject))
+    return numBytes
+
+
+# prints the memory used per struct member, for many small structs built one by one (each with its own type),
+# and created from a schema (sharing one type)
+def benchmarkMemory(sizes=(10 ** 3, 10 ** 4, 10 ** 5)):
+    print "memory, bytes per struct member"
+    print "%10s %10s %10s %10s" % ("structs", "members", "builder", "schema")
+    schema = values.types.StructType("benchmarkRecord").int32("a").uint8("b").char("c").int16("d")
+    schema.finalize()
+    for size in sizes:
+        builtStructs = [values.Struct("benchmarkRecord")
+                        .addInt32("a", i)
+                        .addUInt8("b", i % 256)
+                        .addChar("c", "x")
+                        .addInt16("d", i % 30000)
+                        .finalize()
+                        for i in xrange(size)]
+        builtSize = getMemorySize(builtStructs)
+        del builtStructs
+        schemaSize = getMemorySize([schema.makeValue((i, i % 256, "x", i % 30000)) for i in xrange(size)])
+        numMembers = size * 4
+        print "%10d %10d %10.1f %10.1f" % (size, numMembers, float(builtSize) / numMembers,
+                                           float(schemaSize) / numMembers)
+
+
+# prints the microseconds per struct of packing an array of structs with primitive members
+def benchmarkPackStructs(sizes=(10 ** 3, 10 ** 4, 10 ** 5)):
+    print "pack structs, microseconds per struct"
+    print "%10s %10s" % ("structs", "pack")
+    schema = values.types.StructType("benchmarkRecord").int32("a").uint8("b").char("c").int16("d").uint64("e")
+    schema.finalize()
+    for size in sizes:
+        array = values.SimpleArray(schema, [schema.makeValue((i, i % 256, "x", i % 30000, i)) for i in xrange(size)])
+        packTime, _ = timeCall(packer.Packer().pack, array)
+        print "%10d %10.3f" % (size, packTime * 1e6 / size)
+
+
+# returns a linked chain of the given number of structs, each referring to the next one
+def makeChain(size):
+    chain = values.Struct("benchmarkChain").addInt32("value", 0).add("next", None)
+    for i in xrange(1, size):
+        chain = values.Struct("benchmarkChain").addInt32("value", i).add("next", chain)
+    return chain
+
+
+# prints the microseconds per node of packing, planning and estimating the size of a linked chain of structs, which is
+# as deep as it is long
+def benchmarkDeepChain(sizes=(10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6)):
+    print "deep chain, microseconds per node"
+    print "%10s %10s %10s %10s" % ("nodes", "pack", "plan", "estimate")
+    for size in sizes:
+        chain = makeChain(size)
+        packTime, _ = timeCall(namedstruct.pack, chain)
+        planTime, _ = timeCall(namedstruct.planLayout, chain)
+        estimateTime, _ = timeCall(namedstruct.estimateSize, chain)
+        print "%10d %10.3f %10.3f %10.3f" % (size, packTime * 1e6 / size, planTime * 1e6 / size,
+                                             estimateTime * 1e6 / size)
+
+
+# main.cpp of benchmarkCppBitFieldArray, it prints the nanoseconds per entry of reading all fields of each given
+# bit field array with the per element accessors, the per field decoders and the row decoder
+cppBitFieldArrayBenchmarkSource = cpphelper.loadDataSource + """
+#include <chrono>
+#include "root.h"
+
+static double elapsedNanoseconds(std::chrono::steady_clock::time_point start) {
+    return std::chrono::duration<double, std::nano>(std::chrono::steady_clock::now() - start).count();
+}
+
+int main(int argc, char** argv) {
+    for (int arg = 1; arg < argc; arg++) {
+        std::vector<uint32_t> data = loadData(argv[arg]);
+        const benchmark::benchmarkRoot* root = (const benchmark::benchmarkRoot*)(&data[0]);
+        const benchmark::BenchmarkArray* array = root->getArray();
+        const int n = root->numEntries;
+        std::vector<uint32_t> get(3 * n), fields(3 * n), rows(3 * n);
+        
+        std::chrono::steady_clock::time_point start = std::chrono::steady_clock::now();
+        for (int i = 0; i < n; i++) {
+            get[i] = array->getA(i);
+            get[n + i] = array->getB(i);
+            get[2 * n + i] = array->getC(i);
+        }
+        const double getTime = elapsedNanoseconds(start);
+        
+        start = std::chrono::steady_clock::now();
+        array->decodeA(0, n, &fields[0]);
+        array->decodeB(0, n, &fields[n]);
+        array->decodeC(0, n, &fields[2 * n]);
+        const double fieldsTime = elapsedNanoseconds(start);
+        
+        start = std::chrono::steady_clock::now();
+        array->decodeRows(0, n, &rows[0]);
+        const double rowsTime = elapsedNanoseconds(start);
+        
+        for (int i = 0; i < n; i++) {
+            for (int f = 0; f < 3; f++) {
+                if (get[f * n + i] != fields[f * n + i] || get[f * n + i] != rows[3 * i + f]) {
+                    printf("mismatch at entry %d, field %d\\n", i, f);
+                    return 1;
+                }
+            }
+        }
+        printf("%10d %10.3f %10.3f %10.3f\\n", n, getTime / n, fieldsTime / n, rowsTime / n);
+    }
+    return 0;
+}
+"""
+
+
+# prints the nanoseconds per entry of reading all fields of bit field arrays in a generated header compiled with g++,
+# with the per element accessors and the bulk decoders, after checking that they agree
+def benchmarkCppBitFieldArray(sizes=(10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6)):
+    print "c++ bitFieldArray, nanoseconds per entry"
+    print "%10s %10s %10s %10s" % ("entries", "get", "decode", "decodeRows")
+    files = {"bits.h": namedstruct.generateRuntime(), "main.cpp": cppBitFieldArrayBenchmarkSource}
+    for size in sizes:
+        array = values.BitFieldArray("BenchmarkArray", "a", "b", "c")
+        array.extend((i % 7, i % 1000, i) for i in xrange(size))
+        root = values.Struct("benchmarkRoot").addInt32("numEntries", size).add("array", array)
+        files["root.h"] = namedstruct.generateHeader(root, namespace="benchmark")
+        files["data%d" % size] = namedstruct.pack(root)
+    print cpphelper.compileAndRun(files, ["data%d" % size for size in sizes], flags=("-O3",)),
+
+
+# main.cpp of benchmarkCppReadBits, it prints the nanoseconds per value of reading random bit ranges and an array of
+# values from each given blob, with the bit by bit reference and with the runtime
+cppReadBitsBenchmarkSource = cpphelper.loadDataSource + cpphelper.referenceReadBitsSource + """
+#include <chrono>
+#include "root.h"
+
+static double elapsedNanoseconds(std::chrono::steady_clock::time_point start) {
+    return std::chrono::duration<double, std::nano>(std::chrono::steady_clock::now() - start).count();
+}
+
+int main(int argc, char** argv) {
+    const int numReads = 1 << 20;
+    for (int arg = 1; arg < argc; arg++) {
+        std::vector<uint32_t> data = loadData(argv[arg]);
+        const benchmark::readBitsRoot* root = (const benchmark::readBitsRoot*)(&data[0]);
+        const char* blob = root->getBlob();
+        const int numBits = root->numBits;
+        std::vector<int> bitOffsets(numReads), widths(numReads);
+        uint32_t state = 12345;
+        for (int i = 0; i < numReads; i++) {
+            state = state * 1664525 + 1013904223;
+            widths[i] = (state >> 16) % 33;
+            state = state * 1664525 + 1013904223;
+            bitOffsets[i] = (state >> 1) % (numBits - 32);
+        }
+        std::vector<uint32_t> reference(numReads), runtime(numReads);
+        
+        std::chrono::steady_clock::time_point start = std::chrono::steady_clock::now();
+        for (int i = 0; i < numReads; i++) reference[i] = referenceReadBits(blob, bitOffsets[i], widths[i]);
+        const double referenceTime = elapsedNanoseconds(start);
+        
+        start = std::chrono::steady_clock::now();
+        for (int i = 0; i < numReads; i++) runtime[i] = namedstruct::readBits(blob, bitOffsets[i], widths[i]);
+        const double runtimeTime = elapsedNanoseconds(start);
+        if (reference != runtime) {
+            printf("readBits mismatch\\n");
+            return 1;
+        }
+        
+        const int count = numBits / 13;
+        reference.resize(count);
+        runtime.resize(count);
+        start = std::chrono::steady_clock::now();
+        for (int i = 0; i < count; i++) reference[i] = referenceReadBits(blob, 13 * i, 13);
+        const double referenceArrayTime = elapsedNanoseconds(start);
+        
+        start = std::chrono::steady_clock::now();
+        namedstruct::readBitsArray(blob, 0, 13, count, &runtime[0]);
+        const double runtimeArrayTime = elapsedNanoseconds(start);
+        if (reference != runtime) {
+            printf("readBitsArray mismatch\\n");
+            return 1;
+        }
+        printf("%10d %10.3f %10.3f %10.3f %10.3f\\n", numBits, referenceTime / numReads, runtimeTime / numReads,
+               referenceArrayTime / count, runtimeArrayTime / count);
+    }
+    return 0;
+}
+"""
+
+
+# prints the nanoseconds per value of reading bits from blobs of growing numbers of bits in c++, with a bit by bit
+# readBits and the runtime generated by namedstruct.generateRuntime, after checking that they agree
+def benchmarkCppReadBits(sizes=(10 ** 3, 10 ** 5, 10 ** 7)):
+    import os
+    print "c++ readBits, nanoseconds per value"
+    print "%10s %10s %10s %10s %10s" % ("bits", "reference", "readBits", "reference", "readArray")
+    files = {"bits.h": namedstruct.generateRuntime(), "main.cpp": cppReadBitsBenchmarkSource}
+    for size in sizes:
+        root = values.Struct("readBitsRoot").addInt32("numBits", size * 8).addBlob("blob", os.urandom(size))
+        files["root.h"] = namedstruct.generateHeader(root, namespace="benchmark")
+        files["data%d" % size] = namedstruct.pack(root)
+    print cpphelper.compileAndRun(files, ["data%d" % size for size in sizes], flags=("-O3",)),
+
+
+def runBenchmarks():
+    benchmarkBitFieldArray()
+    benchmarkDecodeBitFieldArray()
+    benchmarkCppBitFieldArray()
+    benchmarkCppReadBits()
+    benchmarkGetAllTypes()
+    benchmarkMemory()
+    benchmarkPackStructs()
+    benchmarkDeepChain()
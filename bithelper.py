@@ -1,14 +1,18 @@
-import math
-import struct
+import array
+import binascii
+import string
 import unittest
 
+_bitDigits = string.maketrans("\x00\x01", "01")  # bit values -> binary digits
+_bitValues = string.maketrans("01", "\x00\x01")  # binary digits -> bit values
+
 
 # returns the number of bits required to store the number
 # 0 -> 0, 255 -> 8, 256 -> 9
 def requiredBits(number):
-    if number == 0:
-        return 0
-    return int(math.log(number, 2)) + 1
+    if number < 0:
+        raise Exception("received negative number " + str(number))
+    return int(number).bit_length()
 
 
 # returns a postive number as an array of bits
@@ -20,10 +24,7 @@ def toBits(number, numBits=None):
         raise Exception("received negative number " + str(number))
     if int(number) != number:
         raise Exception("received non int-number " + str(number))
-    bits = []
-    while number > 0:
-        bits.append(number & 1)
-        number >>= 1
+    bits = [(number >> i) & 1 for i in range(requiredBits(number))]
     if numBits is None:
         return bits
     if len(bits) > numBits:
@@ -39,21 +40,164 @@ def packBitsToChars(bits):
             if ord(c) < 0 or ord(c) > 255:
                 raise Exception("blob strings myst be made of 8-bit chars, but found " + repr(c))
         return bits
-    c = 0
-    numBits = 0
-    result = []
-    for b in bits:
-        if not (b == 0 or b == 1):
-            raise Exception("blobs can only be made from sequences of 0,1 values")
-        if numBits == 8:
-            result.append(c)
-            c = 0
-            numBits = 0
-        c += b << numBits
-        numBits += 1
-    if numBits > 0:
-        result.append(c)
-    return struct.pack("<" + str(len(result)) + "B", *result)
+    return intToBytes(bitsToInt(bits), (len(bits) + 7) / 8)
+
+
+# returns the bits of a byte string (or any bytes-like object) as an array of 0/1 values, little endian,
+# i.e. the inverse of packBitsToChars
+def unpackCharsToBits(chars):
+    numBits = len(chars) * 8
+    if numBits == 0:
+        return array.array('B')
+    digits = bin(bytesToInt(chars))[2:].zfill(numBits)
+    return array.array('B', digits[::-1].translate(_bitValues))
+
+
+# returns a sequence of 0/1 values as an integer, the first bit is the lowest bit
+def bitsToInt(bits):
+    try:
+        data = array.array('B', bits).tostring()
+    except (OverflowError, TypeError):
+        data = None
+    if data is None or len(data.translate(None, "\x00\x01")) > 0:
+        raise Exception("blobs can only be made from sequences of 0,1 values")
+    if len(data) == 0:
+        return 0
+    return int(data[::-1].translate(_bitDigits), 2)
+
+
+# returns a string (or any bytes-like object) as an integer, little endian
+def bytesToInt(data):
+    if not isinstance(data, str):
+        data = str(bytearray(data))
+    if len(data) == 0:
+        return 0
+    return int(binascii.hexlify(data[::-1]), 16)
+
+
+# returns the unsigned number as a string of numBytes bytes, little endian
+def intToBytes(number, numBytes):
+    if numBytes == 0:
+        return ""
+    return binascii.unhexlify("%0*x" % (numBytes * 2, number))[::-1]
+
+
+# writes unsigned integers with a given number of bits into a byte buffer, little endian, i.e. the first bit is
+# stored in the lowest bit of the first byte. The bits are collected in an integer using shifts, and written to
+# the buffer as whole bytes once there are more than blockSize bits.
+class BitWriter(object):
+    blockSize = 4096
+    
+    def __init__(self):
+        self.data = bytearray()
+        self.bits = 0  # the bits that are not written to the data yet
+        self.numBits = 0  # the number of bits in self.bits
+    
+    # appends value using numBits bits, value has to be an unsigned integer smaller than 2^numBits
+    def write(self, value, numBits):
+        if value >> numBits:
+            raise Exception("number %d doesn't fit in %d bits" % (value, numBits))
+        self.bits |= value << self.numBits
+        self.numBits += numBits
+        if self.numBits >= BitWriter.blockSize:
+            numBytes = self.numBits >> 3
+            self.data += intToBytes(self.bits & ((1 << (numBytes * 8)) - 1), numBytes)
+            self.bits >>= numBytes * 8
+            self.numBits -= numBytes * 8
+    
+    # returns the number of written bits
+    def getNumBits(self):
+        return len(self.data) * 8 + self.numBits
+    
+    # returns the written bits as a string, the last byte is filled up with 0 bits
+    def getData(self):
+        return str(self.data) + intToBytes(self.bits, (self.numBits + 7) / 8)
+
+
+# reads unsigned integers with a given number of bits from a string, that was written by a BitWriter
+class BitReader(object):
+    def __init__(self, data, position=0):
+        self.data = data
+        self.position = position  # the current bit position
+    
+    def read(self, numBits):
+        start = self.position >> 3
+        end = (self.position + numBits + 7) >> 3
+        if end > len(self.data):
+            raise Exception("cannot read %d bits at bit position %d, the data only has %d bytes"
+                            % (numBits, self.position, len(self.data)))
+        value = bytesToInt(self.data[start:end]) >> (self.position & 7)
+        self.position += numBits
+        return value & ((1 << numBits) - 1)
+
+
+# packs rows of unsigned integers, given as columns (e.g. numpy arrays), into a little endian bit string. Every row
+# stores the value of column i with bitWidths[i] bits. The result is the same as calling packBitsToChars on the
+# concatenated toBits(value, bitWidth) of all rows, but the bits are combined with numpy word operations.
+# All values have to fit in 32 bits. Requires numpy.
+def packBitColumns(columns, bitWidths):
+    import numpy  # numpy is optional, it's only required for columns
+    numRows = len(columns[0]) if len(columns) > 0 else 0
+    numBits = numRows * sum(bitWidths)
+    if numBits == 0:
+        return ""
+    words = numpy.zeros((numBits + 63) / 64 + 1, dtype=numpy.uint64)  # one extra word for the last high part
+    rowStarts = numpy.arange(numRows, dtype=numpy.uint64) * numpy.uint64(sum(bitWidths))
+    fieldOffset = 0
+    for column, bitWidth in zip(columns, bitWidths):
+        if bitWidth > 0:
+            values = numpy.asarray(column).astype(numpy.uint64)
+            positions = rowStarts + numpy.uint64(fieldOffset)
+            wordIndices = (positions >> numpy.uint64(6)).astype(numpy.intp)
+            shifts = positions & numpy.uint64(63)
+            # the low part goes into the word containing the first bit, the high part into the next word
+            _orWords(words, wordIndices, values << shifts)
+            _orWords(words, wordIndices + 1, (values >> numpy.uint64(1)) >> (numpy.uint64(63) - shifts))
+        fieldOffset += bitWidth
+    return words.astype("<u8").tostring()[:(numBits + 7) / 8]
+
+
+# unpacks rows of unsigned integers from a little endian bit string, the inverse of packBitColumns. The value of
+# column i of row r is stored with bitWidths[i] bits at the bit position bitOffsets[i] + r * rowBits of the data,
+# which may be any buffer. Returns a uint64 numpy array for every column, with the values of the rows begin..end
+# (excl.). The values of all rows are extracted at once, from the two 64 bit words that contain them, so bit widths
+# can be at most 64. Only the bytes of the rows are read. Requires numpy.
+def unpackBitColumns(data, bitOffsets, bitWidths, rowBits, begin, end):
+    import numpy  # numpy is optional, it's only required for columns
+    numRows = max(0, end - begin)
+    if numRows == 0 or sum(bitWidths) == 0:
+        return [numpy.zeros(numRows, dtype=numpy.uint64) for _ in bitWidths]
+    if max(bitWidths) > 64:
+        raise Exception("cannot unpack columns with more than 64 bits, received bit widths %s" % list(bitWidths))
+    startByte = ((begin * rowBits + min(bitOffsets)) >> 6) << 3  # aligned to words
+    endByte = ((end - 1) * rowBits + max(o + w for o, w in zip(bitOffsets, bitWidths)) + 7) >> 3
+    words = numpy.zeros((endByte - startByte + 7) / 8 + 1, dtype="<u8")  # one extra word for the last high part
+    words.view(numpy.uint8)[:endByte - startByte] = numpy.frombuffer(data, numpy.uint8, endByte - startByte,
+                                                                     startByte)
+    words = words.astype(numpy.uint64)
+    rowStarts = numpy.arange(begin, end, dtype=numpy.uint64) * numpy.uint64(rowBits) - numpy.uint64(startByte * 8)
+    columns = []
+    for bitOffset, bitWidth in zip(bitOffsets, bitWidths):
+        if bitWidth == 0:
+            columns.append(numpy.zeros(numRows, dtype=numpy.uint64))
+            continue
+        positions = rowStarts + numpy.uint64(bitOffset)
+        wordIndices = (positions >> numpy.uint64(6)).astype(numpy.intp)
+        shifts = positions & numpy.uint64(63)
+        # the low part comes from the word containing the first bit, the high part from the next word
+        values = (words[wordIndices] >> shifts) | ((words[wordIndices + 1] << numpy.uint64(1))
+                                                   << (numpy.uint64(63) - shifts))
+        columns.append(values & numpy.uint64((1 << bitWidth) - 1))
+    return columns
+
+
+# ors the values into words[indices], where the indices are sorted, but may contain duplicates
+def _orWords(words, indices, values):
+    import numpy
+    isStart = numpy.ones(len(indices), dtype=bool)
+    isStart[1:] = indices[1:] != indices[:-1]
+    starts = numpy.flatnonzero(isStart)
+    words[indices[starts]] |= numpy.bitwise_or.reduceat(values, starts)
 
 
 def zigZagEncode(v):
@@ -70,6 +214,24 @@ def zigZagDecode(v):
         return v >> 1
 
 
+# zig zag encodes all values of a sequence, returns a list, or an uint64 array for numpy arrays
+def zigZagEncodeArray(values):
+    if hasattr(values, "dtype"):  # a numpy array
+        import numpy
+        values = values.astype(numpy.int64)
+        return ((values << 1) ^ (values >> 63)).astype(numpy.uint64)
+    return [zigZagEncode(v) for v in values]
+
+
+# zig zag decodes all values of a sequence, returns a list, or an int64 array for numpy arrays
+def zigZagDecodeArray(values):
+    if hasattr(values, "dtype"):  # a numpy array
+        import numpy
+        values = values.astype(numpy.uint64)
+        return (values >> numpy.uint64(1)).astype(numpy.int64) ^ -(values & numpy.uint64(1)).astype(numpy.int64)
+    return [zigZagDecode(v) for v in values]
+
+
 class TestBitHelper(unittest.TestCase):
     def testZigZag(self):
         values = [
@@ -88,6 +250,81 @@ class TestBitHelper(unittest.TestCase):
         for shift in range(40):
             for v in [1 << shift, (1 << shift) - 1, - (1 << shift), -((1 << shift) - 1)]:
                 self.assertEqual(zigZagDecode(zigZagEncode(v)), v)
+    
+    def testUnpackCharsToBits(self):
+        bits = [0, 1, 0, 0, 1, 0, 0, 1, 1, 1, 1, 1, 1, 1, 1, 1]
+        self.assertEqual(list(unpackCharsToBits(packBitsToChars(bits))), bits)
+        self.assertEqual(list(unpackCharsToBits(bytearray("\x92"))), bits[:8])
+    
+    def testPackBitColumns(self):
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest("numpy is not installed")
+        bitWidths = [3, 0, 31, 17, 1]
+        columns = [numpy.random.randint(0, 2 ** w if w > 0 else 1, size=100) for w in bitWidths]
+        bits = []
+        for row in range(100):
+            for column, w in zip(columns, bitWidths):
+                bits.extend(toBits(int(column[row]), w))
+        self.assertEqual(packBitColumns(columns, bitWidths), packBitsToChars(bits))
+        self.assertEqual(packBitColumns([], []), "")
+    
+    def testUnpackBitColumns(self):
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest("numpy is not installed")
+        bitWidths = [3, 0, 31, 17, 1, 64]
+        bitOffsets = [sum(bitWidths[:i]) for i in range(len(bitWidths))]
+        columns = [numpy.random.randint(0, 2 ** min(w, 62) if w > 0 else 1, size=100) for w in bitWidths]
+        columns[-1][0] = 2 ** 62 + 2 ** 61
+        data = packBitColumns(columns, bitWidths)
+        for begin, end in [(0, 100), (0, 1), (37, 64), (99, 100), (50, 50)]:
+            unpacked = unpackBitColumns(data, bitOffsets, bitWidths, sum(bitWidths), begin, end)
+            for column, unpackedColumn in zip(columns, unpacked):
+                self.assertEqual(list(unpackedColumn), list(column[begin:end]))
+        # the columns may start at an offset, and rows may have unused bits
+        data = "\xff" + packBitColumns(columns[:3] + [numpy.zeros(100, dtype=int)], [3, 0, 31, 6])
+        unpacked = unpackBitColumns(data, [8, 11, 11], [3, 0, 31], 40, 10, 90)
+        self.assertEqual([list(column) for column in unpacked], [list(column[10:90]) for column in columns[:3]])
+    
+    def testRequiredBits(self):
+        self.assertEqual([requiredBits(v) for v in [0, 1, 255, 256, 2 ** 31 - 1, 2 ** 48, 2 ** 48 - 1]],
+                         [0, 1, 8, 9, 31, 49, 48])
+    
+    def testBitsToChars(self):
+        bits = [1, 0, 1, 1, 0, 0, 0, 0, 1, 1]
+        self.assertEqual(packBitsToChars(bits), "\x0d\x03")
+        self.assertEqual(list(unpackCharsToBits("\x0d\x03")), bits + [0] * 6)
+        self.assertEqual(packBitsToChars([]), "")
+        self.assertRaises(Exception, packBitsToChars, [0, 2])
+        self.assertRaises(Exception, packBitsToChars, [-1])
+    
+    def testBitWriterAndReader(self):
+        values = [(i * 7919 % (1 << (i % 33)), i % 33) for i in range(2000)]
+        writer = BitWriter()
+        bits = []
+        for value, numBits in values:
+            writer.write(value, numBits)
+            bits.extend(toBits(value, numBits))
+        self.assertEqual(writer.getNumBits(), len(bits))
+        self.assertEqual(writer.getData(), packBitsToChars(bits))
+        reader = BitReader(writer.getData())
+        self.assertEqual([reader.read(numBits) for value, numBits in values], [value for value, numBits in values])
+        self.assertRaises(Exception, writer.write, 4, 2)
+    
+    def testZigZagArray(self):
+        values = [0, -1, 1, -2, 2, 2147483647, -2147483648]
+        self.assertEqual(zigZagEncodeArray(values), [zigZagEncode(v) for v in values])
+        self.assertEqual(zigZagDecodeArray(zigZagEncodeArray(values)), values)
+        try:
+            import numpy
+        except ImportError:
+            return
+        encoded = zigZagEncodeArray(numpy.array(values))
+        self.assertEqual(list(encoded), [zigZagEncode(v) for v in values])
+        self.assertEqual(list(zigZagDecodeArray(encoded)), values)
 
 
 def runTests():
@@ -4,6 +4,8 @@ import re
 
 # an object that has the add constant functions - they all get dispatched to "addConstant"
 class AddConstantFunctions(object):
+    __slots__ = ()
+    
     def addConstant(self, name, value):  # should return self
         raise Exception("not implemented")
     
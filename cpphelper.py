@@ -0,0 +1,83 @@
+import distutils.spawn
+import os
+import shutil
+import subprocess
+import tempfile
+
+
+# Helpers to compile and run generated headers with a local C++ compiler, used by the tests and benchmarks.
+
+
+# defines referenceReadBits, which reads the bits one by one, like the copies of bits.h consumers used to carry,
+# as a baseline for the runtime generated by namedstruct.generateRuntime
+referenceReadBitsSource = """
+#include <stdint.h>
+
+static uint32_t referenceReadBits(const void* data, int bitOffset, int numBits) {
+    const uint8_t* bytes = (const uint8_t*)data;
+    uint32_t result = 0;
+    for (int i = 0; i < numBits; i++) {
+        const int bit = bitOffset + i;
+        result |= ((uint32_t)((bytes[bit >> 3] >> (bit & 7)) & 1)) << i;
+    }
+    return result;
+}
+"""
+
+# defines loadData(filename), which returns the contents of a file as 4 byte aligned words
+loadDataSource = """
+#include <stdint.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <vector>
+
+static std::vector<uint32_t> loadData(const char* filename) {
+    FILE* file = fopen(filename, "rb");
+    if (file == NULL) { fprintf(stderr, "cannot open %s\\n", filename); exit(1); }
+    fseek(file, 0, SEEK_END);
+    const long size = ftell(file);
+    fseek(file, 0, SEEK_SET);
+    std::vector<uint32_t> words((size + 3) / 4, 0);
+    if (fread(&words[0], 1, size, file) != (size_t)size) { fprintf(stderr, "cannot read %s\\n", filename); exit(1); }
+    fclose(file);
+    return words;
+}
+"""
+
+
+# returns whether the given C++ compiler is available
+def hasCompiler(compiler="g++"):
+    return distutils.spawn.find_executable(compiler) is not None
+
+
+# returns whether the given C++ compiler accepts the flags, e.g. to check if sanitizers are available
+def supportsFlags(flags, compiler="g++"):
+    try:
+        compileAndRun({"main.cpp": "int main() { return 0; }\n"}, flags=flags, compiler=compiler)
+    except Exception:
+        return False
+    return True
+
+
+# writes the files, given as a dict of filename -> contents, into a temporary directory, compiles the file main.cpp,
+# and runs it with the given arguments from the temporary directory. Returns the output of the program. Raises an
+# exception with the compiler or program output if compiling or running fails.
+def compileAndRun(files, arguments=(), flags=("-O2",), compiler="g++"):
+    directory = tempfile.mkdtemp()
+    try:
+        for filename, contents in files.items():
+            with open(os.path.join(directory, filename), "wb") as f:
+                f.write(contents)
+        command = [compiler] + list(flags) + ["-o", "main", "main.cpp"]
+        process = subprocess.Popen(command, cwd=directory, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = process.communicate()[0]
+        if process.returncode != 0:
+            raise Exception("compiling failed:\n%s" % output)
+        process = subprocess.Popen([os.path.join(directory, "main")] + list(arguments), cwd=directory,
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = process.communicate()[0]
+        if process.returncode != 0:
+            raise Exception("running failed:\n%s" % output)
+        return output
+    finally:
+        shutil.rmtree(directory)
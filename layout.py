@@ -0,0 +1,241 @@
+import collections
+
+import packer
+import types
+
+
+# A layout plan stores where every value of a value tree ends up when the tree gets packed, without packing it.
+# It is built by walking the tree once with a LayoutPacker, and can then be reused to pack the tree
+# (see namedstruct.iterPack), to print sizes or to estimate the size of the packed data.
+#
+# For every value, the plan stores an entry of
+#   offset:        the position of the immediate data of the value
+#   immediateSize: the size of the immediate data of the value
+#   referredSize:  the size of all data referred to by the value, including padding
+#   padding:       the number of padding bytes added before the referred data (for references)
+# Values that are stored multiple times in the tree (e.g. padding bytes) get the offset of their last occurrence.
+class LayoutPlan(object):
+    Entry = collections.namedtuple("Entry", ["offset", "immediateSize", "referredSize", "padding"])
+    
+    def __init__(self, root):
+        self.root = root
+        self.entries = {}  # id(value) -> [offset, immediate size, referred size, padding]
+        self.referenceOffsets = {}  # id(reference) -> byte offset stored in the reference, for non-null references
+        LayoutPacker(self).pack(root)
+    
+    def getEntry(self, value):
+        return LayoutPlan.Entry(*self.entries[id(value)])
+    
+    def getOffset(self, value):
+        return self.entries[id(value)][0]
+    
+    def getImmediateDataSize(self, value):
+        return self.entries[id(value)][1]
+    
+    def getReferredDataSize(self, value):
+        return self.entries[id(value)][2]
+    
+    # returns the byte offset that gets stored in the reference, 0 for null references
+    def getReferenceOffset(self, reference):
+        return self.referenceOffsets.get(id(reference), 0)
+    
+    # returns the size of the value and all the data it refers to. For a reference target, this is the size of
+    # the value when packed as a top level value.
+    def getPackedSize(self, value):
+        entry = self.entries[id(value)]
+        return entry[1] + entry[2]
+    
+    # returns the size of the packed root value, excluding the padding added by namedstruct.pack
+    def getTotalSize(self):
+        return self.getPackedSize(self.root)
+
+
+# a packer that doesn't store any data, but records the layout of every packed value in a plan
+class LayoutPacker(packer.Packer):
+    recordsMembers = True  # the plan stores all values
+    
+    def __init__(self, plan):
+        packer.Packer.__init__(self)
+        self.plan = plan
+        self.position = 0
+    
+    def getPosition(self):
+        return self.position
+    
+    def append(self, data):
+        self.position += len(data)
+    
+    def appendZeros(self, numBytes):
+        self.position += numBytes
+    
+    def writeAt(self, position, data):
+        pass
+    
+    def packImmediate(self, value, base):
+        offset = self.position
+        value.packImmediate(self, base)
+        self.plan.entries[id(value)] = [offset, self.position - offset, 0, 0]
+    
+    def packTarget(self, value):
+        if value is not self.plan.root:
+            packer.Packer.packTarget(self, value)
+            return
+        # never use the cache of the root, so that its members are part of the plan
+        self.packImmediate(value, 0)
+        self.schedule(value, 0, 0)
+    
+    def packCached(self, value, cache):
+        self.plan.entries[id(value)] = [self.position, cache.immediateSize, len(cache.data) - cache.immediateSize, 0]
+        self.position += len(cache.data)
+    
+    def storeCache(self, value, position, immediateSize):
+        pass  # there is no data to store
+    
+    def schedule(self, value, position, base):
+        packer.Packer.schedule(self, _MeasureReferred(value), position, base)
+    
+    def packReferenceTarget(self, reference, position, base):
+        if reference.targetValue.isNull():
+            return
+        padding = (base - self.position) % reference.type.targetType.getAlignment()
+        self.plan.entries[id(reference)][3] = padding
+        self.plan.referenceOffsets[id(reference)] = self.position + padding - base
+        self.position += padding
+        self.packTarget(reference.targetValue)  # the offset may not fit the reference yet, so don't store it
+    
+    def getData(self):
+        raise Exception("layout packer doesn't store any data")
+
+
+# wraps a value in the pending stack of a LayoutPacker, measuring the size of the referred data of the value
+class _MeasureReferred(object):
+    def __init__(self, value):
+        self.value = value
+    
+    def packReferred(self, packer, position, base):
+        packer.pending.append((_ReferredEnd(self.value, packer.getPosition()), position, base))
+        self.value.packReferred(packer, position, base)
+
+
+# marks the end of the referred data of a value in the pending stack of a LayoutPacker
+class _ReferredEnd(object):
+    def __init__(self, value, start):
+        self.value = value
+        self.start = start
+    
+    def packReferred(self, packer, position, base):
+        packer.plan.entries[id(self.value)][2] = packer.getPosition() - self.start
+
+
+# selects the smallest bit width for all the references with bit width types.AUTO contained in root.
+# References stored in the same kind of slot use the same bit width, so that types with the same name stay
+# consistent. A slot is identified by the struct name and member name, followed by the path through reference
+# targets ("->") and array elements ("[]"). Starting with 8 bit references, the layout gets planned, and every
+# slot whose offsets don't fit gets widened, until all offsets fit.
+# Only the values whose type contains AUTO references (see types.Type.containsAuto) are visited, i.e. the values on
+# the paths from the slots to the root. Only their packed data changes, so only their caches are cleared.
+def resolveReferenceBitWidths(root):
+    import values  # to avoid circular dependencies
+    
+    # collect the slots
+    slots = collections.OrderedDict()  # slot -> list of references or reference arrays
+    structs = []
+    autoValues = []
+    stack = [(root, ())]
+    while stack:
+        value, path = stack.pop()
+        if not value.type.containsAuto:
+            continue
+        autoValues.append(value)
+        if isinstance(value, values.Struct):
+            structs.append(value)
+            for i, member in enumerate(value.values):
+                if isinstance(member, values.Value):  # primitive members are python values
+                    stack.append((member, (value.type.name, value.type.names[i])))
+            continue
+        if isinstance(value, values.Reference):
+            if value.type.auto:
+                slots.setdefault(path, []).append(value)
+            stack.append((value.targetValue, path + ("->",)))
+            continue
+        if isinstance(value, values.ReferenceArray) and value.type.elementType.auto:
+            slots.setdefault(path + ("[]",), []).append(value)
+        stack.extend((element, path + ("[]",)) for element in value.getContainedValues())
+    if len(slots) == 0:
+        return
+    for value in autoValues:  # the packed data will change
+        if value.packCache is not None:
+            value.packCache.clear()
+    
+    # widen slots until everything fits
+    bitWidths = dict.fromkeys(slots, 8)
+    slotValueIds = set(id(value) for slotValues in slots.values() for value in slotValues)
+    changed = True
+    while changed:
+        for slot, slotValues in slots.items():
+            for value in slotValues:
+                value.setReferenceBitWidth(bitWidths[slot])
+        # relayout the structs whose immediate data changed, nested structs come after their parents
+        changedIds = set(slotValueIds)
+        for struct in reversed(structs):
+            if _containsImmediate(struct, changedIds):
+                struct.relayout()
+                changedIds.add(id(struct))
+        plan = LayoutPlan(root)
+        changed = False
+        for slot, slotValues in slots.items():
+            maxOffset = max(plan.getReferenceOffset(value) for value in slotValues
+                            if isinstance(value, values.Reference))
+            while (bitWidths[slot] < 32
+                   and maxOffset > types.ReferenceType.getMaxOffsetForBitWidth(bitWidths[slot])):
+                bitWidths[slot] *= 2
+                changed = True
+
+
+# returns whether the immediate data of the struct contains one of the values with the given ids
+def _containsImmediate(struct, valueIds):
+    import values  # to avoid circular dependencies
+    stack = struct.getContainedValues()
+    while stack:
+        value = stack.pop()
+        if id(value) in valueIds:
+            return True
+        if not isinstance(value, (values.Struct, values.Reference)):
+            stack.extend(value.getContainedValues())
+    return False
+
+
+# reorders the members of all structs contained in root to minimize the number of padding bytes (see
+# values.Struct.minimizePadding). keepOrders may be a dictionary struct name -> list of member names, e.g. the
+# members of a published earlier version of the struct, which will stay at the start of the struct, in their order.
+# returns an ordered dictionary struct name -> the largest number of padding bytes removed from a struct of that name
+def minimizePadding(root, keepOrders=None):
+    import values  # to avoid circular dependencies
+    if keepOrders is None:
+        keepOrders = {}
+    
+    # collect the structs, parents before the structs they contain
+    allValues = []
+    structs = []
+    stack = [root]
+    while stack:
+        value = stack.pop()
+        allValues.append(value)
+        if isinstance(value, values.Struct):
+            structs.append(value)
+        stack.extend(value.getContainedValues())
+    
+    # check all structs before changing any of them, so that an error doesn't leave the tree partially reordered
+    for struct in structs:
+        struct.assertCanRelayout(keepOrders.get(struct.type.name, ()))
+    for value in allValues:
+        if value.packCache is not None:  # the packed data will change
+            value.packCache.clear()
+    
+    # reorder contained structs first, their width may change
+    savedBytes = collections.OrderedDict()
+    for struct in reversed(structs):
+        name = struct.type.name
+        numBytes = struct.minimizePadding(keepOrders.get(name, ()))
+        savedBytes[name] = max(savedBytes.get(name, 0), numBytes)
+    return savedBytes
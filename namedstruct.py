@@ -1,5 +1,7 @@
 import collections
 
+import layout
+import packer
 import stringhelper
 import types
 import values
@@ -37,6 +39,7 @@ import types
 #
 #   # get data dump
 #   data = namedstruct.pack(s) # returns a binary string, that can be written via open(..,"wb").write(..)
+#   namedstruct.packToFile(s, open(..,"wb")) # writes the same data, without keeping it in memory
 
 
 # this offset has to follow the required alignment
@@ -61,7 +64,7 @@ import types
 #   - when using a null reference, the type doesn't appear to get included in the result
 #
 # TODO:
-#   - create methods like addUint32Array(numbers, referenceBitWidth=32)
+#   + create methods like addUint32Array(numbers, referenceBitWidth=32)
 #   - create a struct array with fixed structs, but an element size so that the structs are expandable (maybe also number of elements?)
 #   - PEP8
 #   - remove the 'add' methods, maybe just do 
@@ -115,7 +118,7 @@ import types
 #
 #
 # pack() -> simple, tree traversal creation of data
-# packOptimized() -> will attempt to minimize the padding bytes used, or store data in padding?
+# packOptimized() -> stores small referred data in alignment gaps between referred data, see packer.OptimizingPacker
 #
 #
 #
@@ -206,6 +209,7 @@ def generateHeader(valuesOrEnumTypes, constantPools=None, namespace=None, define
         if isinstance(s, types.EnumType):
             allTypes.append(s)
         elif isinstance(s, (values.Struct, values.BitField, values.EnumValue)):
+            _resolveReferenceBitWidths(s)
             allTypes.append(s.type)
         else:
             raise Exception("cannot generated header for value: %s" % s)
@@ -219,8 +223,11 @@ def generateHeader(valuesOrEnumTypes, constantPools=None, namespace=None, define
 #define {define}
 #include <stdint.h>
 #include "bits.h"
+#if !defined(NAMEDSTRUCT_BITS_VERSION) || NAMEDSTRUCT_BITS_VERSION < {runtimeVersion}
+#error "bits.h is missing a version or is older than this header, generate it with namedstruct.generateRuntime()"
+#endif
 
-{namespaceString}""".format(define=define, namespaceString=namespaceString)
+{namespaceString}""".format(define=define, namespaceString=namespaceString, runtimeVersion=runtimeVersion)
     currentIndent = "" if namespace is None else indent
     
     # put constants
@@ -276,38 +283,320 @@ def generateHeader(valuesOrEnumTypes, constantPools=None, namespace=None, define
     return result
 
 
+# the version of the runtime, see generateRuntime. Generated headers refuse older or unversioned runtimes.
+runtimeVersion = 2
+
+
+# returns the text of the c++ runtime file bits.h, which is included by all generated headers. It defines
+# namedstruct::readBits, used by the accessors of bit field arrays, and namedstruct::readBitRows, the decoder of
+# ranges of bit data used by the bulk decoders of bit field arrays and the bulk variants for bit data and blobs.
+# headText can be used to add license/author etc.
+def generateRuntime(headText=""):
+    return headText + """
+// Code generated by namedstruct.py
+
+#ifndef __NAMEDSTRUCT_BITS__
+#define __NAMEDSTRUCT_BITS__
+#define NAMEDSTRUCT_BITS_VERSION {version}
+#include <stdint.h>
+#include <string.h>
+
+namespace namedstruct {{
+    /** returns the 8 bytes at data as a little endian value, data doesn't have to be aligned */
+    inline uint64_t loadLittleEndian64(const void* data) {{
+        uint64_t result;
+        memcpy(&result, data, 8);
+#if defined(__BYTE_ORDER__) && __BYTE_ORDER__ == __ORDER_BIG_ENDIAN__
+        result = __builtin_bswap64(result);
+#endif
+        return result;
+    }}
+    
+    /** returns the numBits <= 32 bits at the given bit offset of the little endian bit data. Uses a single
+        64 bit load of the two 32 bit words ending with the word that holds the last bit, so it never reads past
+        that word, which stays within the padding added by namedstruct.pack. If the bits are within the first
+        word of data, the 4 bytes before data are read, which for bit data in packed files always exist: bit field
+        arrays start with their header, and blobs are referred to from before them. */
+    inline uint32_t readBits(const void* data, int bitOffset, int numBits) {{
+        const int lastBit = bitOffset + numBits - (numBits > 0);
+        const int wordOffset = (lastBit >> 5) - 1;
+        const uint64_t window = loadLittleEndian64((const uint8_t*)data + 4*wordOffset);
+        return (uint32_t)((window >> (bitOffset - 32*wordOffset)) & ((((uint64_t)1) << numBits) - 1));
+    }}
+    
+    /** returns the numBits <= 64 bits at the given bit offset of the little endian bit data, see readBits */
+    inline uint64_t readBits64(const void* data, int bitOffset, int numBits) {{
+        if (numBits <= 32) return readBits(data, bitOffset, numBits);
+        return readBits(data, bitOffset, 32) | (((uint64_t)readBits(data, bitOffset + 32, numBits - 32)) << 32);
+    }}
+    
+    /** reads consecutive bit fields of up to 57 bits from little endian bit data, front to back. It keeps a 64 bit
+        window of the data, which is only reloaded with a single unaligned 64 bit load when the next field isn't in
+        it. A reload starts at the byte of the read position, so the window holds at least 57 bits of the field and
+        the following ones, but it never reads past the 32 bit word that holds lastBit, like readBits. */
+    class BitReader {{
+    public:
+        BitReader(const void* data, int bitOffset, int lastBit)
+            : data((const uint8_t*)data), position(bitOffset), lastLoad(4*((lastBit >> 5) - 1)), windowOffset(0),
+              windowEnd(0), window(0) {{}}
+        
+        /** returns the next numBits <= 57 bits, and moves the read position past them */
+        inline uint64_t read(int numBits) {{
+            if (position + numBits > windowEnd) reload();
+            const uint64_t result = (window >> ((position - windowOffset) & 63)) & ((((uint64_t)1) << numBits) - 1);
+            position += numBits;
+            return result;
+        }}
+        
+        /** moves the read position numBits bits forward */
+        inline void skip(int numBits) {{
+            position += numBits;
+        }}
+        
+    private:
+        inline void reload() {{
+            const int byteOffset = (position >> 3) < lastLoad ? (position >> 3) : lastLoad;
+            window = loadLittleEndian64(data + byteOffset);
+            windowOffset = 8*byteOffset;
+            windowEnd = windowOffset + 64;
+        }}
+        
+        const uint8_t* data;
+        int position;
+        const int lastLoad;  // the byte offset of the last 8 bytes that may be loaded
+        int windowOffset;  // the bit offset of the first bit of the window
+        int windowEnd;
+        uint64_t window;
+    }};
+    
+    /** decodes count rows of bit data into out, row by row, the first row at bitOffset, the others rowBits bits
+        apart. The numFields fields of a row are stored one after the other, field f has the bits from
+        fieldBitOffsets[f] to fieldBitOffsets[f+1] (excl.), relative to fieldBitOffsets[0] at the start of the row.
+        E.g. the rows of a bit field array, or a single field of its entries. Fields of up to 57 bits are read with
+        a BitReader, wider fields value by value with readBits64. This is the decoder all bulk reads use. */
+    template <typename T>
+    inline void readBitRows(const void* data, int bitOffset, int rowBits, const uint16_t* fieldBitOffsets,
+                            int numFields, int count, T* out) {{
+        const int usedRowBits = fieldBitOffsets[numFields] - fieldBitOffsets[0];
+        int maxFieldBits = 0;
+        for (int f = 0; f < numFields; f++) {{
+            const int fieldBits = fieldBitOffsets[f+1] - fieldBitOffsets[f];
+            maxFieldBits = fieldBits > maxFieldBits ? fieldBits : maxFieldBits;
+        }}
+        if (count <= 0 || usedRowBits == 0) {{
+            for (int i = 0; i < count*numFields; i++) out[i] = 0;
+            return;
+        }}
+        if (maxFieldBits > 57) {{
+            for (int i = 0; i < count; i++, bitOffset += rowBits) {{
+                for (int f = 0; f < numFields; f++) {{
+                    *out++ = (T)readBits64(data, bitOffset + fieldBitOffsets[f] - fieldBitOffsets[0],
+                                           fieldBitOffsets[f+1] - fieldBitOffsets[f]);
+                }}
+            }}
+            return;
+        }}
+        BitReader reader(data, bitOffset, bitOffset + (count - 1)*rowBits + usedRowBits - 1);
+        if (numFields == 1) {{  // a single field, e.g. a column of a bit field array, without the loop over the fields
+            for (int i = 0; i < count; i++) {{
+                out[i] = (T)reader.read(usedRowBits);
+                reader.skip(rowBits - usedRowBits);
+            }}
+            return;
+        }}
+        for (int i = 0; i < count; i++) {{
+            for (int f = 0; f < numFields; f++) {{
+                *out++ = (T)reader.read(fieldBitOffsets[f+1] - fieldBitOffsets[f]);
+            }}
+            reader.skip(rowBits - usedRowBits);
+        }}
+    }}
+    
+    /** reads count values of numBits <= 64 bits into out, the first one at bitOffset, the others bitStride bits apart,
+        e.g. one field of a range of bit field array entries */
+    template <typename T>
+    inline void readBitsStrided(const void* data, int bitOffset, int numBits, int bitStride, int count, T* out) {{
+        const uint16_t fieldBitOffsets[2] = {{0, (uint16_t)numBits}};
+        readBitRows(data, bitOffset, bitStride, fieldBitOffsets, 1, count, out);
+    }}
+    
+    /** reads count consecutive values of numBits <= 64 bits into out, starting at bitOffset */
+    template <typename T>
+    inline void readBitsArray(const void* data, int bitOffset, int numBits, int count, T* out) {{
+        readBitsStrided(data, bitOffset, numBits, numBits, count, out);
+    }}
+    
+    /** writes the numBits bits at bitOffset into out as one 0/1 byte per bit, e.g. to unpack a blob */
+    inline void unpackBits(const void* data, int bitOffset, int numBits, uint8_t* out) {{
+        if (numBits <= 0) return;
+        BitReader reader(data, bitOffset, bitOffset + numBits - 1);
+        for (int i = 0; i < numBits; i += 57) {{
+            const int chunkBits = numBits - i < 57 ? numBits - i : 57;
+            const uint64_t bits = reader.read(chunkBits);
+            for (int j = 0; j < chunkBits; j++) {{
+                out[i + j] = (bits >> j) & 1;
+            }}
+        }}
+    }}
+}}
+
+#endif /* defined(__NAMEDSTRUCT_BITS__) */
+""".format(version=runtimeVersion)
+
+
 # pad will pad the given dat string value to 4-byte sizes -- except if it it's already 4-byte aligned, it will add
 # an extra 4-byte value if padExtra is True. This is necessary because of how the readBits function in C++
 # will interact with blob or bitfield-array data at the end of files. Padding can be disabled if the last
 # element in the resulting structure is known to not be some bit-data value.
 def pad(data, padExtra=True, paddingAlignment=4):
-    numPaddingBytes = paddingAlignment - (len(data) % paddingAlignment)
+    data += '\0' * getNumPaddingBytes(len(data), padExtra, paddingAlignment)
+    return data
+
+
+# returns the number of bytes 'pad' will add to data of the given length
+def getNumPaddingBytes(length, padExtra=True, paddingAlignment=4):
+    numPaddingBytes = paddingAlignment - (length % paddingAlignment)
     if not padExtra and numPaddingBytes == paddingAlignment:
         numPaddingBytes = 0
-    data += '\0' * numPaddingBytes
-    return data
+    return numPaddingBytes
 
 
 # packs a struct into a string, storing all contained values inside it
+# the whole tree is written into a single buffer, see packer.Packer
 # addPadding will call 'pad' on the result with the given arguments
-def pack(struct, addPadding=True, padExtra=True, paddingAlignment=4):
-    data, offsetedData = struct.pack(None)
-    assert (len(offsetedData) == 0)
+# if deduplicate is True, identical referred data will only be stored once, if possible
+# (see packer.DeduplicatingPacker)
+# references with bit width types.AUTO get the smallest bit width their offsets fit in
+def pack(struct, addPadding=True, padExtra=True, paddingAlignment=4, deduplicate=False):
+    _checkPackable(struct)
+    _resolveReferenceBitWidths(struct)
+    structPacker = packer.DeduplicatingPacker() if deduplicate else packer.Packer()
+    data = structPacker.pack(struct).getData()
     if addPadding:
         data = pad(data, padExtra=padExtra, paddingAlignment=paddingAlignment)
     return data
 
 
+# packs a struct like 'pack', but stores small referred values (short strings, small blobs, tiny arrays) in the
+# alignment gaps between referred values instead of appending them (see packer.OptimizingPacker). The padding
+# members of structs stay zero, since the generated operator== compares them. The data can be read with the same
+# header.
+# returns the packed data and the number of bytes that were stored in alignment gaps
+def packOptimized(struct, addPadding=True, padExtra=True, paddingAlignment=4):
+    _checkPackable(struct)
+    _resolveReferenceBitWidths(struct)
+    structPacker = packer.OptimizingPacker()
+    data = structPacker.pack(struct).getData()
+    if addPadding:
+        data = pad(data, padExtra=padExtra, paddingAlignment=paddingAlignment)
+    return data, structPacker.numReclaimedBytes
+
+
+# returns a layout.LayoutPlan of the struct, which stores the offset and size of every contained value
+def planLayout(struct):
+    _checkPackable(struct)
+    _resolveReferenceBitWidths(struct)
+    return layout.LayoutPlan(struct)
+
+
+# reorders the members of all the structs contained in struct to minimize the padding bytes between members.
+# keepOrders may be a dictionary struct name -> list of member names of an already published version of the
+# struct, those members stay at the start of the struct in their order, so the struct stays backward compatible.
+# returns an ordered dictionary struct name -> number of removed padding bytes, see layout.minimizePadding
+def minimizePadding(struct, keepOrders=None):
+    return layout.minimizePadding(struct, keepOrders)
+
+
+# raises an exception if the value can't be packed as a top level value
+def _checkPackable(value):
+    if isinstance(value, values.Reference):
+        raise Exception("cannot pack reference without a data offset (is the reference not contained in a struct?)")
+
+
+# selects the bit widths of all references with bit width types.AUTO in the struct, if its type contains any
+def _resolveReferenceBitWidths(struct):
+    if struct.type.containsAuto:
+        layout.resolveReferenceBitWidths(struct)
+
+
+# returns the number of bytes that 'pack' would return, without packing the struct
+# plan may be a layout plan of the struct, otherwise only the sizes are counted (see packer.SizePacker)
+def estimateSize(struct, addPadding=True, padExtra=True, paddingAlignment=4, plan=None):
+    if plan is not None:
+        size = plan.getTotalSize()
+    else:
+        _checkPackable(struct)
+        _resolveReferenceBitWidths(struct)
+        size = packer.SizePacker().getPackedSize(struct)
+    if addPadding:
+        size += getNumPaddingBytes(size, padExtra, paddingAlignment)
+    return size
+
+
+# packs a struct like 'pack', but returns a generator of strings, whose concatenation is the packed data.
+# The data is generated sequentially while traversing the value tree, so only about chunkSize bytes are kept
+# in memory at any time. The sizes of the reference targets are measured when their references are written
+# (see packer.StreamPacker), or taken from plan, if it is a layout plan of the struct.
+def iterPack(struct, addPadding=True, padExtra=True, paddingAlignment=4, chunkSize=1 << 16, plan=None):
+    _checkPackable(struct)
+    _resolveReferenceBitWidths(struct)
+    streamPacker = packer.StreamPacker(None, plan, chunkSize)
+    for chunk in streamPacker.iterPack(struct):
+        yield chunk
+    if addPadding:
+        yield '\0' * getNumPaddingBytes(streamPacker.getPosition(), padExtra, paddingAlignment)
+
+
+# packs a struct like 'pack', but writes the data to the given file object, using iterPack.
+# returns the number of written bytes
+def packToFile(struct, fileobj, addPadding=True, padExtra=True, paddingAlignment=4, chunkSize=1 << 16, plan=None):
+    numBytes = 0
+    for chunk in iterPack(struct, addPadding, padExtra, paddingAlignment, chunkSize, plan):
+        fileobj.write(chunk)
+        numBytes += len(chunk)
+    return numBytes
+
+
+# returns an accessor of the root struct of packed data, which reads the members on demand (see reader.Reader).
+# data may be a string or any buffer, root is the struct value or type the data was packed from
+def read(data, root):
+    import reader  # to avoid circular dependencies
+    return reader.Reader(data, root).getRoot()
+
+
+# like read, but maps the file into memory instead of reading it
+def readFile(filename, root):
+    import reader  # to avoid circular dependencies
+    return reader.openFile(filename, root).getRoot()
+
+
 # returns an ordered dict of unique name -> type of all the unique types that are contained in the list
 # of types. The types with the same name are merged, which may result in exceptions if the types
-# are inconsistent. Thus this validates all the types contained in the type list
+# are inconsistent. Thus this validates all the types contained in the type list.
+# The types are ordered like getAllContainedTypes, contained types first. Every type object is only visited
+# once, and every pair of types only merged once, so this is linear in the number of distinct types.
 def getAllTypes(typeList):
     types = collections.OrderedDict()  # name -> type
+    visited = set()  # ids of the visited type objects
+    merged = {}  # (id(type), id(other type)) -> merged type
+    seen = []  # all visited and merged types, which keeps their ids valid
     for root in typeList:
-        for t in root.getAllContainedTypes():
-            name = t.getUniqueName()
-            if name in types:
-                types[name] = types[name].merge(t)
-            else:
-                types[name] = t
+        stack = [(root, False)]
+        while stack:
+            t, visitedChildren = stack.pop()
+            if visitedChildren:
+                name = t.getUniqueName()
+                if name in types:
+                    key = (id(types[name]), id(t))
+                    if key not in merged:
+                        merged[key] = types[name].merge(t)
+                        seen.append(merged[key])
+                    types[name] = merged[key]
+                else:
+                    types[name] = t
+            elif id(t) not in visited:
+                visited.add(id(t))
+                seen.append(t)
+                stack.append((t, True))
+                stack.extend((childType, False) for childType in reversed(t.getContainedTypes()))
     return types
@@ -0,0 +1,479 @@
+import hashlib
+
+
+# The packer writes a whole value tree into a single growable buffer in one traversal.
+#
+# Every value is packed in two phases:
+#   value.packImmediate(packer, base)
+#       appends the immediate data of the value at the end of the packer. References append a placeholder.
+#   value.packReferred(packer, position, base)
+#       appends the referred data of the value, where 'position' is the position where the immediate data
+#       of the value has been written to. References will patch their placeholder once their target lands.
+# 'base' is the position that references are stored relative to.
+#
+# The referred data is not packed recursively, instead the packer keeps a stack of values whose referred data
+# still has to be packed. Values that contain other values push their members onto the stack (in reverse order),
+# so the referred data ends up in the same order as the recursive pack would generate it.
+class Packer(object):
+    recordsMembers = False  # whether every member value has to be packed with packImmediate
+    
+    def __init__(self):
+        self.data = bytearray()
+        self.pending = []  # stack of (value, position, base) whose referred data still has to be packed
+    
+    # returns the position where the next appended data will be written
+    def getPosition(self):
+        return len(self.data)
+    
+    def append(self, data):
+        self.data += data
+    
+    def appendZeros(self, numBytes):
+        if numBytes > 0:
+            self.data += b"\x00" * numBytes
+    
+    # appends the padding bytes that align a referred value, which are not part of any value and never read.
+    # The padding members of structs are part of the struct, and are read by its generated operator==.
+    def appendPadding(self, numBytes):
+        self.appendZeros(numBytes)
+    
+    # overwrites the data at the given position, which must have been appended already
+    def writeAt(self, position, data):
+        self.data[position:position + len(data)] = data
+    
+    # appends the immediate data of a value, which is stored inside the immediate data of another value
+    def packImmediate(self, value, base):
+        value.packImmediate(self, base)
+    
+    # schedules packing the referred data of value, whose immediate data was written at position
+    def schedule(self, value, position, base):
+        self.pending.append((value, position, base))
+    
+    # packs the value as a top level value, i.e. its references are relative to its start
+    def pack(self, value):
+        self.packTarget(value)
+        pending = self.pending
+        while pending:
+            value, position, base = pending.pop()
+            value.packReferred(self, position, base)
+        return self
+    
+    # appends the immediate data of the value, and schedules its referred data
+    # if the value caches its packed data, the cached data gets appended instead
+    def packTarget(self, value):
+        position = self.getPosition()
+        cache = value.packCache
+        if cache is not None:
+            if cache.isValid():
+                self.packCached(value, cache)
+                return
+            storeCache = _StoreCache(value)  # gets popped once all the referred data of the value is packed
+            self.pending.append((storeCache, position, position))
+            self.packImmediate(value, position)
+            storeCache.immediateSize = self.getPosition() - position
+        else:
+            self.packImmediate(value, position)
+        self.schedule(value, position, position)
+    
+    def packCached(self, value, cache):
+        self.append(cache.data)
+    
+    # stores the data packed since position in the cache of the value
+    def storeCache(self, value, position, immediateSize):
+        value.packCache.store(value, str(self.data[position:]), immediateSize)
+    
+    # appends the reference to the end of the packer - the actual offset gets patched once the target lands
+    def appendReference(self, reference, base):
+        self.appendZeros(reference.type.getWidth())
+    
+    # appends the target of the reference stored at position, and patches the offset stored at position
+    def packReferenceTarget(self, reference, position, base):
+        if reference.targetValue.isNull():
+            return  # the placeholder is already the null reference
+        dataOffset = self.getPosition() - base
+        padding = (-dataOffset) % reference.type.targetType.getAlignment()
+        self.appendPadding(padding)
+        self.writeAt(position, reference.type.referenceType.pack(dataOffset + padding))
+        self.packTarget(reference.targetValue)
+    
+    # returns the packed data as a string
+    def getData(self):
+        return str(self.data)
+
+
+# a packer that stores identical referred data only once. Once the target of a reference has been packed, its data
+# is looked up by its hash, and if an identical copy was packed before, the data is removed again, and the
+# reference points to the copy instead. References can only point forward, so a copy can only be used if it's
+# stored after the base of the reference, if it's aligned relative to the base, and if its offset fits in the
+# reference bit width. Otherwise the data stays, and becomes another copy.
+# Thus the targets of a reference array, which are all stored after the array, share identical copies, but e.g.
+# the strings of the structs in a reference array are not shared between the structs, since a struct can't refer
+# to the string of an earlier struct.
+class DeduplicatingPacker(Packer):
+    maxNumTries = 16  # the number of copies that are tried for a target, starting with the last one
+    
+    def __init__(self):
+        Packer.__init__(self)
+        self.copies = {}  # hash of packed data -> list of positions where the data is stored
+        self.copyLog = []  # list of (position, hash) of the stored copies, in the order they were added
+        self.numDeduplicatedBytes = 0  # number of bytes that were removed
+    
+    def packReferenceTarget(self, reference, position, base):
+        if reference.targetValue.isNull():
+            return
+        start = self.getPosition()
+        targetPosition = start + (base - start) % reference.type.targetType.getAlignment()
+        # gets popped once the target has been packed
+        self.pending.append((_Deduplicate(reference, start, targetPosition), position, base))
+        Packer.packReferenceTarget(self, reference, position, base)
+    
+    # called once the target of the reference stored at position has been packed
+    def deduplicate(self, reference, position, base, start, targetPosition):
+        data = str(self.data[targetPosition:])
+        key = hashlib.sha1(data).digest()
+        copies = self.copies.setdefault(key, [])
+        alignment = reference.type.targetType.getAlignment()
+        maxOffset = reference.type.getMaxOffset()
+        for copyPosition in copies[:-DeduplicatingPacker.maxNumTries - 1:-1]:
+            offset = copyPosition - base
+            if (0 < offset <= maxOffset and offset % alignment == 0
+                    and self.data[copyPosition:copyPosition + len(data)] == data):
+                self.numDeduplicatedBytes += self.getPosition() - start
+                self.truncate(start)
+                self.writeAt(position, reference.type.referenceType.pack(offset))
+                return
+        copies.append(targetPosition)
+        self.copyLog.append((targetPosition, key))
+    
+    # removes all data after position, and the copies that were stored there
+    def truncate(self, position):
+        del self.data[position:]
+        while self.copyLog and self.copyLog[-1][0] >= position:
+            copyPosition, key = self.copyLog.pop()
+            self.copies[key].remove(copyPosition)
+
+
+# marks the end of the packed target of a reference in the pending stack of a DeduplicatingPacker
+class _Deduplicate(object):
+    def __init__(self, reference, start, targetPosition):
+        self.reference = reference
+        self.start = start  # the position before the padding of the target
+        self.targetPosition = targetPosition
+    
+    def packReferred(self, packer, position, base):
+        packer.deduplicate(self.reference, position, base, self.start, self.targetPosition)
+
+
+# a packer that stores small reference targets in the padding bytes that align referred values, instead of
+# appending them. These padding bytes are never read, so a contiguous range of them (a hole) can store the data of
+# a reference target, if the target has no referred data itself, if the data fits, if it's aligned relative to the
+# base of the reference, and if the offset fits in the reference. Like all references, they only point forward.
+# The padding members of structs are never used, they are compared by the generated operator==.
+# Since targets may end up anywhere, the packed data of a value is not position independent, so caches are not used.
+class OptimizingPacker(Packer):
+    maxNumTries = 16  # the number of holes of every size that are tried for a target, starting with the last one
+    
+    def __init__(self):
+        Packer.__init__(self)
+        self.holes = {}  # size -> list of positions of free padding bytes of that size
+        self.lastHole = None  # (position, size) of the last added hole, if it's still free
+        self.maxHoleSize = 0  # the size of the largest hole that was ever added
+        self.numReclaimedBytes = 0  # number of bytes stored in holes
+    
+    def appendPadding(self, numBytes):
+        if numBytes <= 0:
+            return
+        position = self.getPosition()
+        Packer.appendPadding(self, numBytes)
+        if self.lastHole is not None and sum(self.lastHole) == position:  # extend the last hole
+            position, size = self.lastHole
+            self.holes[size].pop()
+            numBytes += size
+        self.addHole(position, numBytes)
+    
+    def addHole(self, position, size):
+        self.holes.setdefault(size, []).append(position)
+        self.lastHole = (position, size)
+        self.maxHoleSize = max(self.maxHoleSize, size)
+    
+    def packTarget(self, value):
+        position = self.getPosition()
+        self.packImmediate(value, position)
+        self.schedule(value, position, position)
+    
+    def packReferenceTarget(self, reference, position, base):
+        target = reference.targetValue
+        if (not target.isNull() and not target.hasReferredData()
+                and 0 < target.getImmediateDataSize() <= self.maxHoleSize):
+            data = Packer().pack(target).getData()
+            targetPosition = self.fillHole(reference, base, len(data))
+            if targetPosition is not None:
+                self.writeAt(targetPosition, data)
+                self.writeAt(position, reference.type.referenceType.pack(targetPosition - base))
+                self.numReclaimedBytes += len(data)
+                return
+        Packer.packReferenceTarget(self, reference, position, base)
+    
+    # finds a hole that can store the target of the reference with the given size, and removes the used bytes from
+    # the hole. returns the position where the target can be stored, or None if there is no such hole
+    def fillHole(self, reference, base, size):
+        alignment = reference.type.targetType.getAlignment()
+        maxOffset = reference.type.getMaxOffset()
+        for holeSize, positions in self.holes.items():
+            if holeSize < size:
+                continue
+            for i in range(len(positions) - 1, max(-1, len(positions) - 1 - OptimizingPacker.maxNumTries), -1):
+                holePosition = positions[i]
+                targetPosition = holePosition + (base - holePosition) % alignment
+                offset = targetPosition - base
+                if targetPosition + size > holePosition + holeSize or not 0 <= offset <= maxOffset:
+                    continue  # references only point forward
+                if offset == 0:  # would be the null reference
+                    targetPosition += alignment
+                    offset += alignment
+                    if targetPosition + size > holePosition + holeSize or offset > maxOffset:
+                        continue
+                del positions[i]
+                if self.lastHole == (holePosition, holeSize):
+                    self.lastHole = None
+                if targetPosition > holePosition:
+                    self.addHole(holePosition, targetPosition - holePosition)
+                end = targetPosition + size
+                if end < holePosition + holeSize:
+                    self.addHole(end, holePosition + holeSize - end)
+                return targetPosition
+        return None
+
+
+# a packer that doesn't store any data, but only counts the bytes that would be packed, to get the size of the
+# packed data without packing it. Every value is measured by its immediate data size, so the immediate data is
+# never packed, and nothing is stored per value.
+# If sizes is a dict, the packed sizes of the nested reference targets that contain at least minNumStoredTargets
+# other targets are stored in it by id(target), so that they don't have to be measured again (see StreamPacker).
+class SizePacker(Packer):
+    minNumStoredTargets = 64
+    
+    def __init__(self, sizes=None):
+        Packer.__init__(self)
+        self.position = 0
+        self.sizes = sizes
+        self.numTargets = 0  # the number of reference targets measured so far
+    
+    def getPosition(self):
+        return self.position
+    
+    def append(self, data):
+        self.position += len(data)
+    
+    def appendZeros(self, numBytes):
+        if numBytes > 0:
+            self.position += numBytes
+    
+    def writeAt(self, position, data):
+        pass
+    
+    def packImmediate(self, value, base):
+        self.position += value.getImmediateDataSize()
+    
+    def packTarget(self, value):
+        cache = value.packCache
+        if cache is not None and cache.isValid():
+            self.position += len(cache.data)
+            return
+        position = self.position
+        self.position += value.getImmediateDataSize()
+        if value.hasReferredData():
+            self.schedule(value, position, position)
+    
+    def packReferenceTarget(self, reference, position, base):
+        target = reference.targetValue
+        if target.isNull():
+            return
+        self.position += (base - self.position) % reference.type.targetType.getAlignment()
+        self.numTargets += 1
+        if self.sizes is not None and target.hasReferredData():
+            size = self.sizes.get(id(target))
+            if size is not None:
+                self.position += size
+                return
+            # gets popped once the target has been measured
+            self.pending.append((_StoreSize(target, self.position, self.numTargets), position, base))
+        self.packTarget(target)
+    
+    # returns the size of the value when packed as a top level value
+    def getPackedSize(self, value):
+        start = self.position
+        self.pack(value)
+        return self.position - start
+    
+    def getData(self):
+        raise Exception("size packer doesn't store any data")
+
+
+# marks the end of a reference target in the pending stack of a SizePacker, stores the size of the target if it
+# contains enough other targets
+class _StoreSize(object):
+    def __init__(self, value, start, numTargets):
+        self.value = value
+        self.start = start
+        self.numTargets = numTargets
+    
+    def packReferred(self, packer, position, base):
+        if packer.numTargets - self.numTargets >= SizePacker.minNumStoredTargets:
+            packer.sizes[id(self.value)] = packer.position - self.start
+
+
+# the packed data of a value, when packed as a top level value. Because references are relative, the packed
+# data doesn't depend on where the value is stored. The cache stays valid as long as all the mutable values
+# contained in the value have the same version as when the data was stored.
+class PackCache(object):
+    def __init__(self):
+        self.data = None
+        self.immediateSize = None
+        self.dependencies = []  # list of (mutable value, version)
+    
+    def isValid(self):
+        if self.data is None:
+            return False
+        for value, version in self.dependencies:
+            if value.version != version:
+                return False
+        return True
+    
+    def store(self, value, data, immediateSize):
+        self.data = data
+        self.immediateSize = immediateSize
+        self.dependencies = [(v, v.version) for v in _getMutableValues(value)]
+    
+    def clear(self):
+        self.data = None
+        self.dependencies = []
+
+
+# returns all the mutable values contained in value, including value itself
+# values with a valid cache are not traversed, instead the dependencies of their cache are used
+def _getMutableValues(value):
+    result = []
+    stack = [value]
+    while stack:
+        v = stack.pop()
+        if v.isMutable():
+            result.append(v)
+        cache = v.packCache
+        if v is not value and cache is not None and cache.isValid():
+            result.extend(dependency for dependency, _ in cache.dependencies)
+        else:
+            stack.extend(v.getContainedValues())
+    return result
+
+
+# marks the end of the packed data of a value that caches its data in the pending stack of a packer
+class _StoreCache(object):
+    def __init__(self, value):
+        self.value = value
+        self.immediateSize = None
+    
+    def packReferred(self, packer, position, base):
+        packer.storeCache(self.value, position, self.immediateSize)
+
+
+# a packer that writes the data sequentially to a write function, in chunks of about chunkSize bytes.
+# References are written before their target is packed, so the packed size of every reference target except the
+# last one of every value is measured once the next reference is written (see SizePacker), or taken from plan, if
+# it is a layout.LayoutPlan of the packed value. Thus the immediate data never has to be patched, and only the
+# current chunk, the pending stack, which is bounded by the depth of the tree, and the sizes of large targets that
+# were measured but aren't packed yet have to be kept in memory.
+class StreamPacker(Packer):
+    def __init__(self, write, plan=None, chunkSize=1 << 16):
+        Packer.__init__(self)
+        self.write = write
+        self.plan = plan
+        self.chunkSize = chunkSize
+        self.numWrittenBytes = 0
+        self.referredPosition = None  # the position where the referred data of the last written reference starts
+        self.lastTarget = None  # the target of the last written reference of the current target, if any
+        self.sizes = {}  # id(target) -> packed size, for large targets that have been measured as part of others
+        self.sizePacker = SizePacker(self.sizes)
+    
+    def getPosition(self):
+        return self.numWrittenBytes + len(self.data)
+    
+    def append(self, data):
+        self.data += data
+        if len(self.data) >= self.chunkSize:
+            self.flush()
+    
+    def appendZeros(self, numBytes):
+        if numBytes > 0:
+            self.append(b"\x00" * numBytes)
+    
+    def writeAt(self, position, data):
+        if position < self.numWrittenBytes:
+            raise Exception("cannot overwrite data at position %d, it has already been written" % position)
+        Packer.writeAt(self, position - self.numWrittenBytes, data)
+    
+    # only stores the cache if the data hasn't been written yet
+    def storeCache(self, value, position, immediateSize):
+        if position >= self.numWrittenBytes:
+            Packer.storeCache(self, value, position - self.numWrittenBytes, immediateSize)
+    
+    # writes all data that has been packed so far
+    def flush(self):
+        if len(self.data) > 0:
+            self.write(str(self.data))
+            self.numWrittenBytes += len(self.data)
+            self.data = bytearray()
+    
+    def packTarget(self, value):
+        self.referredPosition = self.getPosition() + value.getImmediateDataSize()
+        self.lastTarget = None
+        Packer.packTarget(self, value)
+    
+    # appends the final reference, assuming the referred data is stored in the same order as the references
+    def appendReference(self, reference, base):
+        if reference.targetValue.isNull():
+            self.append(reference.type.referenceType.pack(0))
+            return
+        if self.lastTarget is not None:  # the size of a target is only needed if another reference follows
+            self.referredPosition += self.getPackedSize(self.lastTarget)
+        dataOffset = self.referredPosition - base
+        padding = (-dataOffset) % reference.type.targetType.getAlignment()
+        self.append(reference.type.referenceType.pack(dataOffset + padding))
+        self.referredPosition += padding
+        self.lastTarget = reference.targetValue
+    
+    # returns the size of the target when packed as a top level value
+    def getPackedSize(self, target):
+        if self.plan is not None:
+            return self.plan.getPackedSize(target)
+        size = self.sizes.get(id(target))
+        if size is not None:
+            return size
+        if not target.hasReferredData() and target.packCache is None:
+            return target.getImmediateDataSize()
+        return self.sizePacker.getPackedSize(target)
+    
+    def packReferenceTarget(self, reference, position, base):
+        target = reference.targetValue
+        if target.isNull():
+            return
+        self.sizes.pop(id(target), None)  # the reference to the target has been written
+        self.appendZeros((base - self.getPosition()) % reference.type.targetType.getAlignment())
+        self.packTarget(target)
+    
+    # packs the value as a top level value, yields the written chunks as they become available
+    def iterPack(self, value):
+        chunks = []
+        self.write = chunks.append
+        self.packTarget(value)
+        pending = self.pending
+        while pending:
+            value, position, base = pending.pop()
+            value.packReferred(self, position, base)
+            if chunks:
+                for chunk in chunks:
+                    yield chunk
+                del chunks[:]
+        self.flush()
+        for chunk in chunks:
+            yield chunk
@@ -0,0 +1,404 @@
+import collections
+import mmap
+import struct
+
+import bithelper
+import namedstruct
+import types
+import values
+
+
+# The reader reads packed data in python, using the same types that the c++ header is generated from. Like the
+# c++ header, it doesn't deserialize the data: accessors only store the position of their data, and read members
+# on demand with struct.unpack_from. The data may be any buffer, e.g. a string, a bytearray, a memoryview or an
+# mmap of a file (see openFile), so opening a file only maps it into memory, and reading a record only reads
+# that record.
+#
+# Every type is read by a read function (position, base) -> python value or accessor, see Reader.getReadFunction:
+#   integers, chars  -> python values
+#   enums            -> the EnumValue of the enum type
+#   bit fields       -> a namedtuple of the field values
+#   references       -> the accessor or value of the target, or None for null references
+#   structs          -> a StructReader, whose class has a property for every member, see Reader.getStructClass
+#   simple arrays    -> an ArrayReader
+#   reference arrays -> a ReferenceArrayReader
+#   bitfield arrays  -> a BitFieldArrayReader
+# 'base' is the position that the references of the value are relative to. It's the position of the value, except
+# for values stored immediately in structs and arrays, which use the base of their parent (see
+# values.Struct.packImmediate and values.Array.packImmediate).
+# Accessors cache the accessors of their members and elements, so following the same reference twice returns the
+# same accessor.
+class Reader(object):
+    # root is the struct value or type that the data was packed from. Types with the same name are merged like in
+    # namedstruct.generateHeader, so members that are only known in some structs (e.g. typed via a non-null
+    # reference in one struct, but null in another) can be read.
+    def __init__(self, data, root):
+        self.data = data
+        self.rootType = root.getType() if isinstance(root, values.Value) else root
+        self.types = namedstruct.getAllTypes([self.rootType])  # unique name -> merged type
+        self.readFunctions = {}  # id(type) -> read function
+        self.structClasses = {}  # id(struct type) -> StructReader subclass
+        self.readTypes = []  # all types with read functions, keeps their ids valid
+    
+    # returns the accessor of the root struct, which is stored at the start of the data
+    def getRoot(self):
+        return self.read(self.rootType, 0)
+    
+    # reads a value of the given type at the given position, references are relative to base (or the position)
+    def read(self, aType, position, base=None):
+        return self.getReadFunction(aType)(position, position if base is None else base)
+    
+    # returns the read function of the type, creating it on the first call
+    def getReadFunction(self, aType):
+        readFunction = self.readFunctions.get(id(aType))
+        if readFunction is None:
+            readFunction = self.createReadFunction(aType)
+            self.readFunctions[id(aType)] = readFunction
+            self.readTypes.append(aType)
+        return readFunction
+    
+    def createReadFunction(self, aType):
+        data = self.data
+        if isinstance(aType, types.EnumType):
+            unpackEnum = struct.Struct("<" + aType.getEnumType().getFormatChar()).unpack_from
+            enumValues = dict((enumValue.getPythonValue(), enumValue) for enumValue in aType.values.values())
+            return lambda position, base: enumValues[unpackEnum(data, position)[0]]
+        if isinstance(aType, types.PrimitiveType):
+            unpack = struct.Struct("<" + aType.getFormatChar()).unpack_from
+            return lambda position, base: unpack(data, position)[0]
+        if isinstance(aType, types.BitFieldType):
+            unpackBits = struct.Struct("<" + aType.dataType.getFormatChar()).unpack_from
+            decode = getBitFieldDecoder(aType)
+            return lambda position, base: decode(unpackBits(data, position)[0])
+        if isinstance(aType, types.ReferenceType):
+            return self.createReferenceReadFunction(aType)
+        if isinstance(aType, types.StructType):
+            structClass = self.getStructClass(aType)
+            return lambda position, base: structClass(self, position, base)
+        if isinstance(aType, types.SimpleArrayType):
+            return lambda position, base: ArrayReader(self, aType, position, base)
+        if isinstance(aType, types.ReferenceArrayType):
+            return lambda position, base: ReferenceArrayReader(self, aType, position, base)
+        if isinstance(aType, types.BitFieldArrayType):
+            return lambda position, base: BitFieldArrayReader(self, aType, position)
+        raise Exception("cannot read values of type " + repr(aType))
+    
+    # the target is read with the read function of the target type, which is only created once a reference is
+    # followed, so that long chains of types don't create all their read functions at once
+    def createReferenceReadFunction(self, referenceType):
+        data = self.data
+        unpackOffset = struct.Struct("<" + referenceType.referenceType.getFormatChar()).unpack_from
+        targetType = referenceType.targetType
+        readTarget = []  # the read function of the target type, once it's needed
+        
+        def readReference(position, base):
+            offset = unpackOffset(data, position)[0]
+            if offset == 0:
+                return None
+            if not readTarget:
+                if targetType is None or isinstance(targetType, types.NullType):
+                    raise Exception("cannot follow reference of type %s at position %d, the target type is unknown"
+                                    % (repr(referenceType), position))
+                readTarget.append(self.getReadFunction(targetType))
+            return readTarget[0](base + offset, base + offset)
+        
+        return readReference
+    
+    # returns the class of the accessors of the struct type. The class is created from the merged type of the
+    # same name, and has a property for every member (except padding bytes), named like the member. Members that
+    # aren't python values are cached in the accessor.
+    def getStructClass(self, structType):
+        structType = self.types.get(structType.getUniqueName(), structType)
+        structClass = self.structClasses.get(id(structType))
+        if structClass is None:
+            classMembers = {"__slots__": (), "_type": structType}
+            for i, name in enumerate(structType.names):
+                if i not in structType.paddingIndices:
+                    classMembers[name] = self.getMemberProperty(i, structType.offsets[i], structType.types[i])
+            structClass = type(str(structType.name), (StructReader,), classMembers)
+            self.structClasses[id(structType)] = structClass
+            self.readTypes.append(structType)
+        return structClass
+    
+    def getMemberProperty(self, index, offset, memberType):
+        readMember = self.getReadFunction(memberType)
+        if isinstance(memberType, (types.PrimitiveType, types.EnumType, types.BitFieldType)):
+            return property(lambda accessor: readMember(accessor._position + offset, accessor._base))
+        
+        def getMember(accessor):
+            children = accessor._children
+            if children is None:
+                children = accessor._children = {}
+            if index not in children:
+                children[index] = readMember(accessor._position + offset, accessor._base)
+            return children[index]
+        
+        return property(getMember)
+
+
+# returns a function that turns the integer of a bit field of the given type into a namedtuple of the field values.
+# Signed fields and enums with negative values are zig zag encoded, enums are returned as their EnumValue.
+def getBitFieldDecoder(bitFieldType):
+    fieldTuple = collections.namedtuple(str(bitFieldType.name), [field.name for field in bitFieldType.fieldArray])
+    decoders = []  # list of (shift, mask, decode function or None)
+    shift = 0
+    for field in bitFieldType.fieldArray:
+        decode = None
+        if field.type == "i":
+            decode = bithelper.zigZagDecode
+        elif field.type != "u":
+            enumValues = dict((enumValue.getPythonValue(), enumValue) for enumValue in field.type.values.values())
+            if field.type.hasNegativeValues():
+                decode = lambda v, enumValues=enumValues: enumValues[bithelper.zigZagDecode(v)]
+            else:
+                decode = enumValues.__getitem__
+        decoders.append((shift, (1 << field.bitWidth) - 1, decode))
+        shift += field.bitWidth
+    
+    def decodeBitField(bits):
+        fieldValues = []
+        for fieldShift, mask, decodeField in decoders:
+            value = (bits >> fieldShift) & mask
+            fieldValues.append(value if decodeField is None else decodeField(value))
+        return fieldTuple(*fieldValues)
+    
+    return decodeBitField
+
+
+# returns numBits bits starting at the bit position bitPosition of the data as an unsigned integer, where bits are
+# stored little endian, like namedstruct::readBits in c++ (see bithelper.BitWriter)
+def readBits(data, bitPosition, numBits):
+    start = bitPosition >> 3
+    end = (bitPosition + numBits + 7) >> 3
+    return (bithelper.bytesToInt(data[start:end]) >> (bitPosition & 7)) & ((1 << numBits) - 1)
+
+
+# the base class of the accessors of structs, see Reader.getStructClass. Members are accessed as properties,
+# which take precedence over the methods of this class if they have the same name.
+class StructReader(object):
+    __slots__ = ("_reader", "_position", "_base", "_children")
+    
+    _type = None  # the struct type, set by the subclasses
+    
+    def __init__(self, reader, position, base):
+        self._reader = reader
+        self._position = position
+        self._base = base
+        self._children = None  # member index -> accessor, for the members that were read already
+    
+    def getType(self):
+        return self._type
+    
+    def getPosition(self):
+        return self._position
+    
+    # returns the value of the member with the given name
+    def get(self, name):
+        return getattr(self, name)
+    
+    def getMemberNames(self):
+        return self._type.getMemberNames()
+    
+    def __repr__(self):
+        return "<StructReader:%s at %d>" % (self._type.name, self._position)
+
+
+# the accessor of a c array. The number of elements is only known for fixed size arrays, like in c++.
+class ArrayReader(object):
+    __slots__ = ("reader", "type", "position", "base", "elementWidth", "readElement", "elements")
+    
+    def __init__(self, reader, arrayType, position, base):
+        self.reader = reader
+        self.type = arrayType
+        self.position = position
+        self.base = base
+        self.elementWidth = arrayType.getElementType().getWidth()
+        self.readElement = reader.getReadFunction(arrayType.getElementType())
+        self.elements = None  # index -> element accessor, for the elements that were read already
+    
+    def getType(self):
+        return self.type
+    
+    def getPosition(self):
+        return self.position
+    
+    # accessors are true, even though the number of elements may not be known
+    def __nonzero__(self):
+        return True
+    
+    def __len__(self):
+        if self.type.fixedSize is None:
+            raise Exception("the number of elements of array %s is not stored" % repr(self.type))
+        return self.type.fixedSize
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.getRange(*self.getSliceRange(index))
+        if self.type.fixedSize is not None:
+            if index < 0:
+                index += self.type.fixedSize
+            if not 0 <= index < self.type.fixedSize:
+                raise IndexError("index %d is out of range for array %s" % (index, repr(self.type)))
+        elementOffset = index * self.elementWidth
+        if isinstance(self.type.getElementType(), types.PrimitiveType):
+            return self.readElement(self.position + elementOffset, self.base + elementOffset)
+        if self.elements is None:
+            self.elements = {}
+        if index not in self.elements:  # references of elements are relative to the element
+            self.elements[index] = self.readElement(self.position + elementOffset, self.base + elementOffset)
+        return self.elements[index]
+    
+    # returns the begin and end of a slice without step. Arrays without fixed size need the end of the slice.
+    def getSliceRange(self, indices):
+        if indices.step not in (None, 1):
+            raise Exception("cannot slice array %s with a step" % repr(self.type))
+        if self.type.fixedSize is not None:
+            return indices.indices(self.type.fixedSize)[:2]
+        if indices.stop is None or indices.stop < 0 or (indices.start or 0) < 0:
+            raise Exception("slices of array %s need a non-negative begin and end, the number of elements is not stored"
+                            % repr(self.type))
+        return indices.start or 0, indices.stop
+    
+    # returns the elements begin..end (excl.) as a list, primitives are read with a single struct call
+    def getRange(self, begin, end):
+        elementType = self.type.getElementType()
+        if isinstance(elementType, types.PrimitiveType):
+            numElements = max(0, end - begin)
+            return list(struct.unpack_from("<%d%s" % (numElements, elementType.getFormatChar()),
+                                           self.reader.data, self.position + begin * self.elementWidth))
+        return [self[i] for i in range(begin, end)]
+    
+    # returns a numpy array of the elements, which is a view of the data (read-only for strings and read-only
+    # mmaps), so no element is decoded. The element type needs a numpy dtype (see types.Type.toNumpyDtype), e.g.
+    # primitives or finalized structs with primitive members. numElements is required for arrays without fixed
+    # size. Requires numpy.
+    def toNumpy(self, numElements=None):
+        import numpy  # numpy is optional, it's only required for numpy arrays
+        if numElements is None:
+            numElements = len(self)
+        dtype = self.type.getElementType().toNumpyDtype()
+        return numpy.frombuffer(self.reader.data, dtype, numElements, self.position)
+    
+    # returns the characters of a char array up to the first '\0' (or up to the fixed size) as a string
+    def getString(self):
+        data = self.reader.data
+        end = self.position
+        maxEnd = len(data) if self.type.fixedSize is None else self.position + self.type.fixedSize
+        while end < maxEnd:
+            chunk = str(data[end:min(end + 64, maxEnd)])
+            terminal = chunk.find("\x00")
+            if terminal >= 0:
+                return str(data[self.position:end + terminal])
+            end += len(chunk)
+        return str(data[self.position:maxEnd])
+    
+    # returns numBits bits at the given bit offset of the array as an unsigned integer, e.g. for blobs
+    def readBits(self, bitOffset, numBits):
+        return readBits(self.reader.data, self.position * 8 + bitOffset, numBits)
+    
+    def __repr__(self):
+        return "<ArrayReader:%s at %d>" % (repr(self.type), self.position)
+
+
+# the accessor of a reference array, the elements are the targets of the references, or None for null references
+class ReferenceArrayReader(ArrayReader):
+    __slots__ = ()
+    
+    # references in reference arrays are relative to the base of the array, not to the element
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.getRange(*self.getSliceRange(index))
+        if self.type.fixedSize is not None:
+            if index < 0:
+                index += self.type.fixedSize
+            if not 0 <= index < self.type.fixedSize:
+                raise IndexError("index %d is out of range for array %s" % (index, repr(self.type)))
+        if self.elements is None:
+            self.elements = {}
+        if index not in self.elements:
+            self.elements[index] = self.readElement(self.position + index * self.elementWidth, self.base)
+        return self.elements[index]
+    
+    def getRange(self, begin, end):
+        return [self[i] for i in range(begin, end)]
+    
+    def __repr__(self):
+        return "<ReferenceArrayReader:%s at %d>" % (repr(self.type), self.position)
+
+
+# the accessor of a bit field array. Like in c++, the number of entries is not stored, and the data may have more
+# or fewer fields than the type.
+class BitFieldArrayReader(object):
+    __slots__ = ("reader", "type", "position", "entryBits", "bitOffsets")
+    
+    def __init__(self, reader, bitFieldArrayType, position):
+        self.reader = reader
+        self.type = bitFieldArrayType
+        self.position = position
+        # the header is the number of bits of an entry, the bit offset of every field, and the end offset
+        self.entryBits, firstOffset = struct.unpack_from("<HH", reader.data, position)
+        numFields = (firstOffset >> 4) - 2
+        self.bitOffsets = struct.unpack_from("<%dH" % (numFields + 1), reader.data, position + 2)
+    
+    def getType(self):
+        return self.type
+    
+    def getPosition(self):
+        return self.position
+    
+    # returns the number of fields stored in the data
+    def getNumFields(self):
+        return len(self.bitOffsets) - 1
+    
+    # returns whether the data stores the field with the given name
+    def has(self, fieldName):
+        return self.type.getFields().index(fieldName) < self.getNumFields()
+    
+    # returns the number of bits used by the field with the given index
+    def getNumBitsByFieldIndex(self, fieldIndex):
+        return self.bitOffsets[fieldIndex + 1] - self.bitOffsets[fieldIndex]
+    
+    def getByFieldIndex(self, fieldIndex, index):
+        bitOffset = self.bitOffsets[fieldIndex] + index * self.entryBits
+        return readBits(self.reader.data, self.position * 8 + bitOffset, self.getNumBitsByFieldIndex(fieldIndex))
+    
+    # returns the value of the field with the given name of the entry with the given index
+    def get(self, fieldName, index):
+        return self.getByFieldIndex(self.type.getFields().index(fieldName), index)
+    
+    # returns the number of entries that fit in the data after the header. That's the number of entries if the data
+    # ends with this array (e.g. if the data is the packed array), unless entries have less than 8 bits, since
+    # the unused bits of the last byte may fit more entries.
+    def getNumEntriesInData(self):
+        if self.entryBits == 0:
+            raise Exception("cannot count the entries of bit field array %s, they have no bits" % self.type.getName())
+        return (len(self.reader.data) * 8 - self.position * 8 - self.bitOffsets[0]) // self.entryBits
+    
+    # returns an ordered dictionary field name -> numpy uint64 array of the values of the entries begin..end (excl.),
+    # for the fields of the type that are stored in the data. All entries are decoded at once (see
+    # bithelper.unpackBitColumns). If end is None, the data has to end with this array, see getNumEntriesInData.
+    # Requires numpy.
+    def decode(self, begin=0, end=None):
+        if end is None:
+            end = self.getNumEntriesInData()
+        fields = self.type.getFields()[:self.getNumFields()]
+        bitOffsets = [self.position * 8 + self.bitOffsets[i] for i in range(len(fields))]
+        bitWidths = [self.getNumBitsByFieldIndex(i) for i in range(len(fields))]
+        columns = bithelper.unpackBitColumns(self.reader.data, bitOffsets, bitWidths, self.entryBits, begin, end)
+        return collections.OrderedDict(zip(fields, columns))
+    
+    def __repr__(self):
+        return "<BitFieldArrayReader:%s at %d>" % (self.type.getName(), self.position)
+
+
+# decodes the entries begin..end (excl.) of a packed bit field array, e.g. the data of values.BitFieldArray.pack,
+# into numpy arrays, see BitFieldArrayReader.decode. bitFieldArray is the value or type of the array
+def decodeBitFieldArray(data, bitFieldArray, begin=0, end=None):
+    return Reader(data, bitFieldArray).getRoot().decode(begin, end)
+
+
+# returns a reader of the packed data in the given file, which is mapped into memory
+def openFile(filename, root):
+    with open(filename, "rb") as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return Reader(data, root)
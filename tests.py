@@ -1,3 +1,5 @@
+import unittest
+
 from namedstruct import pack
 from values import *
 
@@ -365,3 +367,764 @@ def generateHeader():
                                         headText="/* Testing structs generated by namedstructpy */")
     with open("../bgtfsLib/bgtfsLib Tests/namedStructTest.h", "w") as f:
         f.write(header)
+
+
+class TestPack(unittest.TestCase):
+    # the packer has to produce exactly the same data as the recursive value.pack
+    def testPackerMatchesRecursivePack(self):
+        for s in generateTests(quiet=True):
+            self.assertEqual(pack(s, addPadding=False), s.pack(None)[0])
+    
+    def testIterPack(self):
+        for s in generateTests(quiet=True):
+            self.assertEqual("".join(namedstruct.iterPack(s, chunkSize=8)), pack(s))
+    
+    def testPackToFile(self):
+        import StringIO
+        for s in generateTests(quiet=True):
+            f = StringIO.StringIO()
+            numBytes = namedstruct.packToFile(s, f)
+            self.assertEqual(f.getvalue(), pack(s))
+            self.assertEqual(numBytes, len(f.getvalue()))
+    
+    # streaming only keeps the pending stack, which is bounded by the depth of the tree, and the sizes of the large
+    # reference targets that aren't packed yet
+    def testStreamPackerMemory(self):
+        import packer
+        groups = [ReferenceArray([Struct("streamItem").addString("name", "item%d" % i).addInt32("value", i)
+                                  for i in range(100)]) for _ in range(20)]
+        s = Struct("streamRoot").addReferenceArray("groups", groups).addString("end", "end")
+        streamPacker = packer.StreamPacker(None, chunkSize=64)
+        chunks = []
+        counts = []
+        for chunk in streamPacker.iterPack(s):
+            chunks.append(chunk)
+            counts.append((len(streamPacker.pending), len(streamPacker.sizes)))
+        self.assertEqual("".join(chunks), pack(s, addPadding=False))
+        self.assertGreater(len(counts), 100)
+        self.assertLess(max(numPending for numPending, _ in counts), 10)
+        self.assertLessEqual(max(numSizes for _, numSizes in counts), len(groups))
+        self.assertEqual(len(streamPacker.sizes), 0)
+    
+    def testEstimateSize(self):
+        for s in generateTests(quiet=True):
+            self.assertEqual(namedstruct.estimateSize(s), len(pack(s)))
+            self.assertEqual(namedstruct.estimateSize(s, padExtra=False), len(pack(s, padExtra=False)))
+    
+    def testLayoutPlan(self):
+        for s in generateTests(quiet=True):
+            plan = namedstruct.planLayout(s)
+            dataOffset = s.getImmediateDataSize()
+            for i, value in enumerate(s.values):
+                if not isinstance(value, Value):  # primitive members are stored as python values
+                    continue
+                immediate, referred = value.pack(dataOffset)
+                dataOffset += len(referred)
+                self.assertEqual(plan.getEntry(value).offset, s.type.offsets[i])
+                self.assertEqual(plan.getImmediateDataSize(value), len(immediate))
+                self.assertEqual(plan.getReferredDataSize(value), len(referred))
+            self.assertEqual("".join(namedstruct.iterPack(s, plan=plan)), pack(s))
+    
+    def testPackCache(self):
+        bitArray = BitFieldArray("CachedBitArray", "a").add([1]).add([2])
+        shared = (Struct("sharedStruct").addInt32("x", 3).addString("name", "shared")
+                  .add("bitArray", bitArray).finalize().cachePacked())
+        s = Struct("cacheTestStruct").addReference("first", shared).addInt8("y", 1)
+        data = pack(s)
+        self.assertEqual(shared.packCache.data, pack(shared, addPadding=False))
+        self.assertEqual(pack(s), data)
+        self.assertEqual(namedstruct.estimateSize(s), len(data))
+        # mutating a contained value invalidates the cache
+        bitArray.add([1000])
+        self.assertFalse(shared.packCache.isValid())
+        self.assertNotEqual(pack(s), data)
+        self.assertEqual(pack(s), s.pack(None)[0] + "\0" * namedstruct.getNumPaddingBytes(len(s.pack(None)[0])))
+    
+    def testDeduplicate(self):
+        import struct
+        s = (Struct("dedupStruct")
+             .addString("a", "hello")
+             .addString("b", "hello")
+             .addString("c", "other")
+             .addReferenceArray("array", ["other", "hello", "foo", "foo"]))
+        data = pack(s, addPadding=False, deduplicate=True)
+        # one "hello", one "foo" and the padding before the array are removed
+        self.assertEqual(len(data), len(pack(s, addPadding=False)) - 6 - 4 - 2)
+        a, b, c, array = struct.unpack_from("<4i", data)
+        self.assertEqual(a, b)
+        self.assertEqual(data[a:a + 6], "hello\0")
+        self.assertEqual(data[c:c + 6], "other\0")
+        # the array elements are relative to the array, so they can't refer to the strings before the array
+        elements = struct.unpack_from("<4i", data, array)
+        self.assertEqual(data[array + elements[0]:array + elements[0] + 6], "other\0")
+        self.assertEqual(elements[2], elements[3])
+        self.assertEqual(data[array + elements[3]:array + elements[3] + 4], "foo\0")
+        # references can only point forward
+        chain = Struct("dedupChain").addString("s", "abc").add("next", Struct("dedupChain").addString("s", "abc"))
+        self.assertEqual(pack(chain, deduplicate=True), pack(chain))
+        # identical structs in a reference array are shared, but different structs don't share their strings, since
+        # the later struct can't refer back to the string of the earlier one
+        items = [Struct("dedupItem").addString("name", ["alpha", "beta"][i % 2]).addInt32("value", i % 3)
+                 for i in range(12)]
+        s = Struct("dedupItems").addReferenceArray("items", items)
+        data = pack(s, addPadding=False, deduplicate=True)
+        # the array, and 6 distinct structs, each followed by its string, padded to 8 bytes to align the next struct,
+        # except for the last "beta"
+        self.assertEqual(len(data), 4 + 12 * 4 + 6 * (8 + 8) - 3)
+        array, = struct.unpack_from("<i", data)
+        elements = struct.unpack_from("<12i", data, array)
+        self.assertEqual(elements[6:], elements[:6])
+        self.assertEqual(len(set(elements)), 6)
+        for i, element in enumerate(elements):
+            name, value = struct.unpack_from("<2i", data, array + element)
+            self.assertEqual(value, i % 3)
+            position = array + element + name
+            self.assertGreater(name, 0)
+            self.assertEqual(data[position:data.index("\0", position)], ["alpha", "beta"][i % 2])
+    
+    def testAutoReferenceBitWidth(self):
+        import struct
+        s = (Struct("autoStruct")
+             .addString("near", "hello", referenceBitWidth=types.AUTO)
+             .addString("far", "x" * 300, referenceBitWidth=types.AUTO)
+             .addString("afterFar", "world", referenceBitWidth=types.AUTO)
+             .addReferenceArray("array", ["a", "b"], referenceBitWidth=types.AUTO))
+        data = pack(s, addPadding=False)
+        self.assertEqual([t.referenceBitWidth for t in s.type.types[:3]], [8, 8, 16])
+        self.assertEqual(s.values[3].targetValue.type.referenceBitWidth, 8)
+        self.assertEqual(data, s.pack(None)[0])
+        near, far = struct.unpack_from("<BB", data)
+        afterFar, = struct.unpack_from("<h", data, s.type.offsets[2])
+        self.assertEqual(data[near:near + 6], "hello\0")
+        self.assertEqual(data[afterFar:afterFar + 6], "world\0")
+        self.assertIn("uint8_t nearByteOffset", namedstruct.generateHeader(s))
+        self.assertEqual(namedstruct.estimateSize(s), len(pack(s)))
+        # only the trees and values that contain AUTO references are resolved, the other caches stay valid
+        cached = Struct("autoCached").addString("name", "cached").finalize().cachePacked()
+        plain = Struct("autoPlain").addReference("cached", cached)
+        self.assertFalse(plain.type.containsAuto)
+        pack(plain)
+        mixed = Struct("autoMixed").addReference("cached", cached).addString("name", "a", referenceBitWidth=types.AUTO)
+        self.assertTrue(mixed.type.containsAuto)
+        data = pack(mixed)
+        self.assertTrue(cached.packCache.isValid())
+        self.assertEqual(pack(mixed), data)
+        # the AUTO references of any array element are found
+        elements = [Struct("autoElement").addString("name", str(i), referenceBitWidth=types.AUTO if i == 2 else 32)
+                    .finalize() for i in range(3)]
+        self.assertTrue(Struct("autoArray").addArray("elements", elements).type.containsAuto)
+    
+    def testMinimizePadding(self):
+        def makeStruct():
+            element = Struct("paddedElement").addInt8("a", 1).addInt32("b", 2).addInt8("c", 3).finalize()
+            return (Struct("paddedStruct").addInt8("x", 1).addInt64("y", 2).addInt16("z", 3)
+                    .add("element", element).addInt8("w", 4))
+        s = makeStruct()
+        data = s.pack(None)[0]
+        self.assertEqual(namedstruct.minimizePadding(s), {"paddedElement": 4, "paddedStruct": 9})
+        self.assertEqual([name for name in s.type.names if not name.startswith("padding")],
+                         ["y", "element", "z", "x", "w"])
+        self.assertEqual(len(pack(s, addPadding=False)), len(data) - 4 - 9)
+        self.assertEqual(s.get("z"), 3)
+        # members of an earlier version keep their order
+        s = makeStruct()
+        namedstruct.minimizePadding(s, {"paddedStruct": ["x", "y"]})
+        self.assertEqual(s.type.names[:2], ["x", "padding0"])
+        self.assertEqual([name for name in s.type.names if not name.startswith("padding")],
+                         ["x", "y", "element", "z", "w"])
+        # in the order they are listed in
+        s = makeStruct()
+        namedstruct.minimizePadding(s, {"paddedStruct": ["y", "x"]})
+        self.assertEqual([name for name in s.type.names if not name.startswith("padding")],
+                         ["y", "x", "element", "z", "w"])
+        self.assertEqual(s.get("x"), 1)
+        with self.assertRaises(Exception):
+            makeStruct().minimizePadding(["v"])
+        # a struct with a shared type fails before any struct is reordered
+        schema = types.StructType("sharedElement").int8("a").int32("b").int8("c")
+        schema.finalize()
+        self.assertIsNotNone(schema.getRowFormat())
+        self.assertFalse(schema.shared)  # querying the format doesn't share the type
+        s = makeStruct().add("shared", schema.makeValue((1, 2, 3)))
+        names = list(s.type.names)
+        with self.assertRaises(Exception):
+            namedstruct.minimizePadding(s)
+        self.assertEqual(s.type.names, names)
+        with self.assertRaises(Exception):
+            namedstruct.minimizePadding(makeStruct(), {"paddedElement": ["v"]})
+        arraySchema = types.StructType("sharedArrayElement").int8("a").int32("b")
+        arraySchema.finalize()
+        arraySchema.makeArray([(1, 2)])
+        self.assertTrue(arraySchema.shared)
+    
+    def testPackOptimized(self):
+        import struct
+        s = (Struct("optimizedStruct")
+             .addInt8("a", 1)
+             .addInt32("b", 2)
+             .addString("name", "abcde")
+             .addReference("numbers", SimpleArray(types.INT32, [1, 2]))  # 2 bytes alignment after name
+             .addString("tiny", "x")
+             .addInt8("c", 3)
+             .addInt64("d", 4)
+             .addString("text", "too long for padding"))
+        data = pack(s, addPadding=False)
+        optimizedData, numReclaimedBytes = namedstruct.packOptimized(s, addPadding=False)
+        self.assertEqual(numReclaimedBytes, 2)
+        self.assertEqual(len(optimizedData), len(data) - 2)
+        name, = struct.unpack_from("<i", optimizedData, s.type.offsets[s.type.members["name"]])
+        tiny, = struct.unpack_from("<i", optimizedData, s.type.offsets[s.type.members["tiny"]])
+        self.assertEqual(optimizedData[name:name + 6], "abcde\0")
+        self.assertEqual(optimizedData[tiny:tiny + 2], "x\0")
+        self.assertEqual(tiny, name + 6)
+        text, = struct.unpack_from("<i", optimizedData, s.type.offsets[s.type.members["text"]])
+        self.assertEqual(optimizedData[text:text + 21], "too long for padding\0")
+        # the immediate data stays the same, including padding bytes
+        for i, value in enumerate(s.values):
+            if not isinstance(value, Reference):
+                offset = s.type.offsets[i]
+                width = s.type.types[i].getWidth()
+                self.assertEqual(optimizedData[offset:offset + width], data[offset:offset + width])
+        rows = Struct("optimizedRows").addArray("rows", [Struct("optimizedRow").addInt8("a", i).addInt32("b", i)
+                                                         .finalize() for i in range(3)]).addString("tiny", "ab")
+        optimizedData, numReclaimedBytes = namedstruct.packOptimized(rows, addPadding=False)
+        self.assertEqual(numReclaimedBytes, 0)
+        self.assertEqual(optimizedData, pack(rows, addPadding=False))
+    
+    def testBytesBlobs(self):
+        import array
+        import values
+        data = "\x92\x00\xff"
+        expected = pack(Struct("blobStruct").addBlob("blob", [0, 1, 0, 0, 1, 0, 0, 1] + [0] * 8 + [1] * 8))
+        for blob in [data, bytearray(data), memoryview(data), buffer(data), array.array('c', data),
+                     array.array('B', bytearray(data))]:
+            self.assertEqual(pack(Struct("blobStruct").addBlob("blob", blob)), expected)
+        try:
+            import numpy
+            self.assertEqual(pack(Struct("blobStruct").addBlob("blob", numpy.frombuffer(data, numpy.uint8))), expected)
+            with self.assertRaises(TypeError):
+                Blob(numpy.zeros(3, numpy.uint16))
+        except ImportError:
+            pass  # numpy is optional
+        self.assertEqual(pack(Struct("blobStruct").addBlob("blob", iter(Blob(data).getPythonValue()))), expected)
+        for blob in [array.array('H', [1, 2]), 146, object()]:
+            with self.assertRaises(TypeError):
+                Blob(blob)
+        self.assertEqual(list(Blob(bytearray(data)).getPythonValue()), list(Blob(data).getPythonValue()))
+        # blobs given as bytes are not copied
+        values.storeBlobStrings = False
+        try:
+            data = bytearray(data)
+            blob = Blob(data)
+            self.assertIs(blob.values, data)
+            self.assertFalse(any(b is data for b in values.blobStrings))
+        finally:
+            values.storeBlobStrings = True
+    
+    def testBitFieldArrayFromColumns(self):
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest("numpy is not installed")
+        columns = {"stop": numpy.arange(1000) % 300, "time": numpy.arange(1000) * 7, "flag": numpy.arange(1000) % 2}
+        rows = BitFieldArray("stopTimes", "flag", "stop", "time")
+        for i in range(1000):
+            rows.add([i % 2, i % 300, i * 7])
+        array = BitFieldArray.fromColumns("stopTimes", columns, fields=["flag", "stop", "time"])
+        self.assertEqual(len(array), 1000)
+        self.assertEqual(array.getFieldLengths(), rows.getFieldLengths())
+        self.assertEqual(array.get("time", 999), 6993)
+        self.assertEqual(array.pack()[0], rows.pack()[0])
+        self.assertEqual(array.pretty(), rows.pretty())
+        self.assertEqual(pack(Struct("columnStruct").addReference("array", array)),
+                         pack(Struct("columnStruct").addReference("array", rows)))
+        # adding rows turns the columns into entries
+        array.add([1, 2, 3])
+        rows.add([1, 2, 3])
+        self.assertEqual(array.pack()[0], rows.pack()[0])
+        self.assertRaises(Exception, BitFieldArray.fromColumns, "negative", {"a": numpy.array([-1])})
+    
+    def testBitFieldArrayExtend(self):
+        array = BitFieldArray("extendArray", "a", "blob")
+        self.assertEqual(array.getFieldLengths(), [0, 0])
+        array.extend(((i, Blob([1] * (i % 5))) for i in range(20)))
+        self.assertEqual(array.getFieldLengths(), [5, 4])
+        array.add(a=1000, blob=Blob("ab"))
+        self.assertEqual(array.getFieldLengths(), [10, 16])
+        self.assertEqual(len(array), 21)
+        self.assertRaises(Exception, array.extend, [(1,)])
+        # invalid entries don't add any entries, but invalidate cached packs
+        version = array.version
+        self.assertRaises(Exception, array.extend, [(2 ** 20, Blob([1] * 30)), (-1, Blob([]))])
+        self.assertEqual(array.getFieldLengths(), [10, 16])
+        self.assertEqual(len(array), 21)
+        self.assertNotEqual(array.version, version)
+    
+    def testNumericArrays(self):
+        import array
+        numbers = [0, -1, 5, 2 ** 31 - 1, -2 ** 31]
+        expected = pack(Struct("numericStruct").addArray("numbers", [Int(n, False, 32) for n in numbers]))
+        inputs = [numbers, array.array('i', numbers), array.array('l', numbers),
+                  "".join(types.INT32.pack(n) for n in numbers)]
+        try:
+            import numpy
+            inputs.append(numpy.array(numbers, dtype=numpy.int64))
+        except ImportError:
+            pass
+        for numberValues in inputs:
+            s = Struct("numericStruct").addInt32Array("numbers", numberValues)
+            self.assertEqual(pack(s), expected)
+            self.assertEqual(s.values[0].targetValue.getPythonValue(), numbers)
+        s = Struct("fixedNumericStruct").addUInt16Array("numbers", array.array('B', [1, 2]), fixedSize=3)
+        self.assertEqual(pack(s, addPadding=False), "\x01\x00\x02\x00\x00\x00")
+        self.assertEqual(s.values[0].pretty(), "[1, 2]")
+        self.assertRaises(Exception, Struct("numericStruct").addUInt8Array, "numbers", [256])
+        self.assertRaises(Exception, Struct("numericStruct").addUInt8Array, "numbers", array.array('i', [-1]))
+        self.assertRaises(Exception, Struct("numericStruct").addUInt64Array, "numbers", [1.5])
+    
+    def testSchema(self):
+        schema = types.StructType("schemaRow").int32("x").uint8("y").char("c").int16("z")
+        schema.finalize()
+        self.assertEqual(schema.getMemberNames(), ["x", "y", "c", "z"])
+        rows = [(i, i % 256, chr(65 + i % 26), -i) for i in range(100)]
+        expected = Struct("schemaStruct").addArray(
+            "rows", [Struct("schemaRow").addInt32("x", x).addUInt8("y", y).addChar("c", c).addInt16("z", z).finalize()
+                     for x, y, c, z in rows])
+        for array in [schema.makeArray(rows),
+                      schema.makeArray([dict(x=x, y=y, c=c, z=z) for x, y, c, z in rows]),
+                      SimpleArray(schema, [schema.makeValue(row) for row in rows])]:
+            s = Struct("schemaStruct").addReference("rows", array)
+            self.assertEqual(pack(s), pack(expected))
+            self.assertEqual(namedstruct.generateHeader(s), namedstruct.generateHeader(expected))
+        self.assertEqual([v.get("z") for v in schema.makeArray(rows).getPythonValue()], [-i for i in range(100)])
+        self.assertTrue(isinstance(schema.makeArray(rows), StructArray))
+        self.assertRaises(Exception, schema.makeArray, [(1, 256, "a", 0)])
+        self.assertRaises(Exception, types.StructType("mutableRow").int32("x").makeValue, [1])
+        # schemas with references create struct values
+        refSchema = types.StructType("refRow").int32("x").member("name", types.ReferenceType(types.NullType()))
+        refSchema.finalize()
+        array = refSchema.makeArray([(1, "a"), (2, None)])
+        self.assertEqual(array.getPythonValue()[0].get("name"), "a")
+    
+    def testTypeInterning(self):
+        self.assertTrue(Int(1).getType() is Int(2).getType() is types.INT32)
+        self.assertTrue(Char("a").getType() is types.CHAR)
+        target = Struct("internedTarget").addInt32("x", 1).finalize()
+        self.assertTrue(Reference(target).getType() is Reference(target).getType())
+        self.assertTrue(Reference(target, 16).getType() is not Reference(target).getType())
+        self.assertTrue(Reference(target, types.AUTO).getType() is not Reference(target, types.AUTO).getType())
+        self.assertTrue(SimpleArray(types.INT16, [1, 2]).getType() is SimpleArray(types.INT16, []).getType())
+        self.assertRaises(Exception, Reference(target).getType().setReferenceBitWidth, 16)
+        # cached unique names change with the reference bit width
+        refArray = ReferenceArray([target], referenceBitWidth=types.AUTO)
+        self.assertEqual(refArray.getType().getUniqueName(), "internedTargetRefArray")
+        refArray.setReferenceBitWidth(8)
+        self.assertEqual(refArray.getType().getUniqueName(), "internedTargetRef8Array")
+        self.assertEqual(refArray.getType().getHash(), hash("internedTargetRef8Array"))
+        # creating types doesn't invalidate cached names, only changing the width of a named type does
+        namesVersion = types.Type.namesVersion
+        for i in range(100):
+            Struct("uncachedNames").addReference("target", target, types.AUTO).add("array", ReferenceArray([target]))
+        refArray.setReferenceBitWidth(8)
+        self.assertEqual(types.Type.namesVersion, namesVersion)
+        refArray.setReferenceBitWidth(16)
+        self.assertEqual(refArray.getType().getUniqueName(), "internedTargetRef16Array")
+    
+    def testGetAllTypes(self):
+        structs = generateTests(quiet=True)
+        typeNames = [t.getUniqueName() for s in structs for t in s.getType().getAllContainedTypes()]
+        allTypes = namedstruct.getAllTypes([s.getType() for s in structs] * 3)
+        self.assertEqual(allTypes.keys(), list(collections.OrderedDict.fromkeys(typeNames)))
+        # roots with the same name but distinct types get merged
+        roots = [Struct("sharedRoot").addInt32("x", i).add("y", Struct("sharedChild").addInt8("z", i % 100).finalize())
+                 .finalize().getType() for i in range(1000)]
+        allTypes = namedstruct.getAllTypes(roots)
+        self.assertEqual(allTypes.keys(), ["int32_t", "int8_t", "sharedChild", "sharedRoot"])
+    
+    def testCompactStructs(self):
+        import struct
+        s = Struct("compactStruct").addInt8("a", -3).addInt32("b", 7).addChar("c", "x").add("d", "text").finalize()
+        self.assertEqual(s.values[:5], [-3, 3, 7, "x", 3])  # one padding count per gap
+        self.assertEqual(sorted(s.type.paddingIndices), [1, 4])
+        self.assertEqual(s.type.numPadBytes, 6)
+        self.assertEqual([s.get("a"), s.get("b"), s.get("c"), s.get("d")], [-3, 7, "x", "text"])
+        self.assertEqual(pack(s)[:12], struct.pack("<b3xic3x", -3, 7, "x"))
+        self.assertEqual(s.getContainedValues(), [s.values[5]])
+        memberValues = s.getMemberValues()
+        self.assertEqual(memberValues.keys(), ["a", "b", "c", "d"])
+        self.assertEqual([value.getPythonValue() for value in memberValues.values()[:3]], [-3, 7, "x"])
+        self.assertIs(memberValues["d"], s.values[5])
+        declaration = s.type.getDeclaration()
+        self.assertIn("padding0[3];", declaration)
+        self.assertIn("padding1[3];", declaration)
+        for value in [s, Int(1), s.values[5], s.type, types.INT32]:
+            self.assertFalse(hasattr(value, "__dict__"))
+    
+    def testPackFormat(self):
+        import packer
+        
+        class MemberPacker(packer.Packer):
+            recordsMembers = True  # packs every member on its own
+        
+        colorEnum = types.EnumType("PackFormatColor", types.UINT8, {"RED": 0, "GREEN": 1})
+        
+        def makeRecord(i):
+            return (Struct("packFormatRecord")
+                    .addInt8("a", -i)
+                    .addInt32("b", i * 1000)
+                    .addChar("c", chr(65 + i))
+                    .add("color", colorEnum.GREEN if i % 2 else colorEnum.RED)
+                    .add("bits", BitField("packFormatBits", 16).add("x", i % 4, 2).add("y", 5, 3))
+                    .addArray("numbers", [i, i + 1], fixedSize=3)
+                    .addInt16Array("moreNumbers", [i, -i], fixedSize=2)
+                    .add("name", String("n%d" % i, 4))
+                    .finalize())
+        
+        record = makeRecord(1)
+        packFormat = record.type.getPackFormat()
+        self.assertEqual(packFormat.struct.size, record.type.getWidth())
+        self.assertEqual(len(packFormat.valueIndices), 5)
+        self.assertEqual(packer.Packer().pack(record).getData(), MemberPacker().pack(record).getData())
+        self.assertEqual(record.pack()[0], MemberPacker().pack(record).getData())
+        s = Struct("packFormatStruct").addArray("records", [makeRecord(i) for i in range(10)]).finalize()
+        self.assertEqual(packer.Packer().pack(s).getData(), MemberPacker().pack(s).getData())
+        self.assertEqual(namedstruct.packOptimized(s)[0], pack(s))
+        self.assertEqual(Struct("referenceStruct").add("r", "text").finalize().type.getPackFormat(), None)
+        self.assertEqual(Struct("mutableStruct").addInt8("a", 1).type.getPackFormat(), None)
+    
+    def testDeepChain(self):
+        s = Struct("chainStruct").addInt32("value", 0).add("next", None)
+        for i in range(1, 10):
+            s = Struct("chainStruct").addInt32("value", i).add("next", s)
+        self.assertEqual(pack(s), s.pack(None)[0] + "\0" * 4)
+    
+    # deeper than the recursion limit, every tree walk has to use an explicit stack
+    def testDeeperThanRecursionLimit(self):
+        import sys
+        depth = 2 * sys.getrecursionlimit()
+        s = Struct("chainStruct").addInt32("value", 0).add("next", None)
+        for i in range(1, depth):
+            s = Struct("chainStruct").addInt32("value", i).add("next", s)
+        data = pack(s)
+        self.assertEqual(len(data), depth * 8 + 4)
+        self.assertEqual("".join(namedstruct.iterPack(s)), data)
+        self.assertEqual(namedstruct.estimateSize(s), len(data))
+        self.assertEqual(namedstruct.packOptimized(s)[0], data)
+        self.assertEqual(s.getImmediateDataSize(), 8)
+        self.assertEqual(len(namedstruct.getAllTypes([s.getType()])), 5)
+        self.assertEqual(s.getType().dotGraph().count("--"), 3 * depth)
+        array = ReferenceArray([String("end")])
+        for i in range(depth):
+            array = ReferenceArray([array])
+        self.assertTrue(array.pretty().endswith("]" * (depth + 1)))
+    
+    def testValidation(self):
+        import array
+        import values
+        schema = types.StructType("validatedStruct").int8("a").uint16("b")
+        schema.finalize()
+        self.assertRaises(Exception, schema.makeValue, (1, 70000))
+        try:
+            values.validation = values.DEFERRED
+            s = schema.makeValue((1, 70000))
+            self.assertRaisesRegexp(Exception, "member b of struct validatedStruct", pack, s)
+            self.assertRaisesRegexp(Exception, "member b of struct validatedStruct", s.pack)
+            structs = SimpleArray(schema, [schema.makeValue((1, 2)), s])
+            self.assertRaisesRegexp(Exception, "member b of struct validatedStruct", pack, structs)
+            self.assertRaisesRegexp(Exception, "element 1 of int8_t array", pack, SimpleArray(types.INT8, [1, 300]))
+            self.assertRaisesRegexp(Exception, "does not fit", values.NumericArray, types.INT8, [1, 300])
+            self.assertEqual(pack(schema.makeValue((1, 2))), pack(Struct("validatedStruct").addInt8("a", 1)
+                                                                  .addUInt16("b", 2).finalize()))
+            self.assertRaises(Exception, values.NumericArray, types.UINT8, array.array("i", [1, 300]))
+            # struct would truncate floats, they are rejected like with eager validation
+            for function in (lambda: schema.makeValue((1, 2.5)), lambda: Int(2.5), lambda: Int(2.0),
+                             lambda: SimpleArray(types.INT8, [1, 2.5]), lambda: values.NumericArray(types.INT8, [1.5]),
+                             lambda: schema.makeArray([(1, 2), (1, 2.5)])):
+                self.assertRaisesRegexp(Exception, "is not integral", function)
+            try:
+                import numpy
+            except ImportError:
+                return
+            self.assertRaises(Exception, values.NumericArray, types.UINT8, numpy.array([1, 300]))
+            values.validation = values.TRUSTED
+            self.assertEqual(len(values.NumericArray(types.UINT8, numpy.array([1, 300])).data), 2)
+        finally:
+            values.validation = values.EAGER
+
+
+class TestRead(unittest.TestCase):
+    def testReadMembers(self):
+        colorEnum = types.EnumType("ReadColor", types.UINT8, {"RED": 0, "GREEN": 1})
+        partyEnum = types.IntEnumType("ReadParty", {"LEFT": -1, "RIGHT": -2})
+        s = (Struct("readStruct")
+             .addInt8("a", -3)
+             .addUInt64("b", 2 ** 60)
+             .addChar("c", "!")
+             .add("color", colorEnum.GREEN)
+             .add("bits", BitField("readBits", 16).add("x", 5, 3).addSigned("y", -2, 4).addEnum("party",
+                                                                                               partyEnum.RIGHT))
+             .add("name", "hello")
+             .add("fixedName", String("fixed", 8))
+             .add("nested", Struct("readNested").addInt16("x", 7).add("label", "nested").finalize())
+             .add("numbers", [4, 5, 6])
+             .addArray("elements", [Struct("readElement").addInt8("x", i).add("label", str(i)).finalize()
+                                    for i in range(3)])
+             .addReferenceArray("strings", ["foo", None, "bar"], referenceBitWidth=16)
+             .add("bitArray", BitFieldArray("readBitArray", "a", "b").add([1, 300]).add([2, 0]).add([3, 7]))
+             .addBlob("blob", [1, 0, 1, 1, 0, 0, 0, 0, 1])
+             .add("nothing", None))
+        r = namedstruct.read(pack(s), s)
+        self.assertEqual((r.a, r.b, r.c), (-3, 2 ** 60, "!"))
+        self.assertTrue(r.color is colorEnum.GREEN)
+        self.assertEqual((r.bits.x, r.bits.y), (5, -2))
+        self.assertTrue(r.bits.party is partyEnum.RIGHT)
+        self.assertEqual(r.name.getString(), "hello")
+        self.assertEqual(r.fixedName.getString(), "fixed")
+        self.assertEqual(len(r.fixedName), 8)
+        self.assertEqual((r.nested.x, r.nested.label.getString()), (7, "nested"))
+        self.assertTrue(r.nested is r.nested)  # resolved members are cached
+        self.assertEqual(r.numbers[0:3], [4, 5, 6])
+        self.assertEqual([(r.elements[i].x, r.elements[i].label.getString()) for i in range(3)],
+                         [(0, "0"), (1, "1"), (2, "2")])
+        self.assertEqual([string and string.getString() for string in r.strings[0:3]], ["foo", None, "bar"])
+        self.assertEqual(r.bitArray.getNumFields(), 2)
+        self.assertEqual([(r.bitArray.get("a", i), r.bitArray.get("b", i)) for i in range(3)],
+                         [(1, 300), (2, 0), (3, 7)])
+        self.assertEqual([r.blob.readBits(i, 1) for i in range(9)], [1, 0, 1, 1, 0, 0, 0, 0, 1])
+        self.assertTrue(r.nothing is None)
+        self.assertEqual(r.getMemberNames(), s.getType().getMemberNames())
+    
+    # reads the primitive members and strings of all test structs
+    def testReadTestStructs(self):
+        for s in generateTests(quiet=True):
+            r = namedstruct.read(pack(s), s)
+            for name in s.getType().getMemberNames():
+                value = s.values[s.getType().members[name]]
+                if not isinstance(value, Value):
+                    self.assertEqual(r.get(name), value)
+                elif isinstance(value, Reference) and isinstance(value.targetValue, String):
+                    self.assertEqual(r.get(name).getString(), "".join(value.targetValue.values).rstrip("\0"))
+    
+    def testNumpyDtype(self):
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest("numpy is not installed")
+        colorEnum = types.EnumType("DtypeColor", types.UINT8, {"RED": 0, "GREEN": 1})
+        
+        def makeRecord(i):
+            return (Struct("dtypeRecord")
+                    .addInt8("a", -i)
+                    .addUInt64("b", 2 ** 40 + i)
+                    .addChar("c", "xyz"[i % 3])
+                    .add("color", colorEnum.GREEN if i % 2 else colorEnum.RED)
+                    .add("bits", BitField("dtypeBits", 16).add("x", i % 4, 2).add("y", 5, 3))
+                    .addArray("numbers", [i, i + 1], fixedSize=3)
+                    .add("nested", Struct("dtypeNested").addInt16("z", 3 * i).finalize())
+                    .finalize(8))
+        
+        records = [makeRecord(i) for i in range(5)]
+        recordType = records[0].getType()
+        dtype = recordType.toNumpyDtype()
+        self.assertEqual(dtype.itemsize, recordType.getWidth())
+        self.assertEqual(dtype.names, ("a", "b", "c", "color", "bits", "numbers", "nested"))
+        s = Struct("dtypeRoot").addInt32("numRecords", len(records)).addArray("records", records)
+        r = namedstruct.read(pack(s), s)
+        array = r.records.toNumpy(r.numRecords)
+        self.assertEqual(list(array["a"]), [-i for i in range(5)])
+        self.assertEqual(list(array["b"]), [2 ** 40 + i for i in range(5)])
+        self.assertEqual(list(array["c"]), ["x", "y", "z", "x", "y"])
+        self.assertEqual(list(array["color"]), [0, 1, 0, 1, 0])
+        self.assertEqual(list(array["bits"]), [record.values[recordType.members["bits"]].packToInt() for record in records])
+        self.assertEqual(array["numbers"].tolist(), [[i, i + 1, 0] for i in range(5)])
+        self.assertEqual(list(array["nested"]["z"]), [3 * i for i in range(5)])
+        self.assertEqual(array.tostring(), pack(SimpleArray(recordType, records), addPadding=False))
+        self.assertRaises(Exception, Struct("dtypeString").add("s", "string").finalize().getType().toNumpyDtype)
+    
+    def testDecodeBitFieldArray(self):
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest("numpy is not installed")
+        import reader
+        rows = [(i % 3, i * 7919 % 100000, i % 2) for i in range(1000)]
+        array = BitFieldArray("decodedArray", "flag", "stop", "bit").addAll(rows)
+        columns = reader.decodeBitFieldArray(array.pack()[0], array)
+        self.assertEqual(columns.keys(), ["flag", "stop", "bit"])
+        self.assertEqual(zip(*[list(column) for column in columns.values()]), rows)
+        columns = reader.decodeBitFieldArray(array.pack()[0], array.getType(), 123, 456)
+        self.assertEqual(zip(*[list(column) for column in columns.values()]), rows[123:456])
+        # inside a packed struct, with a blob field
+        array = BitFieldArray("blobArray", "a", "blob").add([3, Blob([1, 0, 1])]).add([1, 0]).add([0, 2 ** 20])
+        s = Struct("decodedStruct").addInt8("x", 1).add("array", array)
+        r = namedstruct.read(pack(s), s)
+        self.assertEqual([list(column) for column in r.array.decode(0, 3).values()], [[3, 1, 0], [5, 0, 2 ** 20]])
+        self.assertEqual([list(column) for column in r.array.decode(1, 2).values()], [[1], [0]])
+    
+    def testReadFile(self):
+        import os
+        import tempfile
+        s = Struct("chainStruct").addInt32("value", 0).add("next", None)
+        for i in range(1, 100):
+            s = Struct("chainStruct").addInt32("value", i).add("next", s)
+        handle, filename = tempfile.mkstemp()
+        try:
+            with os.fdopen(handle, "wb") as f:
+                namedstruct.packToFile(s, f)
+            r = namedstruct.readFile(filename, s)
+            values = []
+            while r is not None:
+                values.append(r.value)
+                r = r.next
+            self.assertEqual(values, range(99, -1, -1))
+        finally:
+            os.remove(filename)
+
+    
+    def testCppBitFieldArrayDecoders(self):
+        import cpphelper
+        if not cpphelper.hasCompiler():
+            self.skipTest("g++ is not installed")
+        rows = [(i % 3, i * 7919 % 100000, 0, i * 104729 % 2 ** 31) for i in range(1000)]
+        array = BitFieldArray("CppArray", "flag", "stop", "zero", "time").addAll(rows)
+        s = Struct("cppRoot").addInt32("numEntries", len(rows)).add("array", array)
+        main = cpphelper.loadDataSource + """
+#include "root.h"
+
+static void print(const uint32_t* values, int n) {
+    for (int i = 0; i < n; i++) printf("%u ", values[i]);
+    printf("\\n");
+}
+
+int main(int argc, char** argv) {
+    std::vector<uint32_t> data = loadData(argv[1]);
+    const cppTest::CppArray* array = ((const cppTest::cppRoot*)(&data[0]))->getArray();
+    const int n = ((const cppTest::cppRoot*)(&data[0]))->numEntries;
+    std::vector<uint32_t> out(4 * n);
+    array->decodeRows(0, n, &out[0]);
+    print(&out[0], 4 * n);
+    array->decodeRows(123, 456, &out[0]);
+    print(&out[0], 4 * (456 - 123));
+    array->decodeStop(7, 777, &out[0]);
+    print(&out[0], 777 - 7);
+    array->decodeTime(0, n, &out[0]);
+    print(&out[0], n);
+    array->decodeZero(0, n, &out[0]);
+    print(&out[0], n);
+    for (int i = 0; i < n; i++) out[i] = array->getTime(i);
+    print(&out[0], n);
+    return 0;
+}
+"""
+        output = cpphelper.compileAndRun({"root.h": namedstruct.generateHeader(s, namespace="cppTest"),
+                                          "bits.h": namedstruct.generateRuntime(),
+                                          "data": pack(s),
+                                          "main.cpp": main},
+                                         ["data"])
+        lines = [[int(value) for value in line.split()] for line in output.splitlines()]
+        self.assertEqual(lines[0], [value for row in rows for value in row])
+        self.assertEqual(lines[1], [value for row in rows[123:456] for value in row])
+        self.assertEqual(lines[2], [row[1] for row in rows[7:777]])
+        self.assertEqual(lines[3], [row[3] for row in rows])
+        self.assertEqual(lines[4], [0] * len(rows))
+        self.assertEqual(lines[5], lines[3])
+    
+    def testCppRuntime(self):
+        import cpphelper
+        import random
+        if not cpphelper.hasCompiler():
+            self.skipTest("g++ is not installed")
+        generator = random.Random(0)
+        bits = [generator.randint(0, 1) for _ in range(777)]
+        rows = [(i % 5, generator.randint(0, 2 ** 31 - 1), generator.randint(0, 3)) for i in range(300)]
+        s = (Struct("cppRuntimeRoot")
+             .addInt32("numBits", len(bits))
+             .addInt32("numEntries", len(rows))
+             .add("array", BitFieldArray("RuntimeArray", "a", "b", "c").addAll(rows))
+             .addBlob("blob", bits))  # last, so reads at its end hit the end of the file
+        main = cpphelper.loadDataSource + """
+#include "root.h"
+
+int main(int argc, char** argv) {
+    std::vector<uint32_t> data = loadData(argv[1]);
+    const cppTest::cppRuntimeRoot* root = (const cppTest::cppRuntimeRoot*)(&data[0]);
+    const char* blob = root->getBlob();
+    const int numBits = root->numBits;
+    for (int bitOffset = 0; bitOffset < numBits; bitOffset++) {
+        for (int n = 0; n <= 32 && bitOffset + n <= numBits; n++) printf("%u ", namedstruct::readBits(blob, bitOffset, n));
+    }
+    printf("\\n");
+    for (int bitOffset = 0; bitOffset + 64 <= numBits; bitOffset += 13) {
+        printf("%llu ", (unsigned long long)namedstruct::readBits64(blob, bitOffset, 64));
+        printf("%llu ", (unsigned long long)namedstruct::readBits64(blob, bitOffset, 45));
+    }
+    printf("\\n");
+    std::vector<uint8_t> unpacked(numBits);
+    namedstruct::unpackBits(blob, 0, numBits, &unpacked[0]);
+    for (int i = 0; i < numBits; i++) printf("%u ", unpacked[i]);
+    printf("\\n");
+    std::vector<uint32_t> out(numBits);
+    namedstruct::readBitsArray(blob, 5, 7, (numBits - 5) / 7, &out[0]);
+    for (int i = 0; i < (numBits - 5) / 7; i++) printf("%u ", out[i]);
+    printf("\\n");
+    const cppTest::RuntimeArray* array = root->getArray();
+    for (int f = 0; f < 3; f++) {
+        namedstruct::readBitsStrided(array, array->getBitOffsetByFieldIndex(f, 0), array->getNumBitsByFieldIndex(f),
+                                     array->bitFieldArrayEntryBits, root->numEntries, &out[0]);
+        for (int i = 0; i < root->numEntries; i++) printf("%u %u ", out[i], array->getByFieldIndex(f, i));
+        printf("\\n");
+    }
+    std::vector<uint32_t> rows(3 * root->numEntries);
+    array->decodeRows(0, root->numEntries, &rows[0]);
+    for (int i = 0; i < 3 * root->numEntries; i++) printf("%u ", rows[i]);
+    printf("\\n");
+    array->decode(1, 2, 100, root->numEntries, &rows[0]);
+    for (int i = 0; i < 2 * (root->numEntries - 100); i++) printf("%u ", rows[i]);
+    printf("\\n");
+    std::vector<uint64_t> wide(numBits);
+    for (int n = 55; n <= 64; n++) {  // up to 57 bits are read with the window, wider values one by one
+        namedstruct::readBitsArray(blob, numBits % n, n, numBits / n, &wide[0]);  // up to the end of the data
+        for (int i = 0; i < numBits / n; i++) printf("%llu ", (unsigned long long)wide[i]);
+        printf("\\n");
+    }
+    return 0;
+}
+"""
+        # use the address sanitizer where available, to make sure nothing is read beyond the padded data
+        flags = ["-O2", "-fsanitize=address"]
+        if not cpphelper.supportsFlags(flags):
+            flags = ["-O2"]
+        output = cpphelper.compileAndRun({"root.h": namedstruct.generateHeader(s, namespace="cppTest"),
+                                          "bits.h": namedstruct.generateRuntime(),
+                                          "data": pack(s),
+                                          "main.cpp": main},
+                                         ["data"], flags=flags)
+        
+        def getValue(bitOffset, numBits):
+            return sum(bit << i for i, bit in enumerate(bits[bitOffset:bitOffset + numBits]))
+        
+        lines = [[int(value) for value in line.split()] for line in output.splitlines()]
+        self.assertEqual(lines[0], [getValue(bitOffset, n)
+                                    for bitOffset in range(len(bits)) for n in range(33) if bitOffset + n <= len(bits)])
+        self.assertEqual(lines[1], [value for bitOffset in range(0, len(bits) - 63, 13)
+                                    for value in (getValue(bitOffset, 64), getValue(bitOffset, 45))])
+        self.assertEqual(lines[2], bits)
+        self.assertEqual(lines[3], [getValue(5 + 7 * i, 7) for i in range((len(bits) - 5) / 7)])
+        for f in range(3):
+            self.assertEqual(lines[4 + f], [row[f] for row in rows for _ in range(2)])
+        self.assertEqual(lines[7], [value for row in rows for value in row])
+        self.assertEqual(lines[8], [value for row in rows[100:] for value in row[1:]])
+        for i, n in enumerate(range(55, 65)):
+            self.assertEqual(lines[9 + i], [getValue(len(bits) % n + n * j, n) for j in range(len(bits) / n)])
+        # a bits.h from before the runtime was versioned is refused
+        unversioned = namedstruct.generateRuntime().replace("#define NAMEDSTRUCT_BITS_VERSION", "#define UNVERSIONED")
+        with self.assertRaises(Exception):
+            cpphelper.compileAndRun({"root.h": namedstruct.generateHeader(s, namespace="cppTest"),
+                                     "bits.h": unversioned,
+                                     "main.cpp": main})
+
+
+def runTests():
+    suite = unittest.TestSuite([unittest.TestLoader().loadTestsFromTestCase(TestPack),
+                                unittest.TestLoader().loadTestsFromTestCase(TestRead)])
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -1,6 +1,7 @@
 import collections
 import numbers
 import struct
+import weakref
 
 import bithelper
 import constants
@@ -10,6 +11,8 @@ import values
 
 # given two types, merges them, but if one of them is NullType, returns the other type
 def mergeTypes(typeA, typeB):
+    if typeA is typeB:
+        return typeA
     if isinstance(typeA, NullType):
         return typeB
     if isinstance(typeB, NullType):
@@ -33,27 +36,62 @@ def _typeEqualAssert(typeA, typeB, *keys):
 
 
 class Type(object):
+    __slots__ = ("name", "cachedUniqueName", "cachedNamesVersion", "__weakref__")
+    
+    # whether values of the type may contain references with bit width AUTO. Types that contain other types store
+    # it when they are created or their members are added, so types that get changed after they were added to
+    # another type don't update it.
+    containsAuto = False
+    
+    namesVersion = 0  # incremented whenever cached unique names may become invalid, i.e. reference bit widths change
+    
     # the type name that is used in C to represent this type
     def __init__(self):
         self.name = None
+        self.cachedUniqueName = None
+        self.cachedNamesVersion = -1
     
     def getName(self):
         return self.name
     
-    # a unique name to refer to the type, for most types it's just the c name
+    # a unique name to refer to the type. It's computed by computeUniqueName only once, until Type.namesVersion changes
     def getUniqueName(self):
+        if self.cachedNamesVersion != Type.namesVersion:
+            self.cachedUniqueName = self.computeUniqueName()
+            self.cachedNamesVersion = Type.namesVersion
+        return self.cachedUniqueName
+    
+    # invalidates the cached unique names of all types, if the unique name of this type was cached, since it and the
+    # names of the types containing it change. Types whose name was never asked for can't be part of a cached name.
+    def invalidateUniqueNames(self):
+        if self.cachedNamesVersion != -1:
+            Type.namesVersion += 1
+    
+    # for most types the unique name is just the c name, types with nested names override this
+    def computeUniqueName(self):
         return self.getName()
     
+    # returns a hash of the structure of the type, i.e. of the unique name (which caches its own hash)
+    def getHash(self):
+        return hash(self.getUniqueName())
+    
     # returns all the types that are directly referred/stored in this type (i.e. returns child types)
     def getContainedTypes(self):
         return []
     
     # returns, a generater of all the types that are referred/stored in this type (i.e. returns the whole type tree)
+    # contained types come before the types containing them. Uses an explicit stack, so that deep type trees
+    # (e.g. long chains of structs referring to the next struct) don't hit the recursion limit.
     def getAllContainedTypes(self):
-        for t in self.getContainedTypes():
-            for t2 in t.getAllContainedTypes():
-                yield t2
-        yield self
+        stack = [(self, iter(self.getContainedTypes()))]
+        while stack:
+            containingType, containedTypes = stack[-1]
+            for t in containedTypes:
+                stack.append((t, iter(t.getContainedTypes())))
+                break
+            else:
+                stack.pop()
+                yield containingType
     
     # returns a c++ declaration of the type. If the type does not need to be declared (e.g. int32_t), returns None
     def getDeclaration(self, indent=stringhelper.indent, includeSetters=False):
@@ -80,6 +118,11 @@ class Type(object):
     def hasEqualMethod(self):
         return False
     
+    # returns the numpy dtype that stores values of this type like they are packed, only for types with a fixed
+    # layout. Requires numpy.
+    def toNumpyDtype(self):
+        raise Exception("type " + repr(self) + " has no numpy dtype")
+    
     def assertValueHasType(self, aValue):
         raise Exception("cannot verify whether " + repr(aValue) + " matches type " + repr(self))
     
@@ -101,20 +144,28 @@ class Type(object):
     def merge(self, other):
         raise Exception("unimplemented for " + repr(self))
     
+    # turns a python value into a namedstruct.Value of this type
+    def makeValue(self, aValue):
+        raise Exception("cannot create a value of type %s from %s" % (repr(self), repr(aValue)))
+    
     def dotGraph(self, parent=None):
-        result = ""
+        lines = []
         if parent is None:
-            result += "graph {\n"
-        else:
-            result += "%s -- %s;\n" % (parent.getName(), self.getName())
-        for childType in self.getContainedTypes():
-            result += childType.dotGraph(self)
+            lines.append("graph {\n")
+        stack = [(parent, self)]
+        while stack:
+            parentType, childType = stack.pop()
+            if parentType is not None:
+                lines.append("%s -- %s;\n" % (parentType.getName(), childType.getName()))
+            stack.extend((childType, t) for t in reversed(childType.getContainedTypes()))
         if parent is None:
-            result += "}"
-        return result
+            lines.append("}")
+        return "".join(lines)
 
 
 class PrimitiveType(Type):
+    __slots__ = ()
+    
     def getAlignment(self):  # by default the primtive type width=alignment
         return self.getWidth()
     
@@ -130,6 +181,16 @@ class PrimitiveType(Type):
         formatChar = self.getFormatChar()
         return struct.pack(f + formatChar, aPythonValue)
     
+    # returns a string representing the sequence of primitives, using a single struct call
+    def packArray(self, aPythonValues):
+        formatChar = self.getFormatChar()
+        if formatChar == "c":
+            data = "".join(aPythonValues)
+            if len(data) != len(aPythonValues):
+                raise struct.error("char format requires a string of length 1")
+            return data
+        return struct.pack("<" + str(len(aPythonValues)) + formatChar, *aPythonValues)
+    
     def hasEqualMethod(self):
         return True
     
@@ -142,6 +203,8 @@ class PrimitiveType(Type):
 
 
 class IntType(PrimitiveType):
+    __slots__ = ("unsigned", "bitWidth")
+    
     formats = {8: 'b', 16: 'h', 32: 'i', 64: 'q'}  # map from bit width -> format chars
     
     def __init__(self, unsigned, bitWidth):
@@ -161,12 +224,13 @@ class IntType(PrimitiveType):
                 if self.unsigned else
                 (2 ** (self.bitWidth - 1) > aValue >= -2 ** (self.bitWidth - 1))):
             raise Exception(str(aValue) + " does not fit in " + self.name)
-        self.pack(aValue)
     
     def getWidth(self):
         return self.bitWidth / 8
     
     def merge(self, other):
+        if other is self:
+            return self
         _typeEqualAssert(self, other, "name")
         return self
     
@@ -174,8 +238,18 @@ class IntType(PrimitiveType):
         f = IntType.formats[self.bitWidth]
         return f.upper() if self.unsigned else f.lower()
     
+    def toNumpyDtype(self):
+        import numpy  # numpy is optional, it's only required for dtypes
+        return numpy.dtype("<" + ("u" if self.unsigned else "i") + str(self.getWidth()))
+    
     def makeValue(self, aValue):
         return values.Int(aValue, self.unsigned, self.bitWidth)
+    
+    # returns the shared int type with the given signedness and bit width
+    @staticmethod
+    def get(unsigned, bitWidth):
+        intType = _intTypes.get((unsigned, bitWidth))
+        return intType if intType is not None else IntType(unsigned, bitWidth)
 
 
 INT8 = IntType(False, 8)
@@ -187,16 +261,23 @@ UINT16 = IntType(True, 16)
 UINT32 = IntType(True, 32)
 UINT64 = IntType(True, 64)
 PADDING = INT8
+_intTypes = dict(((t.unsigned, t.bitWidth), t) for t in [INT8, INT16, INT32, INT64, UINT8, UINT16, UINT32, UINT64])
 
 
 # chars are used to represent strings and blobs, and are unsigned 1 byte values
 class CharType(IntType):
+    __slots__ = ()
+    
     def __init__(self):
         IntType.__init__(self, False, 8)
         self.name = "char"
     
     def getFormatChar(self):
-        return "s"
+        return "c"
+    
+    def toNumpyDtype(self):
+        import numpy  # numpy is optional, it's only required for dtypes
+        return numpy.dtype("S1")
     
     def assertValueHasType(self, aValue):
         if not isinstance(aValue, basestring) or len(aValue) != 1:
@@ -210,13 +291,66 @@ class CharType(IntType):
 CHAR = CharType()
 
 
+# the padding bytes of a gap between struct members, or at the end of a struct. Structs have one padding member per
+# gap, whose width is the number of padding bytes (see StructType.addPadding). It's declared as an array of PADDING.
+class PaddingType(Type):
+    __slots__ = ("numBytes",)
+    
+    interned = {}  # number of bytes -> shared padding type
+    
+    def __init__(self, numBytes):
+        super(PaddingType, self).__init__()
+        self.numBytes = numBytes
+        self.name = PADDING.getName()
+    
+    # returns the shared padding type with the given number of bytes
+    @staticmethod
+    def get(numBytes):
+        paddingType = PaddingType.interned.get(numBytes)
+        if paddingType is None:
+            paddingType = PaddingType.interned[numBytes] = PaddingType(numBytes)
+        return paddingType
+    
+    def computeUniqueName(self):
+        return "padding[%d]" % self.numBytes
+    
+    def getDeclarationNameSuffix(self):
+        return "[%d]" % self.numBytes
+    
+    def getAlignment(self):
+        return 1
+    
+    def getWidth(self):
+        return self.numBytes
+    
+    def getFormatString(self):
+        return "%dx" % self.numBytes
+    
+    def isImmediate(self):
+        return True
+    
+    # padding is stored as the number of bytes, and packed as zeros
+    def pack(self, numBytes):
+        return "\0" * self.numBytes
+    
+    def assertValueHasType(self, aValue):
+        if aValue != self.numBytes:
+            raise Exception("%s is not the number of bytes of %s" % (repr(aValue), repr(self)))
+    
+    def merge(self, other):
+        _typeEqualAssert(self, other, "numBytes")
+        return self
+
+
 # bit fields
 class BitFieldType(Type):
+    __slots__ = ("dataType", "fields", "fieldArray", "bitWidth")
+    
     Field = collections.namedtuple("FieldType", ["name", "type", "bitWidth"])
     
     def __init__(self, name, totalBitWidth=32):
         super(BitFieldType, self).__init__()
-        self.dataType = IntType(True, totalBitWidth)
+        self.dataType = IntType.get(True, totalBitWidth)
         self.name = name
         self.fields = {}  # field name -> member index
         # self.fieldWidths = []
@@ -278,6 +412,10 @@ class BitFieldType(Type):
     def getNumUsedBits(self):
         return sum(f.bitWidth for f in self.fieldArray)
     
+    # bit fields are stored as their unsigned integer, the fields are not decoded
+    def toNumpyDtype(self):
+        return self.dataType.toNumpyDtype()
+    
     def hasEqualMethod(self):
         return True
     
@@ -357,6 +495,8 @@ class BitFieldType(Type):
 
 # a type that represents null/none values
 class NullType(Type):
+    __slots__ = ()
+    
     def __init__(self):
         super(NullType, self).__init__()
     
@@ -371,19 +511,59 @@ class NullType(Type):
         return self
 
 
+NULL = NullType()
+
+
+# the reference bit width that will select the smallest bit width that fits the referred data when packing
+AUTO = "auto"
+
+
 # represents references - they are stored as integer byte offsets to another object, so contain that target type
 # the target type may be None, if it is unknown.
 # A reference type to None may be merged with any other reference type, if the reference bit width is the same.
 # if the reference bit width is 8, will use unsigned references, otherwise the references are signed.
+# if the reference bit width is AUTO, the reference uses 32 bits until the bit width gets resolved by
+# layout.resolveReferenceBitWidths.
+# Reference types created with ReferenceType.get are shared, unless their bit width is AUTO.
 class ReferenceType(Type):
+    __slots__ = ("auto", "targetType", "shared", "referenceBitWidth", "referenceType", "containsAuto")
+    
     formats = {8: True, 16: False, 32: False}  # bit width -> isUnsigned?
+    interned = weakref.WeakValueDictionary()  # (id(target type), reference bit width) -> shared reference type
     
     def __init__(self, targetType, referenceBitWidth=32):
         super(ReferenceType, self).__init__()
-        self.referenceBitWidth = referenceBitWidth
+        self.auto = (referenceBitWidth == AUTO)
+        if self.auto:
+            referenceBitWidth = 32
         self.targetType = targetType
-        self.referenceType = IntType(ReferenceType.formats[referenceBitWidth], referenceBitWidth)
+        self.containsAuto = self.auto or (targetType is not None and targetType.containsAuto)
+        self.shared = False
+        self.referenceBitWidth = None
+        self.setReferenceBitWidth(referenceBitWidth)
+    
+    # returns the shared reference type to the target type, or a new one if the bit width is AUTO
+    @staticmethod
+    def get(targetType, referenceBitWidth=32):
+        if referenceBitWidth == AUTO:
+            return ReferenceType(targetType, referenceBitWidth)
+        key = (id(targetType), referenceBitWidth)
+        referenceType = ReferenceType.interned.get(key)
+        if referenceType is None:
+            referenceType = ReferenceType(targetType, referenceBitWidth)
+            referenceType.shared = True
+            ReferenceType.interned[key] = referenceType
+        return referenceType
+    
+    def setReferenceBitWidth(self, referenceBitWidth):
+        if self.shared:
+            raise Exception("cannot change the bit width of the shared reference type " + repr(self))
+        if referenceBitWidth == self.referenceBitWidth:
+            return
+        self.referenceBitWidth = referenceBitWidth
+        self.referenceType = IntType.get(ReferenceType.formats[referenceBitWidth], referenceBitWidth)
         self.name = self.referenceType.name
+        self.invalidateUniqueNames()
     
     def __repr__(self):
         return self.getUniqueName()
@@ -405,13 +585,35 @@ class ReferenceType(Type):
     def getNameSuffix(self):
         return "ByteOffset"
     
+    # creates a reference to the value, which may be a python value (see values.getValue), or None
+    def makeValue(self, aValue):
+        if aValue is None:
+            return values.Reference(None, self.getBitWidthArgument(), targetType=self.targetType)
+        return values.Reference(values.getValue(aValue), self.getBitWidthArgument())
+    
+    # returns the reference bit width that creates references like this one, i.e. AUTO for automatic widths
+    def getBitWidthArgument(self):
+        return AUTO if self.auto else self.referenceBitWidth
+    
+    # returns the largest byte offset that can be stored in a reference of this type
+    def getMaxOffset(self):
+        return ReferenceType.getMaxOffsetForBitWidth(self.referenceBitWidth)
+    
+    @staticmethod
+    def getMaxOffsetForBitWidth(referenceBitWidth):
+        if ReferenceType.formats[referenceBitWidth]:
+            return 2 ** referenceBitWidth - 1
+        return 2 ** (referenceBitWidth - 1) - 1
+    
     def merge(self, other):
+        if other is self:
+            return self
         _typeEqualAssert(self, other)
         self.referenceType.merge(other.referenceType)
-        return ReferenceType(mergeTypes(self.targetType, other.targetType),
-                             self.referenceBitWidth)
+        return ReferenceType.get(mergeTypes(self.targetType, other.targetType),
+                                 self.referenceBitWidth)
     
-    def getUniqueName(self):
+    def computeUniqueName(self):
         return ("ref" + str(self.referenceBitWidth)
                 + "->"
                 + (self.targetType.getUniqueName() if self.targetType is not None else "0"))
@@ -430,6 +632,8 @@ class ReferenceType(Type):
 
 
 class ArrayType(Type):
+    __slots__ = ("elementType", "containsAuto")
+    
     def __init__(self, elementType):
         super(ArrayType, self).__init__()
         if elementType.isMutable():
@@ -438,6 +642,7 @@ class ArrayType(Type):
             raise Exception("cannot use type " + elementType + " for elements in array - width undefined")
         assert ((-elementType.getWidth()) % elementType.getAlignment() == 0)
         self.elementType = elementType
+        self.containsAuto = elementType.containsAuto  # also set by values.Array if any element contains AUTO
     
     def getElementType(self):
         return self.elementType
@@ -447,8 +652,12 @@ class ArrayType(Type):
 
 
 # array types
-# simple arrays are c arrays
+# simple arrays are c arrays, simple array types created with SimpleArrayType.get are shared
 class SimpleArrayType(ArrayType):
+    __slots__ = ("fixedSize", "suffix", "alignment")
+    
+    interned = weakref.WeakValueDictionary()  # (id(element type), fixed size, byte alignment) -> shared array type
+    
     # a fixed size of None means array type doesn't have a fixed size
     # we can override alignment (in bytes)
     def __init__(self, elementType, fixedSize=None, byteAlignment=None):
@@ -465,7 +674,17 @@ class SimpleArrayType(ArrayType):
             if byteAlignment < elementType.getAlignment():
                 raise Exception("simple array type alignment has to be larger or equal the alignment of the elements")
     
-    def getUniqueName(self):
+    # returns the shared simple array type with the given element type, fixed size and alignment
+    @staticmethod
+    def get(elementType, fixedSize=None, byteAlignment=None):
+        key = (id(elementType), fixedSize, byteAlignment)
+        arrayType = SimpleArrayType.interned.get(key)
+        if arrayType is None:
+            arrayType = SimpleArrayType(elementType, fixedSize, byteAlignment)
+            SimpleArrayType.interned[key] = arrayType
+        return arrayType
+    
+    def computeUniqueName(self):
         name = self.elementType.getUniqueName() + self.suffix
         if self.alignment != self.elementType.getAlignment():
             name += "@" + str(self.alignment)
@@ -490,35 +709,56 @@ class SimpleArrayType(ArrayType):
         # TODO - allow overriding the equality test expression, thus allowing equal where self.fixedSize != None
         return False
     
+    # fixed size arrays are numpy sub arrays
+    def toNumpyDtype(self):
+        import numpy  # numpy is optional, it's only required for dtypes
+        if self.fixedSize is None:
+            raise Exception("non-fixed array " + repr(self) + " has no numpy dtype")
+        return numpy.dtype((self.elementType.toNumpyDtype(), (self.fixedSize,)))
+    
     def merge(self, other):
+        if other is self:
+            return self
         _typeEqualAssert(self, other, "fixedSize", "alignment")
         t1 = self.elementType
         t2 = other.elementType
-        if t1.getUniqueName() != t2.getUniqueName():
-            return SimpleArrayType(t1.merge(t2),  # we only have to merge if the unique type names mismatch
-                                   self.fixedSize)
+        if t1 is not t2 and t1.getUniqueName() != t2.getUniqueName():
+            return SimpleArrayType.get(t1.merge(t2),  # we only have to merge if the unique type names mismatch
+                                       self.fixedSize)
         return self
 
 
 # array of references - modelled as a struct
 class ReferenceArrayType(ArrayType):
+    __slots__ = ("fixedSize", "referenceBitWidth")
+    
     infix = {8: "8", 16: "16", 32: ""}  # infix used to denote the array
     
     def __init__(self, elementType, fixedSize=None, referenceBitWidth=32):
-        ArrayType.__init__(self, ReferenceType(elementType, referenceBitWidth))
-        self.referenceBitWidth = referenceBitWidth
+        ArrayType.__init__(self, ReferenceType(elementType, referenceBitWidth))  # not shared, the bit width may change
         self.fixedSize = fixedSize
-        arraySuffix = "Ref" + ReferenceArrayType.infix[referenceBitWidth] + "Array"
-        if fixedSize is not None:
-            arraySuffix = "Size" + str(fixedSize) + arraySuffix
-        self.name = elementType.getName() + arraySuffix
-        self.uniqueName = elementType.getUniqueName() + arraySuffix
+        self.referenceBitWidth = self.elementType.referenceBitWidth
+        self.name = self.elementType.targetType.getName() + self.getArraySuffix()
+    
+    def setReferenceBitWidth(self, referenceBitWidth):
+        if referenceBitWidth == self.referenceBitWidth:
+            return
+        self.elementType.setReferenceBitWidth(referenceBitWidth)
+        self.referenceBitWidth = referenceBitWidth
+        self.name = self.elementType.targetType.getName() + self.getArraySuffix()
+        self.invalidateUniqueNames()
+    
+    def getArraySuffix(self):
+        arraySuffix = "Ref" + ReferenceArrayType.infix[self.referenceBitWidth] + "Array"
+        if self.fixedSize is not None:
+            arraySuffix = "Size" + str(self.fixedSize) + arraySuffix
+        return arraySuffix
     
     def getCointainedTypes(self):
         return [self.elementType.targetType]
     
-    def getUniqueName(self):
-        return self.uniqueName
+    def computeUniqueName(self):
+        return self.elementType.targetType.getUniqueName() + self.getArraySuffix()
     
     def isImmediate(self):
         return self.fixedSize
@@ -530,10 +770,12 @@ class ReferenceArrayType(ArrayType):
             raise Exception("non-fixed array has no width")
     
     def merge(self, other):
+        if other is self:
+            return self
         _typeEqualAssert(self, other, "fixedSize", "referenceBitWidth")
         t1 = self.elementType.targetType
         t2 = other.elementType.targetType
-        if t1.getUniqueName() != t2.getUniqueName():
+        if t1 is not t2 and t1.getUniqueName() != t2.getUniqueName():
             return ReferenceArrayType(mergeTypes(t1, t2),  # we only have to merge if the unique type names mismatch
                                       self.fixedSize)
         return self
@@ -567,10 +809,12 @@ class ReferenceArrayType(ArrayType):
 
 # Create an integer enum with the given name and mapping. Just calls the constructor of EnumType
 def IntEnumType(name, mapping, bitWidth=32, unsigned=False):
-    return EnumType(name, IntType(unsigned=unsigned, bitWidth=bitWidth), mapping)
+    return EnumType(name, IntType.get(unsigned, bitWidth), mapping)
 
 
 class EnumType(Type):
+    __slots__ = ("enumType", "mapping", "values", "uniqueName", "_hasNegativeValues")
+    
     # Create an enum with the given type name, underlying type and name->value mapping.
     # The underlying type should be a primitive type (integer, char)
     # the mapping should either be a dictionary (names will be sorted), or a list of name->value pairs
@@ -595,11 +839,11 @@ class EnumType(Type):
             self.mapping[name] = namedstructValue
             enumValue = values.EnumValue(self, name)  # the enum value constructor requres the self.mapping value
             self.values[name] = enumValue
-            setattr(self, name, enumValue)
     
     def __getitem__(self, key):
         return self.values[key]
     
+    # enum values are accessible as attributes, e.g. Color.RED
     def __getattr__(self, item):
         return self.values[item]
     
@@ -648,6 +892,10 @@ class EnumType(Type):
     def hasEqualMethod(self):
         return True
     
+    # enums are stored as the python values of their underlying type
+    def toNumpyDtype(self):
+        return self.getEnumType().toNumpyDtype()
+    
     def assertValueHasType(self, aValue):
         raise Exception("cannot verify whether " + repr(aValue) + " matches type " + repr(self))
     
@@ -678,6 +926,15 @@ class EnumType(Type):
 
 
 class StructType(Type, constants.AddConstantFunctions):
+    __slots__ = ("constantPool", "mutable", "alignment", "members", "names", "offsets", "types", "numPadBytes",
+                 "paddingIndices", "byteAlignment", "shared", "rowFormat", "packFormat", "containsAuto")
+    
+    # a struct.Struct that packs the member values of a struct value, see getPackFormat. memberIndices are the
+    # indices of the members that are passed to the struct.Struct (all but padding), or None if there is no padding.
+    # valueIndices are the indices into those arguments of the members that are stored as Value objects, which are
+    # passed as their getPackArgument().
+    PackFormat = collections.namedtuple("PackFormat", ["struct", "memberIndices", "valueIndices"])
+    
     def __init__(self, name):
         super(StructType, self).__init__()
         self.constantPool = constants.ConstantPool()
@@ -689,6 +946,30 @@ class StructType(Type, constants.AddConstantFunctions):
         self.offsets = []  # list of member offsets
         self.types = []  # list of member types
         self.numPadBytes = 0  # the total number of padding bytes in struct
+        self.paddingIndices = set()  # the member indices of the padding members, one for every gap
+        self.byteAlignment = None  # the byte alignment used to finalize the struct
+        self.shared = False  # whether values were created from this type, see makeValue and makeArray
+        self.rowFormat = None  # struct.Struct that packs a row of member values, see getRowFormat
+        self.packFormat = None  # PackFormat, or False if the struct can't be packed in one call, see getPackFormat
+        self.containsAuto = False
+    
+    # removes all members, so that they can be added again. Constants are kept.
+    def removeMembers(self):
+        if self.shared:
+            raise Exception("cannot change the members of struct type %s, it is shared by the values created from it"
+                            % self.name)
+        self.mutable = True
+        self.alignment = 1
+        self.members = {}
+        self.names = []
+        self.offsets = []
+        self.types = []
+        self.numPadBytes = 0
+        self.paddingIndices = set()
+        self.byteAlignment = None
+        self.rowFormat = None
+        self.packFormat = None
+        self.containsAuto = False
     
     def addConstant(self, name, value):  # should return self
         self.constantPool.addConstant(name, value)
@@ -697,18 +978,15 @@ class StructType(Type, constants.AddConstantFunctions):
     def getConstantPool(self):
         return self.constantPool
     
-    # will add padding bytes until the current struct is aligned to the given byte alignment
+    # will add a padding member until the current struct is aligned to the given byte alignment
     # returns how many padding bytes were added
     def addPadding(self, byteAlignment):
-        # perform alignment
-        padding = 0
-        currentWidth = self.getCurrentWidth()
-        if currentWidth > 0:
-            while (-currentWidth) % byteAlignment != 0:
-                self.addMember("paddingByte" + str(self.numPadBytes), PADDING)
-                self.numPadBytes += 1
-                currentWidth += 1
-                padding += 1
+        padding = (-self.getCurrentWidth()) % byteAlignment
+        if padding > 0:
+            name = "padding" + str(len(self.paddingIndices))
+            self.paddingIndices.add(len(self.names))
+            self.addMember(name, PaddingType.get(padding))
+            self.numPadBytes += padding
         return padding
     
     # returns how many padding bytes were added before adding the member
@@ -727,25 +1005,156 @@ class StructType(Type, constants.AddConstantFunctions):
         self.offsets.append(self.getCurrentWidth())
         self.types.append(memberType)
         self.alignment = max(self.alignment, memberType.getAlignment())
+        if memberType.containsAuto:
+            self.containsAuto = True
         return padding
     
+    # adds a member, returns self - allows building struct types like values, i.e. as a schema:
+    #   StructType("foo").int32("x").uint8("y").char("c")
+    def member(self, name, memberType):
+        self.addMember(name, memberType)
+        return self
+    
+    def int8(self, name):
+        return self.member(name, INT8)
+    
+    def int16(self, name):
+        return self.member(name, INT16)
+    
+    def int32(self, name):
+        return self.member(name, INT32)
+    
+    def int64(self, name):
+        return self.member(name, INT64)
+    
+    def uint8(self, name):
+        return self.member(name, UINT8)
+    
+    def uint16(self, name):
+        return self.member(name, UINT16)
+    
+    def uint32(self, name):
+        return self.member(name, UINT32)
+    
+    def uint64(self, name):
+        return self.member(name, UINT64)
+    
+    def char(self, name):
+        return self.member(name, CHAR)
+    
     # returns the byte offset,type,name for the member at the given index
     def getMember(self, index):
         return self.offsets[index], self.types[index], self.names[index]
     
+    # returns the names of all members, except padding
+    def getMemberNames(self):
+        return [name for i, name in enumerate(self.names) if i not in self.paddingIndices]
+    
+    # creates a values.Struct of this type, which has to be finalized. The value may be a dictionary of
+    # member name -> value, or a sequence of the member values in order (excluding padding).
+    # All created values share this type, so it can't be changed afterwards.
+    def makeValue(self, aValue):
+        if self.mutable:
+            raise Exception("cannot create values of struct type %s, it is not finalized" % self.name)
+        self.shared = True
+        return values.Struct.fromType(self, aValue)
+    
+    # creates an array of structs of this type, which has to be finalized. The rows may be dictionaries or
+    # sequences, like the values for makeValue. If all members are primitives, the rows are packed directly,
+    # without creating struct values (see values.StructArray). The array shares this type, like the values.
+    def makeArray(self, rows, fixedSize=None):
+        if self.mutable:
+            raise Exception("cannot create arrays of struct type %s, it is not finalized" % self.name)
+        self.shared = True
+        if self.getRowFormat() is not None:
+            return values.StructArray(self, rows, fixedSize)
+        return values.SimpleArray(self, [self.makeValue(row) for row in rows], fixedSize)
+    
+    # returns a struct.Struct that packs the values of all members except padding, if the struct type is
+    # finalized and all members are primitives, otherwise returns None
+    def getRowFormat(self):
+        if self.rowFormat is None and not self.mutable:
+            formatString = "<"
+            for i, memberType in enumerate(self.types):
+                if i in self.paddingIndices:
+                    formatString += memberType.getFormatString()
+                elif isinstance(memberType, IntType):
+                    formatString += memberType.getFormatChar()
+                else:
+                    return None
+            self.rowFormat = struct.Struct(formatString)
+        return self.rowFormat
+    
+    # returns a PackFormat that packs the immediate data of struct values of this type in a single call, if the
+    # struct type is finalized and all members have a fixed layout: primitives, enums, bit fields and fixed size
+    # arrays of primitives. Otherwise returns None. Padding is packed as pad bytes, without an argument.
+    def getPackFormat(self):
+        if self.mutable:
+            return None
+        if self.packFormat is None:
+            formatString = "<"
+            memberIndices = []
+            valueIndices = []
+            for i, memberType in enumerate(self.types):
+                if i in self.paddingIndices:
+                    formatString += memberType.getFormatString()
+                    continue
+                memberIndices.append(i)
+                if isinstance(memberType, PrimitiveType):
+                    formatString += memberType.getFormatChar()
+                    continue
+                valueIndices.append(len(memberIndices) - 1)
+                if isinstance(memberType, EnumType):
+                    formatString += memberType.getEnumType().getFormatChar()
+                elif isinstance(memberType, BitFieldType):
+                    formatString += memberType.dataType.getFormatChar()
+                elif (isinstance(memberType, SimpleArrayType) and memberType.fixedSize is not None
+                      and isinstance(memberType.elementType, PrimitiveType)):
+                    formatString += str(memberType.getWidth()) + "s"
+                else:
+                    self.packFormat = False
+                    return None
+            if len(memberIndices) == len(self.types):
+                memberIndices = None
+            self.packFormat = StructType.PackFormat(struct.Struct(formatString), memberIndices, valueIndices)
+        return self.packFormat or None
+    
     def getWidth(self):
         if self.mutable:
             raise Exception("cannot ask the width of non-finished struct type " + repr(self))
         return self.getCurrentWidth()
     
     def hasEqualMethod(self):
-        return len(self.members) > 0 and all(t.hasEqualMethod() for t in self.types)
+        return len(self.members) > 0 and all(t.hasEqualMethod() for t in self.getContainedTypes())
     
     def getCurrentWidth(self):
         if len(self.offsets) == 0:
             return 0
         return self.offsets[-1] + self.types[-1].getWidth()
     
+    # returns a numpy structured dtype with a field for every member (except padding bytes) at the offset of the
+    # member, and the width of the struct as item size. The struct type has to be finalized, and all members must
+    # have a numpy dtype: primitives, enums, bit fields (as their integer), fixed size arrays of those, and
+    # structs of those. Requires numpy.
+    def toNumpyDtype(self):
+        import numpy  # numpy is optional, it's only required for dtypes
+        if self.mutable:
+            raise Exception("cannot create numpy dtype of non-finished struct type " + repr(self))
+        names = []
+        formats = []
+        offsets = []
+        for i, memberType in enumerate(self.types):
+            if i in self.paddingIndices:
+                continue
+            try:
+                formats.append(memberType.toNumpyDtype())
+            except Exception as e:
+                raise Exception("cannot create numpy dtype of struct type %s, member %s: %s"
+                                % (self.name, self.names[i], e))
+            names.append(str(self.names[i]))
+            offsets.append(self.offsets[i])
+        return numpy.dtype({"names": names, "formats": formats, "offsets": offsets, "itemsize": self.getWidth()})
+    
     # this will finalize the definition of this struct. The Struct may never grow in size
     # from this point on, otherwise it will become incompatible. Reserved elements may be added
     # to reserve space for future additions. After finalizing, the struct may have a fixed
@@ -755,6 +1164,7 @@ class StructType(Type, constants.AddConstantFunctions):
             raise Exception("cannot finalize empty struct")
         paddingBytes = self.addPadding(byteAlignment)
         self.mutable = False
+        self.byteAlignment = byteAlignment
         return paddingBytes
     
     def isImmediate(self):
@@ -764,10 +1174,12 @@ class StructType(Type, constants.AddConstantFunctions):
     def getAlignment(self):
         return self.alignment
     
-    def getContainedTypes(self):
-        return list(self.types)
+    def getContainedTypes(self):  # padding is declared by the struct itself
+        return [memberType for i, memberType in enumerate(self.types) if i not in self.paddingIndices]
     
     def merge(self, other):
+        if other is self:
+            return self
         _typeEqualAssert(self, other, "name", "mutable", "names")
         # TODO - merge constant pools
         # go through and check if the unique names are the same - in that case we can just return self
@@ -775,7 +1187,7 @@ class StructType(Type, constants.AddConstantFunctions):
         for i, name in enumerate(self.names):
             t1 = self.types[i]
             t2 = other.types[i]
-            if t1.getUniqueName() != t2.getUniqueName():
+            if t1 is not t2 and t1.getUniqueName() != t2.getUniqueName():
                 equal = False
                 break
         if equal:
@@ -784,11 +1196,13 @@ class StructType(Type, constants.AddConstantFunctions):
         for i, name in enumerate(self.names):
             t1 = self.types[i]
             t2 = other.types[i]
-            if t1.getUniqueName != t2.getUniqueName():
+            if t1 is not t2 and t1.getUniqueName() != t2.getUniqueName():
                 result.addMember(name, t1.merge(t2))  # we only have to merge if the unique type names mismatch
             else:
                 result.addMember(name, t1)
         result.mutable = self.mutable
+        result.paddingIndices = set(self.paddingIndices)
+        result.numPadBytes = self.numPadBytes
         result.constantPool = self.constantPool  # FIXME - This is a hack! Properly deal with cosntant pools!
         return result
     
@@ -829,8 +1243,9 @@ class StructType(Type, constants.AddConstantFunctions):
         if len(functions) > 0:
             result = result + functions[:-len(indent)]
         
-        # add equal
+        # add equal, padding is always zero
         if self.hasEqualMethod():
+            comparedNames = [(i, name) for i, name in enumerate(self.names) if i not in self.paddingIndices]
             result += """{indent}
             {indent}bool operator==(const {name}& other) const {{
             {indent}{indent}return {prefix}{comparisonExpression}{postfix};
@@ -841,12 +1256,12 @@ class StructType(Type, constants.AddConstantFunctions):
             {indent}}}
             """.format(name=self.getName(),
                        indent=indent,
-                       prefix="(    " if len(self.names) > 1 else "",
-                       postfix=")" if len(self.names) > 1 else "",
+                       prefix="(    " if len(comparedNames) > 1 else "",
+                       postfix=")" if len(comparedNames) > 1 else "",
                        comparisonExpression=(("\n{i}{i}        and ".format(i=indent))
                                              .join("{name}{suffix} == other.{name}{suffix}"
                                                    .format(name=n, suffix=self.types[i].getNameSuffix())
-                                                   for i, n in enumerate(self.names))))
+                                                   for i, n in comparedNames)))
         # finish
         result = result + "} " + self.getName() + ";"
         return result
@@ -854,6 +1269,8 @@ class StructType(Type, constants.AddConstantFunctions):
 
 # a special struct type, an array of bitfield values
 class BitFieldArrayType(Type):
+    __slots__ = ("fields",)
+    
     def __init__(self, name, fields):
         super(BitFieldArrayType, self).__init__()
         self.name = name
@@ -913,7 +1330,30 @@ class BitFieldArrayType(Type):
 {indent}{indent}const int nextBitOffset = ((uint16_t*)(this))[2+fieldIndex];
 {indent}{indent}const int bitOffset = thisBitOffset + elementIndex*bitFieldArrayEntryBits;
 {indent}{indent}return namedstruct::readBits(this, bitOffset, nextBitOffset-thisBitOffset);
-{indent}}}""".format(indent=stringhelper.indent)
+{indent}}}
+{indent}
+{indent}/** decodes numFields consecutive fields, starting with the field with the given field index, of the elements
+{indent}    begin..end (excl.) into out, element by element, i.e. the field with field index fieldIndex + f of element i
+{indent}    is stored at out[(i-begin)*numFields + f]. Assumes the fields are present, and have <=32 bits. All the
+{indent}    decoders of this use it, it reads the bits with namedstruct::readBitRows. */
+{indent}inline void decode(int fieldIndex, int numFields, int begin, int end, uint32_t* out) const {{
+{indent}{indent}const uint16_t* bitOffsets = ((uint16_t*)(this)) + 1 + fieldIndex;
+{indent}{indent}namedstruct::readBitRows(this, bitOffsets[0] + begin*bitFieldArrayEntryBits, bitFieldArrayEntryBits,
+{indent}{indent}                         bitOffsets, numFields, end - begin, out);
+{indent}}}
+{indent}
+{indent}/** decodes the field with the given field index of the elements begin..end (excl.) into out,
+{indent}    assuming it is present, and assuming it has <=32 bits. */
+{indent}inline void decodeByFieldIndex(int fieldIndex, int begin, int end, uint32_t* out) const {{
+{indent}{indent}decode(fieldIndex, 1, begin, end, out);
+{indent}}}
+{indent}
+{indent}/** decodes all {numFields} fields of the elements begin..end (excl.) into out, element by element, i.e. the
+{indent}    field with field index f of element i is stored at out[(i-begin)*{numFields} + f]. Assumes all fields are
+{indent}    present, and have <=32 bits. */
+{indent}inline void decodeRows(int begin, int end, uint32_t* out) const {{
+{indent}{indent}decode(0, {numFields}, begin, end, out);
+{indent}}}""".format(indent=stringhelper.indent, numFields=len(self.fields))
         # by name accessors:
         for i, field in enumerate(self.fields):
             if i == len(self.fields) - 1:
@@ -947,6 +1387,11 @@ class BitFieldArrayType(Type):
 {indent}/** returns the value of the field {field} at the given index, assuming it has <= 31 bits, or the default the field is not present. */
 {indent}inline uint32_t get{Field}OrDefault(int index, int defaultValue = 0) const {{
 {indent}{indent}return has{Field}() ? get{Field}(index) : defaultValue;
+{indent}}}
+{indent}
+{indent}/** decodes the field {field} of the elements begin..end (excl.) into out, assuming it is present, and assuming it has <=32 bits */
+{indent}inline void decode{Field}(int begin, int end, uint32_t* out) const {{
+{indent}{indent}decodeByFieldIndex({i}, begin, end, out);
 {indent}}}""".format(i=i, field=field, indent=stringhelper.indent, nextBitOffset=nextBitOffset,
                      Field=stringhelper.capitalizeFirst(field))
         
@@ -1,13 +1,39 @@
 import array
+import collections
 import numbers
+import struct
+import sys
 
 import bithelper
 import constants
+import layout
 import namedstruct
+import packer
 import stringhelper
 import types
 
 
+# validation policies for the python values of primitives, see 'validation'
+EAGER = "eager"  # values are checked when they are created
+DEFERRED = "deferred"  # value ranges are checked by struct in bulk when they are packed, only the python types of
+#                        the values are checked when they are created, numpy arrays are range checked vectorized
+TRUSTED = "trusted"  # values are not checked, e.g. numpy arrays are converted without range checks
+# the validation policy. Errors found while packing name the struct and member, or the array element.
+validation = EAGER
+
+# the types of python integers, struct packs values of other types (e.g. floats) by truncating them
+_integralTypes = frozenset((int, long, bool))
+
+
+# checks the python values for the deferred validation, like the eager validation does, but only if they aren't all
+# python integers. Integer ranges are checked by struct when packing, but struct silently truncates other numbers.
+def _assertDeferredValues(valueType, pythonValues):
+    if isinstance(valueType, types.CharType) or set(map(type, pythonValues)) <= _integralTypes:
+        return  # struct rejects anything but chars for chars
+    for value in pythonValues:
+        valueType.assertValueHasType(value)
+
+
 # given a python object, will return a reasonable Value for it
 # Value   -> returns the argument
 # int     -> int32 value
@@ -45,22 +71,92 @@ def getArrayValue(arrayValues, fixedSize=None):
 
 
 class Value(object):
+    __slots__ = ("type", "packCache")
+    
     def __init__(self, valueType):
         self.type = valueType
+        self.packCache = None  # a packer.PackCache, if caching of the packed data is enabled
     
     def getType(self):
         return self.type
     
+    # returns all the values that are directly referred/stored in this value
+    def getContainedValues(self):
+        return []
+    
+    # returns whether values may still be added to this value, mutable values have a version
+    # that gets incremented on every change
+    def isMutable(self):
+        return False
+    
+    # returns whether this is the null value, without computing the python value (which may be expensive)
+    def isNull(self):
+        return False
+    
+    # enables caching the packed data of this value, so that packing it again (e.g. as part of another struct)
+    # just reuses the data. The cache is invalidated when any mutable value contained in this value changes.
+    # returns self
+    def cachePacked(self):
+        if self.packCache is None:
+            self.packCache = packer.PackCache()
+        return self
+    
     # returns a tuple of strings, the immediate data, and the offseted data, which is assumed to start at dataOffset
     # the caller has to ensure proper alignment of the immediate data 
     # but the function will ensure alignment of the offseted data
     def pack(self, dataOffset=None):
         raise Exception()
     
+    # appends the immediate data to the packer, references will be stored relative to the position base
+    # by default a placeholder is appended, which gets overwritten by packReferred
+    def packImmediate(self, packer, base):
+        packer.appendZeros(self.getImmediateDataSize())
+    
+    # appends the referred data to the packer, the immediate data has been written at the given position
+    # by default uses pack to get both immediate and referred data
+    def packReferred(self, packer, position, base):
+        immediate, referred = self.pack(packer.getPosition() - base)
+        packer.writeAt(position, immediate)
+        packer.append(referred)
+    
+    # whether packReferred may append any data
+    @staticmethod
+    def hasReferredData():
+        return True
+    
     def getPythonValue(self):  # will return a python value, basically what was used to create this
         raise Exception()
     
+    # returns a readable string of the value. Values whose string contains the strings of other values implement
+    # getPrettyChildren and prettyFromChildren instead, so that deep value trees are walked with an explicit stack
     def pretty(self):
+        children = self.getPrettyChildren()
+        if children is None:
+            raise Exception("unimplemented for " + repr(self))
+        frames = [(self, iter(children), [])]
+        while True:
+            value, children, results = frames[-1]
+            for child in children:
+                grandChildren = child.getPrettyChildren()
+                if grandChildren is None:
+                    results.append(child.pretty())
+                else:
+                    frames.append((child, iter(grandChildren), []))
+                    break
+            else:
+                frames.pop()
+                result = value.prettyFromChildren(results)
+                if len(frames) == 0:
+                    return result
+                frames[-1][2].append(result)
+    
+    # returns the values whose pretty strings are part of the pretty string of this value, or None if pretty
+    # doesn't use the pretty strings of other values
+    def getPrettyChildren(self):
+        return None
+    
+    # returns the pretty string of this value, given the pretty strings of getPrettyChildren
+    def prettyFromChildren(self, childResults):
         raise Exception("unimplemented for " + repr(self))
     
     def getLiteral(self):
@@ -68,14 +164,22 @@ class Value(object):
     
     def getImmediateDataSize(self):
         return self.type.getWidth()
+    
+    # returns the argument for the struct.Struct that packs a struct containing this value (see
+    # types.StructType.getPackFormat), only for values with a fixed layout
+    def getPackArgument(self):
+        raise Exception("cannot pack " + repr(self) + " with a struct format")
 
 
 # primitve value
 class PrimitiveValue(Value):
+    __slots__ = ("pythonValue",)
+    
     def __init__(self, valueType, pythonValue):
         Value.__init__(self, valueType)
         self.pythonValue = pythonValue
-        valueType.assertValueHasType(pythonValue)
+        if validation == EAGER or (validation == DEFERRED and type(pythonValue) not in _integralTypes):
+            valueType.assertValueHasType(pythonValue)
     
     @staticmethod
     def hasFixedWidth():
@@ -89,14 +193,24 @@ class PrimitiveValue(Value):
     
     def pack(self, dataOffset=None):
         return self.type.pack(self.pythonValue), ""
+    
+    def packImmediate(self, packer, base):
+        packer.append(self.type.pack(self.pythonValue))
+    
+    def packReferred(self, packer, position, base):
+        pass
+    
+    @staticmethod
+    def hasReferredData():
+        return False
 
 
 # integer value
 class Int(PrimitiveValue):
+    __slots__ = ()
+    
     def __init__(self, intValue, unsigned=False, bitWidth=32):
-        valueType = types.IntType(unsigned, bitWidth)
-        valueType.assertValueHasType(intValue)
-        PrimitiveValue.__init__(self, valueType, intValue)
+        PrimitiveValue.__init__(self, types.IntType.get(unsigned, bitWidth), intValue)
     
     def getLiteral(self):
         return str(self.getPythonValue())
@@ -104,17 +218,23 @@ class Int(PrimitiveValue):
 
 # padding byte
 class Padding(Int):
+    __slots__ = ()
+    
     def __init__(self):
         Int.__init__(self, 0, True, 8)
+    
+    def packImmediate(self, packer, base):
+        packer.appendZeros(1)  # part of the struct, unlike the padding appended by packer.appendPadding
 
 
 # a single char
 class Char(PrimitiveValue):
+    __slots__ = ()
+    
     def __init__(self, char):
         assert (isinstance(char, basestring))
         assert (len(char) == 1)
-        charType = types.CharType()
-        PrimitiveValue.__init__(self, charType, char)
+        PrimitiveValue.__init__(self, types.CHAR, char)
     
     def getLiteral(self):
         return stringhelper.literalFromString(self.getPythonValue(), quote="'")
@@ -122,9 +242,12 @@ class Char(PrimitiveValue):
 
 # an integer that acts as a bit field
 class BitField(Value):
+    __slots__ = ("values", "version")
+    
     def __init__(self, name, bitWidth=32):
         super(BitField, self).__init__(types.BitFieldType(name, bitWidth))
         self.values = []
+        self.version = 0
     
     def add(self, name, value, bitWidth=1):
         if not (0 <= value < 2 ** bitWidth):
@@ -132,6 +255,7 @@ class BitField(Value):
                             % (self.type.name, name, value, bitWidth))
         self.type.add(name, bitWidth)
         self.values.append(value)
+        self.version += 1
         return self
     
     def addSigned(self, name, value, bitWidth):
@@ -140,17 +264,22 @@ class BitField(Value):
                             % (self.type.name, name, value, bitWidth))
         self.type.addSigned(name, bitWidth)
         self.values.append(value)
+        self.version += 1
         return self
     
     def addEnum(self, name, enumValue):  # TODO: ,numBits=None,signed=None):
         self.type.addEnum(name, enumValue.getType())
         self.values.append(enumValue)
+        self.version += 1
         return self
     
     @staticmethod
     def hasFixedWidth():
         return True
     
+    def isMutable(self):
+        return True
+    
     def getPythonValue(self):
         return self
     
@@ -188,6 +317,19 @@ class BitField(Value):
         intPacked = self.packToInt()
         return Int(intPacked, True, self.type.bitWidth).pack(dataOffset)
     
+    def packImmediate(self, packer, base):
+        packer.append(self.type.dataType.pack(self.packToInt()))
+    
+    def getPackArgument(self):
+        return self.packToInt()
+    
+    def packReferred(self, packer, position, base):
+        pass
+    
+    @staticmethod
+    def hasReferredData():
+        return False
+    
     def __repr__(self):
         return (
             self.pretty()
@@ -202,18 +344,25 @@ class BitField(Value):
 
 
 class Null(Value):
+    __slots__ = ()
+    
     def __init__(self):
-        Value.__init__(self, types.NullType())
+        Value.__init__(self, types.NULL)
     
     def pretty(self):
         return "<NULL>"
     
     def getPythonValue(self):
         return None
+    
+    def isNull(self):
+        return True
 
 
 # reference value
 class Reference(Value):
+    __slots__ = ("targetValue",)
+    
     # a target of None is allowed - in that case (and only that case) target type may be set
     def __init__(self, targetValue, referenceBitWidth=32, targetType=None):
         """:type targetValue: any"""
@@ -223,50 +372,75 @@ class Reference(Value):
         if targetValue is None:
             targetValue = Null()
         targetValue = getValue(targetValue)
-        Value.__init__(self, types.ReferenceType(targetValue.type, referenceBitWidth=referenceBitWidth))
+        Value.__init__(self, types.ReferenceType.get(targetValue.type, referenceBitWidth))
         self.targetValue = targetValue
     
-    def pretty(self):
-        return ("->" +
-                (self.targetValue.pretty().replace("\n", stringhelper.indent + "\n")
-                 if self.targetValue is not None else
-                 "None"))
+    def getPrettyChildren(self):
+        return [self.targetValue]
+    
+    def prettyFromChildren(self, childResults):
+        return "->" + childResults[0].replace("\n", stringhelper.indent + "\n")
     
     def getPythonValue(self):
         return self.targetValue.getPythonValue()
     
+    def getContainedValues(self):
+        return [self.targetValue]
+    
+    def setReferenceBitWidth(self, referenceBitWidth):
+        self.type.setReferenceBitWidth(referenceBitWidth)
+    
     def pack(self, dataOffset=None):
         if dataOffset is None:
             raise Exception("cannot pack reference without a data offset (is the reference not contained in a struct?)")
-        if self.targetValue.getPythonValue() is None:
+        if self.targetValue.isNull():
             return self.type.referenceType.pack(0), ""
         else:
             # add padding bytes until data offset is aligned with target type
             padding = ((-dataOffset) % self.type.targetType.getAlignment())
             packedReference = self.type.referenceType.pack(dataOffset + padding)
-            packedData = "\x00" * padding + namedstruct.pack(self.targetValue, addPadding=False)
+            packedData = "\x00" * padding + packer.Packer().pack(self.targetValue).getData()
             return packedReference, packedData
+    
+    def packImmediate(self, packer, base):
+        packer.appendReference(self, base)
+    
+    def packReferred(self, packer, position, base):
+        packer.packReferenceTarget(self, position, base)
 
 
 # all the array-like values
 class Array(Value):
+    __slots__ = ("elementsAreValueObjects", "values")
+    
     def __init__(self, arrayType, values):
         Value.__init__(self, arrayType)
         # check correctness on values - either incoming values are python values or Value objects
         self.elementsAreValueObjects = (len(values) > 0 and isinstance(values[0], Value))
-        for v in values:
-            if self.elementsAreValueObjects:
+        if self.elementsAreValueObjects:
+            for v in values:
                 assert (isinstance(v, Value))
-                arrayType.getElementType().merge(v.getType())
-            else:
+                if v.getType() is not arrayType.getElementType():  # values created from a schema share the type
+                    arrayType.getElementType().merge(v.getType())
+                    if v.getType().containsAuto:  # the merged element type may not contain the AUTO references
+                        arrayType.containsAuto = True
+        elif validation == EAGER:
+            for v in values:
                 arrayType.getElementType().assertValueHasType(v)
+        elif validation == DEFERRED:
+            _assertDeferredValues(arrayType.getElementType(), values)
         self.values = values
     
     def getPythonValue(self):
         return self.values
     
+    def getContainedValues(self):
+        return self.values if self.elementsAreValueObjects else []
+    
     # will pack the elements
     def pack(self, dataOffset=None, elementOffsetsRelativeToElement=True):
+        if not self.elementsAreValueObjects:
+            return self.packPythonValues(), ""
         if dataOffset is None:
             dataOffset = self.getImmediateDataSize()
         immediateData = []
@@ -289,27 +463,98 @@ class Array(Value):
         offsetedString = "".join(offsetedData)
         return immediateString, offsetedString
     
+    # appends the elements, followed by zero bytes up to the immediate data size (for fixed size arrays)
+    def packImmediate(self, packer, base, elementOffsetsRelativeToElement=True):
+        start = packer.getPosition()
+        if self.elementsAreValueObjects:
+            for value in self.values:
+                packer.packImmediate(value,
+                                     base + (packer.getPosition() - start
+                                             if elementOffsetsRelativeToElement else
+                                             0))  # offset is relative to element
+        else:
+            packer.append(self.packPythonValues())
+        packer.appendZeros(self.getImmediateDataSize() - (packer.getPosition() - start))
+    
+    # packs the python values of the elements with a single struct call, which checks them in bulk
+    def packPythonValues(self):
+        elementType = self.type.getElementType()
+        try:
+            return elementType.packArray(self.values)
+        except struct.error:
+            for i, value in enumerate(self.values):  # find the offending element
+                try:
+                    elementType.assertValueHasType(value)
+                except Exception as e:
+                    raise Exception("cannot pack element %d of %s array: %s" % (i, elementType.getName(), e))
+            raise
+    
+    # the elements are scheduled one at a time, so the pending stack of the packer doesn't grow with the array
+    def packReferred(self, packer, position, base, elementOffsetsRelativeToElement=True):
+        if not self.elementsAreValueObjects:
+            return
+        packer.pending.append((_ScheduleElements(self, elementOffsetsRelativeToElement), position, base))
+    
+    def hasReferredData(self):
+        return self.elementsAreValueObjects
+    
+    def getPrettyChildren(self):
+        return self.values if self.elementsAreValueObjects else None
+    
     def pretty(self):
+        if self.elementsAreValueObjects:
+            return Value.pretty(self)
+        return Array.prettyResults([str(v) for v in self.values], len(self.values))
+    
+    def prettyFromChildren(self, childResults):
+        return Array.prettyResults(childResults, len(childResults))
+    
+    # joins the pretty strings of the first elements, as long as they're not too long.
+    # results may be only the first results, numElements is the number of all elements
+    @staticmethod
+    def prettyResults(results, numElements):
         maxChars = 500
         minResults = 2
-        results = [v.pretty() if self.elementsAreValueObjects else str(v) for v in self.values]
         chars = 0
         i = 0
         while (chars <= maxChars or i < minResults) and i < len(results):
             chars += len(results[i])
             i += 1
-        return "[" + ", ".join(results[:i]) + (",..." if i < len(results) else "") + "]"
+        return "[" + ", ".join(results[:i]) + (",..." if i < numElements else "") + "]"
+
+
+# schedules the elements of an array in the pending stack of a packer, one element at a time, after all the
+# referred data of the previous element has been packed
+class _ScheduleElements(object):
+    __slots__ = ("values", "width", "elementOffsetsRelativeToElement", "index")
+    
+    def __init__(self, array, elementOffsetsRelativeToElement):
+        self.values = array.values
+        self.width = array.type.getElementType().getWidth()
+        self.elementOffsetsRelativeToElement = elementOffsetsRelativeToElement
+        self.index = 0
+    
+    def packReferred(self, packer, position, base):
+        i = self.index
+        self.index += 1
+        if self.index < len(self.values):
+            packer.pending.append((self, position, base))
+        offset = i * self.width
+        packer.schedule(self.values[i], position + offset,
+                        base + (offset if self.elementOffsetsRelativeToElement else 0))
 
 
 # c array - either variable length, or fixed length
 class SimpleArray(Array):
+    __slots__ = ("fixedSize",)
+    
     def __init__(self, elementType, values, fixedSize=None, byteAlignment=None):
         if isinstance(elementType, types.ReferenceType):
             raise Exception("simple arrays cannot store references")
         if fixedSize is not None:
             assert (len(values) <= fixedSize)
         self.fixedSize = fixedSize
-        Array.__init__(self, types.SimpleArrayType(elementType, fixedSize, byteAlignment), values)
+        Array.__init__(self, types.SimpleArrayType.get(elementType, fixedSize, byteAlignment), values)
     
     def getImmediateDataSize(self):
         return (self.type.getElementType().getWidth()
@@ -325,15 +570,212 @@ class SimpleArray(Array):
             return immediateData + offsetData, ""
         else:
             return immediateData, offsetData
+    
+    # arrays of structs that can be packed in one call (see types.StructType.getPackFormat) are packed into a
+    # single buffer
+    def packImmediate(self, packer, base, elementOffsetsRelativeToElement=True):
+        packFormat = self.getElementPackFormat()
+        if packFormat is None or packer.recordsMembers:
+            Array.packImmediate(self, packer, base)
+            return
+        width = packFormat.struct.size
+        data = bytearray(self.getImmediateDataSize())
+        i = 0
+        try:
+            for i, value in enumerate(self.values):
+                packFormat.struct.pack_into(data, i * width, *value.getPackArguments())
+        except struct.error as e:
+            raise self.values[i].getPackException(e)
+        packer.append(data)
+    
+    def packReferred(self, packer, position, base, elementOffsetsRelativeToElement=True):
+        if self.hasReferredData():
+            Array.packReferred(self, packer, position, base)
+    
+    def hasReferredData(self):
+        return self.elementsAreValueObjects and self.getElementPackFormat() is None
+    
+    # returns the pack format of the elements, if they are struct values that can be packed in one call
+    def getElementPackFormat(self):
+        elementType = self.type.getElementType()
+        if self.elementsAreValueObjects and isinstance(elementType, types.StructType):
+            return elementType.getPackFormat()
+        return None
+    
+    # returns the packed elements, without the zero bytes that fill fixed size arrays
+    def getPackArgument(self):
+        if self.elementsAreValueObjects:
+            return "".join(value.pack()[0] for value in self.values)
+        return self.packPythonValues()
+
+
+# c array whose elements are stored as packed data, instead of python values or values.
+class PackedArray(SimpleArray):
+    __slots__ = ("data", "numElements")
+    
+    def __init__(self, arrayType, data, numElements):
+        if arrayType.fixedSize is not None:
+            assert (numElements <= arrayType.fixedSize)
+        # the elements don't have to be checked one by one, so avoid SimpleArray.__init__
+        Value.__init__(self, arrayType)
+        self.fixedSize = arrayType.fixedSize
+        self.elementsAreValueObjects = False
+        self.values = []
+        self.data = data
+        self.numElements = numElements
+    
+    def getImmediateDataSize(self):
+        return len(self.data) if self.fixedSize is None else self.fixedSize * self.type.getElementType().getWidth()
+    
+    def pack(self, dataOffset=None, elementOffsetsRelativeToElement=True):
+        return self.data + "\x00" * (self.getImmediateDataSize() - len(self.data)), ""
+    
+    def packImmediate(self, packer, base):
+        packer.append(self.data)
+        packer.appendZeros(self.getImmediateDataSize() - len(self.data))
+    
+    def hasReferredData(self):
+        return False
+    
+    def getPackArgument(self):
+        return self.data
+
+
+# c array of integers, stored as packed little endian data, without a python value for every element.
+# The integers may be a numpy array, an array.array, a sequence of integers, or bytes (a string, bytearray,
+# memoryview or buffer), which are used as the packed little endian data of the elements.
+# The ranges of numpy arrays and array.arrays are validated using their minimum and maximum.
+class NumericArray(PackedArray):
+    __slots__ = ()
+    
+    def __init__(self, elementType, integers, fixedSize=None, byteAlignment=None):
+        if not isinstance(elementType, types.IntType) or isinstance(elementType, types.CharType):
+            raise Exception("numeric arrays can only store integers, received type " + repr(elementType))
+        width = elementType.getWidth()
+        if hasattr(integers, "dtype"):  # a numpy array
+            data = NumericArray.packNumpyArray(elementType, integers)
+        elif isinstance(integers, array.array):
+            data = NumericArray.packArray(elementType, integers)
+        elif isinstance(integers, (str, bytearray, memoryview, buffer)):
+            data = integers if isinstance(integers, str) else str(bytearray(integers))
+            if len(data) % width != 0:
+                raise Exception("the data of %s elements has to be a multiple of %d bytes, received %d bytes"
+                                % (elementType.getName(), width, len(data)))
+        else:
+            integers = list(integers)
+            if validation == EAGER:
+                for integer in integers:
+                    if not isinstance(integer, numbers.Integral):
+                        raise Exception(repr(integer) + " is not integral")
+            elif validation == DEFERRED:
+                _assertDeferredValues(elementType, integers)
+            try:
+                data = elementType.packArray(integers)
+            except struct.error:
+                for number in integers:  # find the offending number
+                    elementType.assertValueHasType(number)
+                raise
+        numElements = len(data) / width
+        PackedArray.__init__(self, types.SimpleArrayType.get(elementType, fixedSize, byteAlignment), data, numElements)
+    
+    @staticmethod
+    def packNumpyArray(elementType, integers):
+        if integers.ndim != 1 or integers.dtype.kind not in "biu":
+            raise Exception("numeric arrays can only be built from one dimensional integer numpy arrays, received "
+                            + repr(integers.dtype) + " with shape " + repr(integers.shape))
+        if len(integers) > 0 and validation != TRUSTED:
+            elementType.assertValueHasType(int(integers.min()))
+            elementType.assertValueHasType(int(integers.max()))
+        return integers.astype("<" + elementType.getFormatChar()).tostring()
+    
+    @staticmethod
+    def packArray(elementType, integers):
+        if integers.typecode not in "bBhHiIlL":
+            raise Exception("numeric arrays can only be built from integer arrays, received typecode "
+                            + integers.typecode)
+        if len(integers) > 0 and validation != TRUSTED:
+            elementType.assertValueHasType(min(integers))
+            elementType.assertValueHasType(max(integers))
+        typeCodes = [typeCode for typeCode in ("BHIL" if elementType.unsigned else "bhil")
+                     if array.array(typeCode).itemsize == elementType.getWidth()]
+        if len(typeCodes) == 0:  # no matching array type, e.g. 64 bit on some platforms
+            return elementType.packArray(integers.tolist())
+        if integers.typecode != typeCodes[0] or sys.byteorder != "little":
+            integers = array.array(typeCodes[0], integers)
+        if sys.byteorder != "little":
+            integers.byteswap()
+        return integers.tostring()
+    
+    def getPythonValue(self):
+        return list(struct.unpack("<" + str(self.numElements) + self.type.getElementType().getFormatChar(),
+                                  self.data))
+    
+    def pretty(self):
+        numResults = min(self.numElements, 502)  # more can't be printed
+        formatString = "<" + str(numResults) + self.type.getElementType().getFormatChar()
+        return Array.prettyResults([str(v) for v in struct.unpack_from(formatString, self.data)], self.numElements)
+
+
+# c array of structs, whose type only has primitive members. The rows are packed directly, without creating a
+# struct value for every row, see types.StructType.makeArray
+class StructArray(PackedArray):
+    __slots__ = ()
+    
+    def __init__(self, structType, rows, fixedSize=None):
+        rowFormat = structType.getRowFormat()
+        if rowFormat is None:
+            raise Exception("struct arrays can only be built from finalized struct types with primitive members")
+        structType.shared = True  # the rows are packed with the row format of the type
+        names = structType.getMemberNames()
+        data = []
+        row = None
+        try:
+            for row in rows:
+                if isinstance(row, dict):
+                    row = [row[name] for name in names]
+                if validation != TRUSTED and not _integralTypes.issuperset(map(type, row)):
+                    StructArray.assertRowHasTypes(structType, row)  # struct would truncate non integral numbers
+                data.append(rowFormat.pack(*row))
+        except struct.error as e:
+            raise Exception("cannot pack %s as struct %s: %s" % (repr(row), structType.name, e))
+        PackedArray.__init__(self, types.SimpleArrayType.get(structType, fixedSize), "".join(data), len(data))
+    
+    # raises an exception naming the row if one of its values doesn't match the type of its member
+    @staticmethod
+    def assertRowHasTypes(structType, row):
+        memberTypes = [memberType for i, memberType in enumerate(structType.types)
+                       if i not in structType.paddingIndices]
+        for memberType, value in zip(memberTypes, row):
+            try:
+                memberType.assertValueHasType(value)
+            except Exception as e:
+                raise Exception("cannot pack %s as struct %s: %s" % (repr(row), structType.name, e))
+    
+    # returns the elements as struct values
+    def getPythonValue(self):
+        return [self.type.getElementType().makeValue(row)
+                for row in self.unpackRows(self.numElements)]
+    
+    # returns the first rows as tuples
+    def unpackRows(self, numRows):
+        rowFormat = self.type.getElementType().getRowFormat()
+        return [rowFormat.unpack_from(self.data, i * rowFormat.size) for i in range(numRows)]
+    
+    def pretty(self):
+        structType = self.type.getElementType()
+        rows = self.unpackRows(min(self.numElements, 502))  # more can't be printed
+        return Array.prettyResults([structType.makeValue(row).pretty() for row in rows], self.numElements)
 
 
 # c array of chars - arbitrary strings get converted to utf-8
 class String(SimpleArray):
+    __slots__ = ("string",)
+    
     def __init__(self, string="", fixedSize=None, omitTerminal=False):
         chars = stringhelper.stringToChars(string)
         if omitTerminal:
             chars = chars[:-1]
-        SimpleArray.__init__(self, types.CharType(), chars, fixedSize)
+        SimpleArray.__init__(self, types.CHAR, chars, fixedSize)
         self.string = string
     
     def pretty(self):
@@ -347,33 +789,88 @@ class String(SimpleArray):
 
 
 # c array of chars - but inputs as arrays of 0/1 (bit) values, packed into 8 bits per char
+# all blob inputs are kept in blobStrings, unless storeBlobStrings is set to False
 blobStrings = []
+storeBlobStrings = True
+
+
+# returns the bytes of an object supporting the buffer protocol with 1 byte items, for Blob
+def _getBlobBytes(blob):
+    if isinstance(blob, array.array):  # only supports the old buffer protocol
+        data = buffer(blob)
+        itemSize = blob.itemsize
+    else:
+        try:
+            data = memoryview(blob)
+        except TypeError:
+            raise TypeError("a blob has to be given as bits or bytes, not %s" % type(blob).__name__)
+        itemSize = data.itemsize
+    if itemSize != 1:
+        raise TypeError("a blob given as bytes needs 1 byte items, not %d byte items" % itemSize)
+    return data
 
 
 class Blob(SimpleArray):
+    __slots__ = ("blob",)
+    
+    # the blob may be 0/1 bit values, given as a list, tuple, xrange or iterator, or a unicode string of '0'/'1'.
+    # Anything else has to be bytes: a string, bytearray, memoryview, buffer, or any other object supporting
+    # the buffer protocol with 1 byte items, like array.arrays of chars or bytes, or numpy uint8 arrays.
+    # Bytes are stored directly, without copying - so they should not be modified until they are packed.
     # the alignment is 4 bytes by default, which can be overriden
     def __init__(self, blob, fixedSize=None, byteAlignment=4):
-        global blobStrings
-        blobStrings.append(blob)
-        if isinstance(blob, basestring):
-            bitArrays = [bithelper.toBits(ord(c), numBits=8) for c in blob]
-            blob = []
-            for bitArray in bitArrays:
-                blob.extend(bitArray)
-        blob = array.array('B', blob)  # turn blob into an actual binary array - if it's not a string
-        SimpleArray.__init__(self, types.CharType(), bithelper.packBitsToChars(blob), fixedSize, byteAlignment)
-        self.blob = blob
+        if storeBlobStrings:
+            blobStrings.append(blob)
+        self.blob = None  # the bits, if the blob was given as bits
+        if isinstance(blob, (str, bytearray, memoryview, buffer)):
+            data = blob
+        elif isinstance(blob, unicode):
+            data = bithelper.packBitsToChars(blob).encode("latin-1")
+        elif isinstance(blob, (list, tuple, xrange, collections.Iterator)):
+            self.blob = array.array('B', blob)  # turn blob into an actual binary array
+            data = bithelper.packBitsToChars(self.blob)
+        else:
+            data = _getBlobBytes(blob)
+        if fixedSize is not None:
+            assert (len(data) <= fixedSize)
+        # the bytes don't have to be checked element by element, so avoid SimpleArray.__init__
+        Value.__init__(self, types.SimpleArrayType.get(types.CHAR, fixedSize, byteAlignment))
+        self.fixedSize = fixedSize
+        self.elementsAreValueObjects = False
+        self.values = data
+    
+    def pack(self, dataOffset=None, elementOffsetsRelativeToElement=True):
+        return str(bytearray(self.values)) + "\x00" * (self.getImmediateDataSize() - len(self.values)), ""
+    
+    def packImmediate(self, packer, base):
+        packer.append(self.values)
+        packer.appendZeros(self.getImmediateDataSize() - len(self.values))
+    
+    def hasReferredData(self):
+        return False
+    
+    def getPackArgument(self):
+        return str(bytearray(self.values))
     
     def pretty(self):
-        return stringhelper.cutStringIfTooLong("[" + ''.join(str(b) for b in self.blob[0:200]) + "]",
-                                               length=len(self.blob))
+        bits = self.blob if self.blob is not None else bithelper.unpackCharsToBits(self.values[0:25])
+        return stringhelper.cutStringIfTooLong("[" + ''.join(str(b) for b in bits[0:200]) + "]",
+                                               length=self.getNumBits())
     
+    def getNumBits(self):
+        return len(self.values) * 8 if self.blob is None else len(self.blob)
+    
+    # returns the blob as an array of bits
     def getPythonValue(self):
+        if self.blob is None:  # the bits are not stored for blobs given as bytes
+            return bithelper.unpackCharsToBits(self.values)
         return self.blob
 
 
 # reference array
 class ReferenceArray(Array):
+    __slots__ = ("fixedSize",)
+    
     # construct reference array from a sequence of values - those may be values, or will be turned into values
     def __init__(self, values, fixedSize=None, referenceBitWidth=32):
         if len(values) == 0:
@@ -414,14 +911,29 @@ class ReferenceArray(Array):
             return immediateData + offsetData, ""
         else:
             return immediateData, offsetData
+    
+    def setReferenceBitWidth(self, referenceBitWidth):
+        self.type.setReferenceBitWidth(referenceBitWidth)
+        for reference in self.values:
+            reference.setReferenceBitWidth(referenceBitWidth)
+    
+    def packImmediate(self, packer, base, elementOffsetsRelativeToElement=False):
+        Array.packImmediate(self, packer, base, elementOffsetsRelativeToElement=False)
+    
+    def packReferred(self, packer, position, base, elementOffsetsRelativeToElement=False):
+        Array.packReferred(self, packer, position, base, elementOffsetsRelativeToElement=False)
 
 
 # reserved is just a set of bytes reserved for future use
 class ReservedValue(SimpleArray):
+    __slots__ = ()
+    
     pass  # TODO?
 
 
 class EnumValue(Value):
+    __slots__ = ("name",)
+    
     def __init__(self, enumType, name):
         assert isinstance(enumType, types.EnumType)
         assert name in enumType.mapping
@@ -447,17 +959,36 @@ class EnumValue(Value):
     def pack(self, dataOffset=None):
         return self.type.mapping[self.name].pack(dataOffset=dataOffset)
     
+    def packImmediate(self, packer, base):
+        self.type.mapping[self.name].packImmediate(packer, base)
+    
+    def getPackArgument(self):
+        return self.getPythonValue()
+    
+    def packReferred(self, packer, position, base):
+        pass
+    
+    @staticmethod
+    def hasReferredData():
+        return False
+    
     def __repr__(self):
         return "%s.%s" % (self.type, self.name)
 
 
 # struct value
 # structs don't have fixed width unless they are closed/finished
+# primitive members (ints and chars) are stored as python values, the member type is stored in the struct type.
+# Padding is stored as the number of padding bytes of the gap. All other members are stored as Value objects, use
+# getMemberValues to get all members as Value objects.
 class Struct(Value, constants.AddConstantFunctions):
+    __slots__ = ("values", "version")
+    
     def __init__(self, name):
         structType = types.StructType(name)
         Value.__init__(self, structType)
-        self.values = []  # list of member values
+        self.values = []  # list of member values, python values for primitive members and padding
+        self.version = 0
     
     def __repr__(self):
         structType = self.type
@@ -466,6 +997,37 @@ class Struct(Value, constants.AddConstantFunctions):
                 + " with " + str(numMembers)
                 + " member%s>" % ("" if numMembers == 1 else "s"))
     
+    # creates a struct of the given finalized struct type, without creating a new type, see types.StructType.makeValue
+    @staticmethod
+    def fromType(structType, memberValues):
+        struct = Struct.__new__(Struct)
+        Value.__init__(struct, structType)
+        struct.version = 0
+        names = structType.getMemberNames()
+        if isinstance(memberValues, dict):
+            memberValues = [memberValues[name] for name in names]
+        if len(memberValues) != len(names):
+            raise Exception("expecting %d member values for struct %s, received %s"
+                            % (len(names), structType.name, memberValues))
+        memberValues = iter(memberValues)
+        struct.values = []
+        for i, memberType in enumerate(structType.types):
+            if i in structType.paddingIndices:
+                struct.values.append(memberType.getWidth())
+                continue
+            value = next(memberValues)
+            if isinstance(value, Value):
+                memberType.merge(value.getType())
+                if isinstance(value, PrimitiveValue):
+                    value = value.getPythonValue()
+            elif isinstance(memberType, types.PrimitiveType):
+                if validation == EAGER or (validation == DEFERRED and type(value) not in _integralTypes):
+                    memberType.assertValueHasType(value)
+            else:
+                value = memberType.makeValue(value)
+            struct.values.append(value)
+        return struct
+    
     def getName(self):
         return self.type.name
     
@@ -476,15 +1038,42 @@ class Struct(Value, constants.AddConstantFunctions):
     def getPythonValue(self):
         return self  # struct is a container, so it's not a python value
     
+    def getContainedValues(self):
+        return [value for value in self.values if isinstance(value, Value)]
+    
+    # returns an ordered dictionary member name -> value of all members except padding, with primitive members
+    # turned into Value objects
+    def getMemberValues(self):
+        structType = self.type
+        return collections.OrderedDict(
+            (structType.names[i], value if isinstance(value, Value) else structType.types[i].makeValue(value))
+            for i, value in enumerate(self.values) if i not in structType.paddingIndices)
+    
+    def isMutable(self):
+        return self.type.mutable
+    
     def get(self, key):  # returns the python value associated with the given key
         if key in self.type.members:
-            index = self.type.members[key]
-            return self.values[index].getPythonValue()
+            value = self.values[self.type.members[key]]
+            return value.getPythonValue() if isinstance(value, Value) else value
         constantPool = self.getType().getConstantPool()
         return constantPool.get(key).getPythonValue()
     
+    # sums the sizes of the members, walking nested structs with an explicit stack
     def getImmediateDataSize(self):
-        return sum(v.getImmediateDataSize() for v in self.values)
+        size = 0
+        structs = [self]
+        while structs:
+            structValue = structs.pop()
+            memberTypes = structValue.type.types
+            for i, value in enumerate(structValue.values):
+                if isinstance(value, Struct):
+                    structs.append(value)
+                elif isinstance(value, Value):
+                    size += value.getImmediateDataSize()
+                else:
+                    size += memberTypes[i].getWidth()
+        return size
     
     # will add a new value to the struct.
     # if value is a dictionary, will add value[name]
@@ -500,6 +1089,8 @@ class Struct(Value, constants.AddConstantFunctions):
     
     # will add a reference to the given value to this struct
     # if the type is defined, and value=None allows adding a typed reference even if the value is Null
+    # if the referenceBitWidth is types.AUTO, the smallest bit width that fits the referred data gets
+    # selected when packing.
     def addReference(self, name, value, referenceBitWidth=32, targetType=None):
         if targetType is not None:
             if value is not None:
@@ -526,12 +1117,12 @@ class Struct(Value, constants.AddConstantFunctions):
         referenceBitWidth = 32
         return self.addReference(name, value, referenceBitWidth=referenceBitWidth, targetType=targetType)
     
-    # will add the value
+    # will add the value, primitive values are stored as python values
     def addImmediate(self, name, value):
         value = getValue(dictGet(value, name))
-        padBytes = self.getType().addMember(name, value.getType())
-        self.values.extend([Padding()] * padBytes)
-        self.values.append(value)
+        self.addPaddingValue(self.getType().addMember(name, value.getType()))
+        self.values.append(value.getPythonValue() if isinstance(value, PrimitiveValue) else value)
+        self.version += 1
         return self
     
     # add an int32 to the struct. if 'anInt' is a dictionary d, will add d[name]
@@ -561,14 +1152,48 @@ class Struct(Value, constants.AddConstantFunctions):
     def addUInt64(self, name, anInt):
         return self.add(name, Int(dictGet(anInt, name), True, 64))
     
+    # will add an array of integers to the struct, see NumericArray. If 'numbers' is a dictionary d, will add d[name]
+    # if the fixedSize is given, the array is stored inside the struct, otherwise it's referenced
+    # returns self
+    def addInt8Array(self, name, numbers, fixedSize=None, referenceBitWidth=32):
+        return self.addNumericArray(name, types.INT8, numbers, fixedSize, referenceBitWidth)
+    
+    def addInt16Array(self, name, numbers, fixedSize=None, referenceBitWidth=32):
+        return self.addNumericArray(name, types.INT16, numbers, fixedSize, referenceBitWidth)
+    
+    def addInt32Array(self, name, numbers, fixedSize=None, referenceBitWidth=32):
+        return self.addNumericArray(name, types.INT32, numbers, fixedSize, referenceBitWidth)
+    
+    def addInt64Array(self, name, numbers, fixedSize=None, referenceBitWidth=32):
+        return self.addNumericArray(name, types.INT64, numbers, fixedSize, referenceBitWidth)
+    
+    def addUInt8Array(self, name, numbers, fixedSize=None, referenceBitWidth=32):
+        return self.addNumericArray(name, types.UINT8, numbers, fixedSize, referenceBitWidth)
+    
+    def addUInt16Array(self, name, numbers, fixedSize=None, referenceBitWidth=32):
+        return self.addNumericArray(name, types.UINT16, numbers, fixedSize, referenceBitWidth)
+    
+    def addUInt32Array(self, name, numbers, fixedSize=None, referenceBitWidth=32):
+        return self.addNumericArray(name, types.UINT32, numbers, fixedSize, referenceBitWidth)
+    
+    def addUInt64Array(self, name, numbers, fixedSize=None, referenceBitWidth=32):
+        return self.addNumericArray(name, types.UINT64, numbers, fixedSize, referenceBitWidth)
+    
+    def addNumericArray(self, name, elementType, numbers, fixedSize=None, referenceBitWidth=32):
+        value = NumericArray(elementType, dictGet(numbers, name), fixedSize)
+        if value.getType().isImmediate():
+            return self.addImmediate(name, value)
+        return self.addReference(name, value, referenceBitWidth)
+    
     def addChar(self, name, aChar):
         return self.add(name, Char(dictGet(aChar, name)))
     
-    # will reference add a binary blob, either an array of 0/1 values, or a string, to the struct.
+    # will reference add a binary blob, either an array of 0/1 values, or bytes (see Blob), to the struct.
     # if 'aBlob' is a dictionary d, will add d[name] will store the the byte offset in the C struct,
     # using the name <name>+ByteOffset. If the name exists, will throw an error.
     # Blobs will be word aligned by default, but that can be overriden.
     # Blobs are stored little endian, i.e. [0,1,0,0,1,0,0,1]=0x92=146.
+    # the referenceBitWidth may be types.AUTO, see addReference.
     # returns self
     def addBlob(self, name, blob, referenceBitWidth=32):
         self.addReference(name, Blob(dictGet(blob, name)), referenceBitWidth=referenceBitWidth)
@@ -582,14 +1207,14 @@ class Struct(Value, constants.AddConstantFunctions):
     # a reference to a variable length string.
     # If omit terminal is true, will omit the '\0' terminal character at the end of the string.
     # reference bit width allows overriding the bit widh of the reference (byte offset) used,
-    # if the string is not stored as an immediate value.
+    # if the string is not stored as an immediate value. It may be types.AUTO, see addReference.
     # returns self
     def addString(self, name, string, fixedWidth=None, omitTerminal=False, referenceBitWidth=32):
         string = dictGet(string, name)
         if string is None:
             if fixedWidth is not None:
                 raise Exception("cannot add fixed with string as a null-reference")
-            self.addImmediate(name, Reference(None, targetType=types.SimpleArrayType(types.CharType())))
+            self.addImmediate(name, Reference(None, targetType=types.SimpleArrayType.get(types.CHAR)))
         else:
             self.addReference(name, String(string, fixedWidth, omitTerminal), referenceBitWidth)
         return self
@@ -611,6 +1236,7 @@ class Struct(Value, constants.AddConstantFunctions):
     # if value is a dictionary, will add value[name]
     # if the value is an array of Value objects, will add an array with the val
     # otherwise it will attempt to turn the value into a value using "getValue"
+    # the referenceBitWidth of the elements may be types.AUTO, see addReference.
     def addReferenceArray(self, name, arrayValues, fixedSize=None, referenceBitWidth=32):
         arrayValues = dictGet(arrayValues, name)
         arrayValues = [getValue(v) for v in arrayValues]
@@ -624,10 +1250,71 @@ class Struct(Value, constants.AddConstantFunctions):
     # this will finalize type of this struct. The Struct may never grow in size from this point on.
     # returns self.
     def finalize(self, byteAlignment=4):
-        padBytes = self.getType().finalize(byteAlignment)
-        self.values.extend([Padding()] * padBytes)
+        self.addPaddingValue(self.getType().finalize(byteAlignment))
+        self.version += 1
         return self
     
+    # stores the padding member the struct type added before a member or at its end, if there was a gap
+    def addPaddingValue(self, padBytes):
+        if padBytes > 0:
+            self.values.append(padBytes)
+    
+    # adds all the members again, recomputing offsets and padding bytes - this is necessary if the width or
+    # alignment of member types changed. If the struct was finalized, it will be finalized again.
+    # names may be a list of all the member names, in the order in which they should be added.
+    def relayout(self, names=None):
+        structType = self.getType()
+        members = [(structType.names[i], (structType.types[i], value)) for i, value in enumerate(self.values)
+                   if i not in structType.paddingIndices]
+        if names is not None:
+            memberValues = dict(members)
+            if sorted(names) != sorted(memberValues):
+                raise Exception("the names %s are not the members of struct %s" % (names, structType.name))
+            members = [(name, memberValues[name]) for name in names]
+        byteAlignment = structType.byteAlignment
+        structType.removeMembers()
+        self.values = []
+        for name, (memberType, value) in members:
+            self.addPaddingValue(structType.addMember(name, memberType))
+            self.values.append(value)
+        if byteAlignment is not None:
+            self.addPaddingValue(structType.finalize(byteAlignment))
+        self.version += 1
+    
+    # raises an exception if the members of the struct can't be reordered, because its type is shared or one of
+    # the names in keepOrder is not a member
+    def assertCanRelayout(self, keepOrder=()):
+        structType = self.getType()
+        if structType.shared:
+            raise Exception("cannot change the members of struct type %s, it is shared by the values created from it"
+                            % structType.name)
+        for name in keepOrder:
+            if name not in structType.members or structType.members[name] in structType.paddingIndices:
+                raise Exception("cannot keep the order of %s, it's not a member of struct %s"
+                                % (name, structType.getName()))
+    
+    # reorders the members of the struct to minimize the number of padding bytes, by sorting them by decreasing
+    # alignment. The members given in keepOrder (i.e. the members of an earlier version of the struct) are kept
+    # at the start of the struct, in the order they are listed in, so that the struct stays compatible with the
+    # earlier version. A last member without fixed width stays last.
+    # returns the number of padding bytes that were removed
+    def minimizePadding(self, keepOrder=()):
+        self.assertCanRelayout(keepOrder)
+        structType = self.getType()
+        members = [(name, structType.types[i]) for i, name in enumerate(structType.names)
+                   if i not in structType.paddingIndices]
+        fixedNames = list(keepOrder)
+        keepOrder = set(keepOrder)
+        lastNames = []
+        if len(members) > 0 and members[-1][0] not in keepOrder and not members[-1][1].isImmediate():
+            lastNames = [members.pop()[0]]
+        sortedMembers = sorted([(name, memberType) for name, memberType in members if name not in keepOrder],
+                               key=lambda member: -member[1].getAlignment())  # sort is stable
+        sortedNames = [name for name, memberType in sortedMembers]
+        numPadBytes = structType.numPadBytes
+        self.relayout(fixedNames + sortedNames + lastNames)
+        return numPadBytes - structType.numPadBytes
+    
     def pretty(self):
         result = "struct " + self.type.getName() + " {"
         length = max([0] + [len(repr(self.type.getMember(i)[1])) for i in range(len(self.values))])
@@ -640,6 +1327,12 @@ class Struct(Value, constants.AddConstantFunctions):
         return result
     
     def pack(self, dataOffset=None):
+        packFormat = self.type.getPackFormat()
+        if packFormat is not None:  # there is no referred data
+            try:
+                return packFormat.struct.pack(*self.getPackArguments()), ""
+            except struct.error as e:
+                raise self.getPackException(e)
         if True:  # try:
             if dataOffset is None:
                 dataOffset = self.getImmediateDataSize()
@@ -649,6 +1342,12 @@ class Struct(Value, constants.AddConstantFunctions):
             immediateData = ""
             offsetedData = ""
             for i, value in enumerate(self.values):
+                if not isinstance(value, Value):
+                    try:
+                        immediateData += self.type.types[i].pack(value)
+                    except struct.error as e:
+                        raise self.getPackException(e)
+                    continue
                 immediate, referred = value.pack(dataOffset)
                 dataOffset += len(referred)
                 immediateData = immediateData + immediate
@@ -663,18 +1362,74 @@ class Struct(Value, constants.AddConstantFunctions):
                 #    print "error when packing struct %s, member %s" % (self.getName(),repr(currentMember))
                 #    raise e
     
+    def packImmediate(self, packer, base):
+        try:
+            packFormat = self.type.getPackFormat()
+            if packFormat is not None and not packer.recordsMembers:
+                packer.append(packFormat.struct.pack(*self.getPackArguments()))
+                return
+            memberTypes = self.type.types
+            paddingIndices = self.type.paddingIndices
+            for i, value in enumerate(self.values):
+                if isinstance(value, Value):
+                    packer.packImmediate(value, base)
+                elif i in paddingIndices:
+                    packer.appendZeros(value)
+                else:
+                    packer.append(memberTypes[i].pack(value))
+        except struct.error as e:
+            raise self.getPackException(e)
+    
+    # returns an exception naming the member that can't be packed, given the error raised by struct when packing
+    # this struct. Returns the error if no member is found.
+    def getPackException(self, error):
+        structType = self.type
+        for i, value in enumerate(self.values):
+            if i in structType.paddingIndices or isinstance(value, Reference):
+                continue
+            try:
+                if isinstance(value, Value):
+                    value.pack(0)
+                else:
+                    structType.types[i].assertValueHasType(value)
+            except Exception as e:
+                return Exception("cannot pack member %s of struct %s: %s" % (structType.names[i], structType.name, e))
+        return error
+    
+    def hasReferredData(self):
+        return self.type.getPackFormat() is None
+    
+    # returns the arguments for the pack format of the struct type (see types.StructType.getPackFormat)
+    def getPackArguments(self):
+        packFormat = self.type.getPackFormat()
+        if packFormat.memberIndices is not None:
+            memberValues = self.values
+            arguments = [memberValues[i] for i in packFormat.memberIndices]
+        elif len(packFormat.valueIndices) == 0:
+            return self.values
+        else:
+            arguments = list(self.values)
+        for i in packFormat.valueIndices:
+            arguments[i] = arguments[i].getPackArgument()
+        return arguments
+    
+    def packReferred(self, packer, position, base):
+        offsets = self.type.offsets
+        for i in reversed(range(len(self.values))):
+            value = self.values[i]
+            if isinstance(value, Value) and value.hasReferredData():
+                packer.schedule(value, position + offsets[i], base)
+    
     # prints the sizes of every member
     # indent allows indenting the printing result by 'indent' spaces
-    def printSizes(self, indent=0):
+    # plan may be a layout plan that contains this struct, otherwise one will be created
+    def printSizes(self, indent=0, plan=None):
+        if plan is None:
+            plan = namedstruct.planLayout(self)
         # collect names/sizes
-        names = []
-        sizes = []
-        dataOffset = self.getImmediateDataSize()
-        for i, value in enumerate(self.values):
-            immediate, referred = value.pack(dataOffset)
-            names.append(self.type.getMember(i)[2])
-            sizes.append(len(immediate) + len(referred))
-            dataOffset += len(referred)
+        names = [self.type.getMember(i)[2] for i in range(len(self.values))]
+        sizes = [plan.getPackedSize(value) if isinstance(value, Value) else self.type.types[i].getWidth()
+                 for i, value in enumerate(self.values)]
         total = "total:"
         maxNameLen = max([len(total)] + [len(name) for name in names]) + 1
         numLen = len(str(sum(sizes)))
@@ -690,80 +1445,153 @@ class Struct(Value, constants.AddConstantFunctions):
 
 # an array of bitfield values, with variable number of bits
 class BitFieldArray(Value):
+    __slots__ = ("columns", "entries", "fieldLengths", "version")
+    
     def __init__(self, name, *fields):
         super(BitFieldArray, self).__init__(types.BitFieldArrayType(name, fields))
         self.entries = []  # each entry is an array of (isBlob,value)
+        self.columns = None  # list of numpy arrays for every field, replaces the entries (see fromColumns)
+        self.fieldLengths = [0] * len(fields)  # the number of bits of every field, updated when adding entries
+        self.version = 0
+    
+    # creates a bit field array from columns of integers, without creating entries for every row.
+    # columns may be a dictionary field name -> sequence of values (e.g. a numpy array), or a sequence of columns.
+    # fields is the list of field names, if it's None, the keys of the columns are used, sorted
+    # (unless columns is an OrderedDict). Requires numpy.
+    @staticmethod
+    def fromColumns(name, columns, fields=None):
+        import numpy  # numpy is optional, it's only required for columns
+        if fields is None:
+            if not isinstance(columns, dict):
+                raise Exception("fields are required if the columns are not a dictionary")
+            fields = columns.keys() if isinstance(columns, collections.OrderedDict) else sorted(columns.keys())
+        if isinstance(columns, dict):
+            columns = [columns[field] for field in fields]
+        if len(columns) != len(fields):
+            raise Exception("expecting %d columns, received %d" % (len(fields), len(columns)))
+        result = BitFieldArray(name, *fields)
+        result.columns = []
+        for field, column in zip(fields, columns):
+            column = numpy.asarray(column)
+            if column.dtype.kind not in "biu":
+                raise Exception("bitFieldArray column %s has to be integral, received %s" % (field, column.dtype))
+            if len(column) != len(columns[0]):
+                raise Exception("all columns of bitFieldArray %s need to have the same length" % name)
+            if len(column) > 0 and not (0 <= column.min() and column.max() < 2 ** 31):
+                raise Exception("bitFieldArray only supports values between 0 (incl) and 2^31 (excl), "
+                                "received column %s with values in [%d, %d]" % (field, column.min(), column.max()))
+            result.columns.append(column.astype(numpy.uint64))
+        if len(result) > 0:
+            result.fieldLengths = [bithelper.requiredBits(int(column.max())) for column in result.columns]
+        return result
     
     def __repr__(self):
         return "<BitFieldArray:%s with %d fields>" % (self.type.getName(), len(self.type.getFields()))
     
     def __len__(self):
+        if self.columns is not None:
+            return len(self.columns[0]) if len(self.columns) > 0 else 0
         return len(self.entries)
     
+    # returns the entries, creating them from the columns if necessary
+    def getEntries(self):
+        if self.columns is not None:
+            return [[(False, int(value)) for value in row] for row in zip(*self.columns)]
+        return self.entries
+    
     # adds a new entry to the bit field array
     # the fieldValues may be a dictionary of field-value, or a sequence of values in the same order as the fields
     # the values themselves may be (positive) integers, or Blob objects
     def add(self, fieldValues=None, **fieldValuesDict):
         if fieldValues is None:
             fieldValues = fieldValuesDict
-        fields = self.type.getFields()
-        if len(fields) != len(fieldValues):
-            raise Exception("expecting %d field values, received %s" % (len(fields), fieldValues))
-        if isinstance(fieldValues, dict):
-            fieldValues = [fieldValues[field] for field in fields]
-        entry = []
-        for value in fieldValues:
-            if isinstance(value, Blob):
-                entry.append((True, value))
-            else:
-                if not isinstance(value, numbers.Integral):
-                    raise Exception(
-                            "attempting to add " + repr(value) + ", but bitFieldArray only supports int or blobValue.")
-                if not (0 <= value < 2 ** 31):
-                    raise Exception(
-                            "bitFieldArray only supports values between 0 (incl) and 2^31 (excl), received " + repr(value))
-                entry.append((False, value))
-        self.entries.append(entry)
-        return self
+        return self.extend([fieldValues])
     
     # calls add on all elements of a sequence, returns self
     def addAll(self, entries):
-        for entry in entries:
-            self.add(entry)
+        return self.extend(entries)
+    
+    # adds all the entries of an iterable, every entry is given like the fieldValues of add
+    # the bit lengths of the fields are updated while adding, so they never have to be recomputed
+    # if an entry is invalid, none of the entries are added
+    # returns self
+    def extend(self, entries):
+        if self.columns is not None:  # rows get added as entries
+            self.entries = self.getEntries()
+            self.columns = None
+        numEntries = len(self.entries)
+        fieldLengths = list(self.fieldLengths)
+        try:
+            self._extend(entries)
+        except:
+            del self.entries[numEntries:]
+            self.fieldLengths = fieldLengths
+            raise
+        finally:
+            self.version += 1
         return self
     
+    # adds the entries for extend, which undoes it on errors
+    def _extend(self, entries):
+        fields = self.type.getFields()
+        fieldLengths = self.fieldLengths
+        appendEntry = self.entries.append
+        for fieldValues in entries:
+            if len(fields) != len(fieldValues):
+                raise Exception("expecting %d field values, received %s" % (len(fields), fieldValues))
+            if isinstance(fieldValues, dict):
+                fieldValues = [fieldValues[field] for field in fields]
+            entry = []
+            for i, value in enumerate(fieldValues):
+                if isinstance(value, Blob):
+                    entry.append((True, value))
+                    numBits = value.getNumBits()
+                else:
+                    if not isinstance(value, numbers.Integral):
+                        raise Exception(
+                                "attempting to add " + repr(value) + ", but bitFieldArray only supports int or blobValue.")
+                    if not (0 <= value < 2 ** 31):
+                        raise Exception(
+                                "bitFieldArray only supports values between 0 (incl) and 2^31 (excl), received " + repr(value))
+                    entry.append((False, value))
+                    numBits = bithelper.requiredBits(value)
+                if numBits > fieldLengths[i]:
+                    fieldLengths[i] = numBits
+            appendEntry(entry)
+    
     @staticmethod
     def hasFixedWidth():
         return False
     
+    def isMutable(self):
+        return True
+    
     def getPythonValue(self):
         return self
     
     def get(self, fieldName, index):  # returns the value of the field name at the given index
+        if self.columns is not None:
+            return int(self.columns[self.type.getFields().index(fieldName)][index])
         return self.entries[index][self.type.getFields().index(fieldName)][1]
     
     # for every field, returns the bit length of it
     def getFieldLengths(self):
-        fields = self.type.getFields()
-        if len(self.entries) == 0:
-            return [0] * len(fields)
-        return [
-            max(len(entry[fieldIndex][1].getPythonValue())
-                if entry[fieldIndex][0] else
-                bithelper.requiredBits(entry[fieldIndex][1])
-                for entry in self.entries)
-            for fieldIndex in range(len(fields))]
+        return list(self.fieldLengths)
     
     def pretty(self):
         fields = self.type.getFields()
         fieldLengths = self.getFieldLengths()
-        result = "bitFieldArray[{length}x{numBits}]{{".format(length=len(self.entries), numBits=sum(fieldLengths))
+        result = "bitFieldArray[{length}x{numBits}]{{".format(length=len(self), numBits=sum(fieldLengths))
         rows = [stringhelper.indent + s + ":" for s in stringhelper.getColumn(fields)]
         rows = [rows[i] + s + " = [" for i, s in enumerate(stringhelper.getColumn(fieldLengths))]
         maxColumnWidth = 80
         maxEntryWidth = 12
-        numEntries = len(self.entries)
-        for i, entry in enumerate(self.entries):
+        numEntries = len(self)
+        entries = self.entries
+        if self.columns is not None:  # only the first entries can be printed
+            entries = [[(False, int(value)) for value in row]
+                       for row in zip(*[column[:maxColumnWidth] for column in self.columns])]
+        for i, entry in enumerate(entries):
             # build column values
             values = []
             for isBlob, value in entry:
@@ -790,26 +1618,35 @@ class BitFieldArray(Value):
     
     def getImmediateDataSize(self):
         fieldLengths = self.getFieldLengths()
-        return (len(fieldLengths) + 2) * 2 + (sum(fieldLengths) * len(self.entries) + 7) / 8
+        return (len(fieldLengths) + 2) * 2 + (sum(fieldLengths) * len(self) + 7) / 8
     
     def pack(self, dataOffset=None):
         fieldLengths = self.getFieldLengths()
         offset = (len(fieldLengths) + 2) * 16
         headerValues = [sum(fieldLengths)] + [offset + sum(fieldLengths[:i]) for i in range(len(fieldLengths) + 1)]
-        header = namedstruct.pack(SimpleArray(types.UINT16, headerValues), addPadding=False)
+        header = packer.Packer().pack(SimpleArray(types.UINT16, headerValues)).getData()
+        if self.columns is not None:
+            return header + bithelper.packBitColumns(self.columns, fieldLengths), ""
         # create data blob
-        blob = array.array('B', [])
+        writer = bithelper.BitWriter()
         for entry in self.entries:
             for i, (isBlob, value) in enumerate(entry):
                 if isBlob:
-                    b = value.getPythonValue()
-                    blob.extend(b)
-                    blob.extend((fieldLengths[i] - len(b)) * array.array('B', [0]))
-                else:
-                    blob.extend(array.array('B', bithelper.toBits(value, fieldLengths[i])))
-        data = namedstruct.pack(Blob(blob), addPadding=False)
-        assert (len(blob) == sum(fieldLengths) * len(self.entries))
+                    value = bithelper.bytesToInt(value.values)
+                writer.write(value, fieldLengths[i])
+        assert (writer.getNumBits() == sum(fieldLengths) * len(self.entries))
+        data = packer.Packer().pack(Blob(writer.getData())).getData()
         return header + data, ""
+    
+    def packImmediate(self, packer, base):
+        packer.append(self.pack()[0])
+    
+    def packReferred(self, packer, position, base):
+        pass
+    
+    @staticmethod
+    def hasReferredData():
+        return False
 
 
 # if value is a dictionary, returns value[name], otherwise returns value